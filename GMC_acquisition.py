@@ -0,0 +1,136 @@
+"""Continuous heartbeat acquisition for GQ GMC Geiger counters
+
+HeartbeatStream reads <HEARTBEAT1>> samples from a GMCDevice into a SampleRing,
+a fixed size ring of (monotonic timestamp, counts per second) pairs backed by
+two arrays, so a stream can run indefinitely in constant memory. Consumers read
+the ring through memoryview segments without copying.
+"""
+import threading, time
+from array import array
+from GMC_timing import SampleClock
+
+DEFAULT_CAPACITY = 86400 # one day of 1 Hz samples
+POLL_TIME = 0.25 # longest a stream waits before checking its stop flag
+
+class SampleRing:
+    """Fixed capacity ring of (timestamp, count) samples
+
+    Every sample gets a sequence number (0, 1, 2, ...); <total> is the number of
+    samples ever appended. Only the last <capacity> samples are kept. There is a
+    single writer, readers must finish with a segment before the writer wraps
+    around onto it.
+    """
+    def __init__(self, capacity: int = DEFAULT_CAPACITY):
+        self.capacity = capacity
+        self.times = array('d', bytes(8*capacity))
+        self.counts = array('I', bytes(array('I').itemsize*capacity))
+        self.total = 0
+    def __len__(self):
+        return min(self.total, self.capacity)
+    @property
+    def oldest(self) -> int:
+        """Sequence number of the oldest sample still held
+        """
+        return max(0, self.total - self.capacity)
+    def append(self, timestamp: float, count: int):
+        i = self.total % self.capacity
+        self.times[i] = timestamp
+        self.counts[i] = count
+        self.total += 1
+    def clear(self):
+        self.total = 0
+    def last(self):
+        """The newest (timestamp, count) sample, or None
+        """
+        if not self.total:
+            return None
+        i = (self.total - 1) % self.capacity
+        return self.times[i], self.counts[i]
+    def segments(self, since: int = 0) -> list:
+        """Zero-copy views of every sample with a sequence number >= <since>
+
+        Returns at most two (times, counts) memoryview pairs in time order
+        """
+        total = self.total
+        since = max(since, total - self.capacity, 0)
+        if since >= total:
+            return []
+        start = since % self.capacity
+        end = start + (total - since)
+        times, counts = memoryview(self.times), memoryview(self.counts)
+        if end <= self.capacity:
+            return [(times[start:end], counts[start:end])]
+        end -= self.capacity
+        return [(times[start:], counts[start:]), (times[:end], counts[:end])]
+    def latest(self, n: int) -> list:
+        """Zero-copy views of the newest <n> samples
+        """
+        return self.segments(self.total - n)
+class HeartbeatStream:
+    """Streams heartbeat samples from a GMCDevice into a SampleRing
+
+    Every sample is given its event time on the time.monotonic() scale by <clock>
+    (see GMC_timing) and passed to each callable in <callbacks> as
+    callback(timestamp, count); clock.flags holds the sample's GAP/BURST flags.
+    A port with its own monotonic() and wall_offset, such as a replayed capture,
+    supplies the time instead of the host clock.
+    """
+    def __init__(self, device, ring: SampleRing = None, clock: SampleClock = None):
+        self.device = device
+        port = getattr(device, 'port', None)
+        self.now = getattr(port, 'monotonic', time.monotonic)
+        self.wall_offset = getattr(port, 'wall_offset', None)
+        self.ring = ring if ring is not None else SampleRing()
+        self.clock = clock if clock is not None else SampleClock()
+        self.callbacks = []
+        self.service = None # called after every sample, may pause the heartbeat, see GMC_scheduler
+        self.stop_flag = False
+        self.thread = None
+    def run(self, samples: int = None) -> int:
+        """Streams until stop() is called or <samples> device seconds have elapsed
+
+        Returns the number of samples read, lost samples are counted in clock.missed
+        """
+        self.stop_flag = False
+        self.clock = clock = SampleClock(self.clock.interval, self.clock.period, # keeps the learnt drift
+                                         wall_offset=self.wall_offset)
+        device, ring, callbacks = self.device, self.ring, self.callbacks
+        metrics = getattr(device, 'metrics', None)
+        device.start_heartbeat()
+        n = 0
+        try:
+            while not self.stop_flag and (samples is None or clock.ticks < samples):
+                count = device.read_heartbeat(POLL_TIME)
+                if count is None:
+                    continue # nothing yet, check the stop flag again
+                arrival = self.now()
+                if metrics is not None:
+                    metrics.heartbeat(arrival)
+                timestamp = clock.stamp(arrival, device.heartbeat_backlog())[0]
+                ring.append(timestamp, count)
+                n += 1
+                for callback in callbacks:
+                    callback(timestamp, count)
+                if self.service is not None and self.service():
+                    clock.resume()
+                    if metrics is not None:
+                        metrics.heartbeat_stopped()
+        finally:
+            if metrics is not None:
+                metrics.heartbeat_stopped()
+            try:
+                device.stop_heartbeat()
+            except OSError:
+                pass # port is gone, the original error is more useful
+        return n
+    def start(self, samples: int = None):
+        """Runs the stream on a background thread
+        """
+        self.thread = threading.Thread(target=self.run, args=(samples,), daemon=True)
+        self.thread.start()
+        return self.thread
+    def stop(self):
+        self.stop_flag = True
+    def join(self, timeout: float = None):
+        if self.thread:
+            self.thread.join(timeout)
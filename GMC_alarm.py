@@ -0,0 +1,115 @@
+"""Streaming detection of sudden count rate changes
+
+RateAlarm watches a count stream against a background rate it learns as it
+goes. Every sample updates a small bank of Poisson CUSUM statistics in constant
+time and memory, one per <ratio> of the background rate:
+    S = max(0, S + count*ln(ratio) - (ratio - 1)*background)
+the log-likelihood ratio of "the rate is now <ratio> times the background"
+against "nothing changed". A large ratio catches a source brought near the tube
+within a heartbeat or two, a small one a weak rise that a run average hides, and
+a ratio below 1 a drop such as a failing tube. An alarm is raised when a
+statistic crosses <threshold> and cleared when the one that raised it is back
+at zero. The background is not learnt while an alarm is raised, so a source left
+in place is never taken for background.
+
+Events go to every callable in <callbacks>. scan() runs the same code over a
+recorded series, such as a sample store query, at batch speed:
+    alarm = RateAlarm()
+    events = alarm.scan(store.query(start, end))
+"""
+import math
+from collections import namedtuple
+
+RATIOS = (16.0, 4.0, 1.5, 0.25) # rates watched for, times the background
+THRESHOLD = 14.0 # log-likelihood ratio that raises an alarm
+CAP = 2.0 # statistics stop at CAP*threshold while an alarm is raised, so it clears soon after the change ends
+BACKGROUND_SECONDS = 600 # time constant of the learnt background rate
+WARMUP_SECONDS = 60 # background learnt before the first alarm
+MIN_BACKGROUND = 1/60 # counts per second, keeps a silent tube's background above zero
+
+# <kind> is 'rise', 'drop' or 'clear'; <rate> is the counts per second since the change began,
+# or over the whole alarm when it clears, <background> the counts per second before it and
+# <ratio> that of the statistic that crossed the threshold
+AlarmEvent = namedtuple('AlarmEvent', 'timestamp kind rate background ratio')
+
+class RateAlarm:
+    """Raises and clears alarms on a stream of (timestamp, count) samples of <interval> seconds each
+    """
+    def __init__(self, ratios: tuple = RATIOS, threshold: float = THRESHOLD, interval: float = 1.0,
+                 background_seconds: float = BACKGROUND_SECONDS, warmup_seconds: float = WARMUP_SECONDS):
+        self.ratios = ratios
+        self.threshold = threshold
+        self.interval = interval
+        self.logs = [math.log(ratio) for ratio in ratios]
+        self.alpha = min(1.0, interval/background_seconds) # weight of a sample in the background
+        self.warmup = max(1, round(warmup_seconds/interval))
+        self.callbacks = []
+        self.reset()
+    def reset(self):
+        """Forgets the background and any alarm, the next samples learn it again
+        """
+        n = len(self.ratios)
+        self.statistics = [0.0]*n
+        self.sums = [0]*n # counts since each statistic was last at zero
+        self.lengths = [0]*n # samples since then
+        self.background = 0.0 # counts per second
+        self.samples = 0
+        self.alarm = None # index of the ratio that raised the alarm, None when quiet
+        self.alarm_counts = 0 # counts since the alarm was raised
+        self.alarm_samples = 0
+    def update(self, timestamp: float, count: int) -> AlarmEvent:
+        """Adds a sample and returns the AlarmEvent it caused, if any
+        """
+        self.samples += 1
+        if self.samples <= self.warmup:
+            self.background += (count/self.interval - self.background)/self.samples # mean of the warmup
+            return None
+        expected = max(self.background, MIN_BACKGROUND)*self.interval
+        statistics, sums, lengths = self.statistics, self.sums, self.lengths
+        cap = self.threshold*CAP if self.alarm is not None else math.inf
+        crossed = None
+        for i, (ratio, log) in enumerate(zip(self.ratios, self.logs)):
+            s = statistics[i] + count*log - (ratio - 1)*expected
+            if s <= 0:
+                statistics[i] = 0.0
+                sums[i] = lengths[i] = 0
+                continue
+            statistics[i] = min(s, cap)
+            sums[i] += count
+            lengths[i] += 1
+            if crossed is None and s > self.threshold:
+                crossed = i
+        event = None
+        if self.alarm is None:
+            if crossed is not None:
+                self.alarm = crossed
+                self.alarm_counts = sums[crossed]
+                self.alarm_samples = lengths[crossed]
+                event = AlarmEvent(timestamp, 'rise' if self.ratios[crossed] > 1 else 'drop',
+                                   sums[crossed]/(lengths[crossed]*self.interval), self.background, self.ratios[crossed])
+            else:
+                self.background += (count/self.interval - self.background)*self.alpha
+        else:
+            self.alarm_counts += count
+            self.alarm_samples += 1
+            if statistics[self.alarm] == 0.0:
+                event = AlarmEvent(timestamp, 'clear', self.alarm_counts/(self.alarm_samples*self.interval),
+                                   self.background, self.ratios[self.alarm])
+                self.alarm = None
+                for i in range(len(statistics)): # a slower statistic must not raise the same change again
+                    statistics[i] = 0.0
+                    sums[i] = lengths[i] = 0
+        if event is not None:
+            for callback in self.callbacks:
+                callback(event)
+        return event
+    def scan(self, samples) -> list:
+        """Runs update() over (timestamp, count, ...) tuples and returns the events
+        """
+        events = []
+        update = self.update
+        for sample in samples:
+            event = update(sample[0], sample[1])
+            if event is not None:
+                events.append(event)
+        return events
@@ -0,0 +1,152 @@
+"""Benchmarks for the device I/O paths, run against GMC_emulator (POSIX only)
+
+The emulator runs in a separate process with simulated link latency so the CPU
+figures only cover this side of the link. Measured:
+    command latency p50/p99 for each query command
+    device detection (open + GETVER) as done by open_ports
+    config export (cold GETCFG and cached) and config rewrite (tube voltage write)
+    heartbeat acquisition: samples/sec sustained and Python CPU time per sample
+
+Results are written as JSON and can be compared with an earlier run:
+    python GMC_bench.py --output new.json --compare old.json
+"""
+import argparse, json, os, platform, statistics, subprocess, sys, time
+from GMC_acquisition import HeartbeatStream, SampleRing
+from GMC_config import ConfigCache, set_tube_voltage
+from GMC_device import GMCDevice
+
+QUERY_COMMANDS = ('GETVER', 'GETSERIAL', 'GETCPM', 'GETVOLT', 'GETDATETIME', 'GETTEMP', 'GETGYRO', 'GETCFG')
+WIRE_BYTE_TIME = 10/115200
+
+def percentile(values: list, p: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, round(p/100*(len(values) - 1)))]
+def summary(seconds: list) -> dict:
+    """p50/p99/mean of a list of durations, in milliseconds
+    """
+    return {'p50_ms': percentile(seconds, 50)*1000, 'p99_ms': percentile(seconds, 99)*1000,
+            'mean_ms': statistics.fmean(seconds)*1000, 'n': len(seconds)}
+class EmulatorProcess:
+    """GMC_emulator.py running in a child process
+    """
+    def __init__(self, *args):
+        here = os.path.dirname(os.path.abspath(__file__))
+        self.process = subprocess.Popen([sys.executable, os.path.join(here, 'GMC_emulator.py'), *args],
+                                        stdout=subprocess.PIPE, text=True)
+        self.port_name = self.process.stdout.readline().split(' on ')[-1].strip()
+    def __enter__(self):
+        return self
+    def __exit__(self, *exc):
+        self.process.terminate()
+        self.process.wait()
+def emulator_args(args, heartbeat_interval: float = 1.0) -> list:
+    return ['--byte-latency', str(args.byte_latency), '--ack-delay', str(args.ack_delay),
+            '--link-latency', str(args.link_latency),
+            '--heartbeat-interval', str(heartbeat_interval), '--seed', '1']
+def timed(fn, *fn_args):
+    start = time.perf_counter()
+    fn(*fn_args)
+    return time.perf_counter() - start
+def bench_commands(device: GMCDevice, repeat: int) -> dict:
+    calls = {'GETVER': device.get_version, 'GETSERIAL': device.get_serial, 'GETCPM': device.get_cpm,
+             'GETVOLT': device.get_battery_voltage, 'GETDATETIME': device.get_datetime,
+             'GETTEMP': device.get_temperature, 'GETGYRO': device.get_gyro, 'GETCFG': device.get_config}
+    return {name: summary([timed(calls[name]) for i in range(repeat)]) for name in QUERY_COMMANDS}
+def bench_detection(port_name: str, repeat: int) -> dict:
+    def detect():
+        device = GMCDevice.open(port_name)
+        device.get_version()
+        device.port.close()
+    return summary([timed(detect) for i in range(repeat)])
+def bench_config(device: GMCDevice, repeat: int) -> dict:
+    results = {}
+    cache = ConfigCache()
+    cold = []
+    for i in range(repeat):
+        cache.invalidate(device)
+        cold.append(timed(cache.get, device))
+    results['export_cold'] = summary(cold)
+    results['export_cached'] = summary([timed(cache.get, device) for i in range(repeat)])
+    results['rewrite'] = summary([timed(set_tube_voltage, device, 40 + i % 2*10, cache) for i in range(repeat)])
+    results['rewrite_legacy'] = summary([timed(legacy_rewrite, device) for i in range(max(1, repeat//5))])
+    return results
+def legacy_rewrite(device: GMCDevice):
+    """The original write_tube_voltage loop: one blocking round trip per config byte
+    """
+    port = device.port
+    port.timeout = 1
+    port.write(b'<GETCFG>>')
+    cfg = port.read(device.cfg_size)
+    port.write(b'<ECFG>>')
+    port.read(1)
+    for address in range(len(cfg)):
+        port.write(b'<WCFG' + address.to_bytes(2, 'big') + bytes((cfg[address],)) + b'>>')
+        port.read(1)
+    port.write(b'<CFGUPDATE>>')
+    port.read(1)
+def bench_acquisition(port_name: str, seconds: float) -> dict:
+    device = GMCDevice.open(port_name)
+    device.get_version()
+    stream = HeartbeatStream(device, SampleRing())
+    stream.start()
+    time.sleep(0.5) # warm up
+    start_n, start_wall, start_cpu = stream.ring.total, time.perf_counter(), time.process_time()
+    time.sleep(seconds)
+    n, wall, cpu = stream.ring.total - start_n, time.perf_counter() - start_wall, time.process_time() - start_cpu
+    stream.stop()
+    stream.join()
+    device.close()
+    return {'samples_per_sec': n/wall, 'cpu_us_per_sample': cpu/max(n, 1)*1e6, 'samples': n}
+def run(args) -> dict:
+    results = {'label': args.label, 'python': platform.python_version(), 'platform': platform.platform(),
+               'byte_latency': args.byte_latency, 'link_latency': args.link_latency, 'ack_delay': args.ack_delay}
+    with EmulatorProcess(*emulator_args(args)) as emulator:
+        results['detection'] = bench_detection(emulator.port_name, args.repeat)
+        device = GMCDevice.open(emulator.port_name)
+        device.get_version()
+        results['commands'] = bench_commands(device, args.repeat)
+        results['config'] = bench_config(device, args.repeat)
+        device.close()
+    with EmulatorProcess(*emulator_args(args, args.heartbeat_interval)) as emulator:
+        results['acquisition'] = bench_acquisition(emulator.port_name, args.seconds)
+    return results
+def flatten(results: dict, prefix: str = '') -> dict:
+    flat = {}
+    for key, value in results.items():
+        if isinstance(value, dict):
+            flat.update(flatten(value, prefix + key + '.'))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            flat[prefix + key] = value
+    return flat
+def compare(old: dict, new: dict):
+    """Prints every shared metric with its ratio new/old
+    """
+    old, new = flatten(old), flatten(new)
+    for key in sorted(set(old) & set(new)):
+        ratio = new[key]/old[key] if old[key] else float('nan')
+        print(f"{key:<40} {old[key]:>12.3f} {new[key]:>12.3f} {ratio:>8.2f}x")
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark GMC device I/O against the emulator")
+    parser.add_argument('--output', help="JSON result file (default: stdout)")
+    parser.add_argument('--compare', help="earlier JSON result to compare against")
+    parser.add_argument('--label', default='', help="name of this run, e.g. a version")
+    parser.add_argument('--repeat', type=int, default=50)
+    parser.add_argument('--seconds', type=float, default=5.0, help="acquisition run time")
+    parser.add_argument('--byte-latency', type=float, default=WIRE_BYTE_TIME)
+    parser.add_argument('--link-latency', type=float, default=0.002, help="USB-serial turnaround")
+    parser.add_argument('--ack-delay', type=float, default=0.0002, help="device time per 0xAA ack")
+    parser.add_argument('--heartbeat-interval', type=float, default=0.001,
+                        help="emulator heartbeat period for the throughput run")
+    args = parser.parse_args()
+    results = run(args)
+    text = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text)
+    else:
+        print(text)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), results)
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,195 @@
+"""Raw serial capture and replay
+
+CaptureSerial wraps a serial port and records every byte written and read, with
+its time.monotonic() timestamp, into a capture file:
+    8 byte magic, 4 byte header length, JSON header (port, start times)
+    records of <time: f64><direction: u8><length: u32> followed by the bytes
+
+ReplaySerial plays a capture back in place of a serial port, at real time or
+faster. Its clock only runs ahead to the next recorded write, and jumps there
+when the code under replay makes that write, so responses never show up before
+the command that asked for them, at any speed. Recorded writes the code does
+not make are skipped, along with their responses, when it makes a later one or
+after STALL_TIME, and counted as mismatches. Code that timestamps samples
+should use the transport's monotonic() (HeartbeatStream does), so a replay at
+1000x produces the same timestamps as the original run.
+"""
+import json, os, struct, threading, time
+
+CAPTURE_MAGIC = b'GMCCAP1\n'
+RECORD = struct.Struct('<dBI') # time, direction, length
+OUT, IN = 0, 1
+FLUSH_INTERVAL = 1.0 # seconds between flushes of the capture file
+STALL_TIME = 2.0 # host seconds reads wait for a recorded write before it is skipped
+LOOKAHEAD = 8 # recorded writes searched for one matching a write
+
+class CaptureSerial:
+    """Serial port wrapper that records all traffic to <path>
+
+    Everything but write/read/close is passed to the wrapped port.
+    """
+    def __init__(self, port, path: str):
+        self.__dict__['_port'] = port # before __getattr__ can be consulted
+        self.path = path
+        self.file = open(path, 'wb')
+        header = json.dumps({'port': getattr(port, 'port', None), 'monotonic': time.monotonic(),
+                             'wall': time.time()}).encode()
+        self.file.write(CAPTURE_MAGIC + struct.pack('<I', len(header)) + header)
+        self._lock = threading.Lock()
+        self._flushed = time.monotonic()
+    def __getattr__(self, name):
+        return getattr(self._port, name)
+    def __setattr__(self, name, value):
+        if name == 'timeout':
+            self._port.timeout = value
+        else:
+            self.__dict__[name] = value
+    def _record(self, direction: int, data: bytes):
+        now = time.monotonic()
+        with self._lock:
+            self.file.write(RECORD.pack(now, direction, len(data)) + data)
+            if now - self._flushed >= FLUSH_INTERVAL:
+                self.file.flush()
+                self._flushed = now
+    def write(self, data: bytes):
+        self._record(OUT, data)
+        return self._port.write(data)
+    def read(self, size: int = 1) -> bytes:
+        data = self._port.read(size)
+        if data:
+            self._record(IN, data)
+        return data
+    def close(self):
+        self._port.close()
+        with self._lock:
+            if not self.file.closed:
+                self.file.close()
+def read_capture(path: str):
+    """Returns (header, records) of a capture, records as a list of (time, direction, data)
+    """
+    with open(path, 'rb') as f:
+        data = f.read()
+    if data[:len(CAPTURE_MAGIC)] != CAPTURE_MAGIC:
+        raise ValueError(f"{path} is not a serial capture")
+    pos = len(CAPTURE_MAGIC)
+    header_size = struct.unpack_from('<I', data, pos)[0]
+    header = json.loads(data[pos + 4:pos + 4 + header_size])
+    pos += 4 + header_size
+    records = []
+    while pos + RECORD.size <= len(data):
+        timestamp, direction, length = RECORD.unpack_from(data, pos)
+        pos += RECORD.size
+        if pos + length > len(data):
+            break # cut off by a crash
+        records.append((timestamp, direction, data[pos:pos + length]))
+        pos += length
+    return header, records
+class ReplayEnd(OSError):
+    """Raised by a read once the capture has nothing left, like a port that was unplugged
+    """
+class ReplaySerial:
+    """Serial port stand-in that replays a capture at <speed> times real time
+    """
+    def __init__(self, path: str, speed: float = 1.0):
+        header, records = read_capture(path)
+        self.port = header.get('port') or path
+        self.speed = speed
+        self.wall_offset = header['wall'] - header['monotonic'] # for SampleClock, maps capture time to epoch
+        self.timeout = 1
+        self.received = [(t, data) for t, direction, data in records if direction == IN]
+        self.writes = [(t, data) for t, direction, data in records if direction == OUT]
+        self.next_write = 0
+        self.next_read = 0 # index into received
+        self.offset = 0 # bytes of received[next_read] already read
+        self.mismatches = 0 # writes that differ from the capture
+        start = records[0][0] if records else header['monotonic']
+        self._anchor = (start, time.monotonic()) # capture time and the host time it was reached
+        self._stalled = None # host time reads started waiting for data behind the next write
+    def monotonic(self) -> float:
+        """Replay position on the capture's time.monotonic() scale
+        """
+        capture_time, host_time = self._anchor
+        now = capture_time + (time.monotonic() - host_time)*self.speed
+        if self.next_write < len(self.writes):
+            now = min(now, self.writes[self.next_write][0]) # waits for the code to send the next command
+        return now
+    def _jump(self, capture_time: float):
+        self._anchor = (capture_time, time.monotonic())
+        self._stalled = None
+    def write(self, data: bytes):
+        upcoming = [recorded for t, recorded in self.writes[self.next_write:self.next_write + LOOKAHEAD]]
+        if data in upcoming:
+            for i in range(upcoming.index(data)):
+                self._skip_write() # commands of the captured session this one does not send
+        if self.next_write < len(self.writes):
+            recorded_time, recorded = self.writes[self.next_write]
+            if data != recorded:
+                self.mismatches += 1
+            self.next_write += 1
+            self._jump(max(self.monotonic(), recorded_time))
+        return len(data)
+    def _skip_write(self):
+        """Skips the next recorded write and the data received in answer to it
+        """
+        self.mismatches += 1
+        self._jump(self.writes[self.next_write][0])
+        self.next_write += 1
+        until = self.writes[self.next_write][0] if self.next_write < len(self.writes) else float('inf')
+        while not self.finished and self.received[self.next_read][0] < until:
+            self.next_read += 1
+            self.offset = 0
+    @property
+    def finished(self) -> bool:
+        return self.next_read >= len(self.received)
+    @property
+    def in_waiting(self) -> int:
+        now = self.monotonic()
+        received = self.received
+        waiting = -self.offset
+        i = self.next_read
+        while i < len(received) and received[i][0] <= now:
+            waiting += len(received[i][1])
+            i += 1
+        return waiting
+    def read(self, size: int = 1) -> bytes:
+        """Returns up to <size> bytes, waiting up to timeout seconds of host time for them
+        """
+        deadline = time.monotonic() + (self.timeout if self.timeout is not None else 1e9)
+        data = bytearray()
+        while len(data) < size:
+            if self.finished:
+                if data:
+                    break
+                raise ReplayEnd(f"end of capture {self.port}")
+            t, chunk = self.received[self.next_read]
+            now = self.monotonic()
+            if t > now:
+                wait = (t - now)/self.speed
+                if self.next_write < len(self.writes) and self.writes[self.next_write][0] < t:
+                    if self._stalled is None:
+                        self._stalled = time.monotonic()
+                    elif time.monotonic() - self._stalled >= STALL_TIME:
+                        self._skip_write() # a command of the captured session this one does not send
+                        continue
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                time.sleep(min(wait, remaining, 0.05)) # short naps, a write may move the clock
+                continue
+            if now > t and self.offset == 0:
+                self._jump(t) # overslept, at high speeds by many capture seconds
+            take = chunk[self.offset:self.offset + size - len(data)]
+            data += take
+            self.offset += len(take)
+            if self.offset >= len(chunk):
+                self.next_read += 1
+                self.offset = 0
+        return bytes(data)
+    def close(self):
+        pass
+def capture_path(directory: str, name: str) -> str:
+    """Capture file for port <name> in <directory>, named by the current time
+    """
+    os.makedirs(directory, exist_ok=True)
+    safe_name = ''.join(c if c.isalnum() else '_' for c in name)
+    return os.path.join(directory, time.strftime('%Y%m%d-%H%M%S') + f'-{safe_name}.gmccap')
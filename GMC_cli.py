@@ -0,0 +1,583 @@
+"""Headless command line front end for GMC Geiger counters
+
+Runs on machines without a display and never imports PyQt5. Every command
+imports only the core modules it needs, so startup stays in the milliseconds:
+    python GMC_cli.py ports
+    python GMC_cli.py count COM3 --seconds 60
+    python GMC_cli.py log /dev/ttyUSB0 --store samples
+    python GMC_cli.py config dump COM3 --output config.json
+    python GMC_cli.py config set COM3 tube1_voltage_percent=60
+    python GMC_cli.py history COM3 history.bin --csv history.csv
+    python GMC_cli.py sweep COM3 --start 30 --stop 80 --step 2 --dwell 60
+    python GMC_cli.py log COM3 --capture field.gmccap
+    python GMC_cli.py replay field.gmccap --speed 1000
+    python GMC_cli.py export samples month.parquet --start 2024-05-01 --end 2024-06-01
+    python GMC_cli.py proxy COM3 --store samples
+    python GMC_cli.py tail --command GETCPM
+    python GMC_cli.py longrun COM3 week.json --days 7
+    python GMC_cli.py status week.json
+    python GMC_cli.py telemetry COM3 COM4 --interval 60
+    python GMC_cli.py alarms samples --start 2024-05-01
+"""
+import argparse, sys
+
+def open_device(port_name: str, metrics_port: int = None, capture: str = None):
+    """Opens <port_name> and identifies the counter on it
+
+    With <metrics_port> the device's I/O metrics are served on http://127.0.0.1:<metrics_port>/metrics,
+    with <capture> all serial traffic is recorded to that file
+    """
+    from GMC_device import GMCDevice
+    device = GMCDevice.open(port_name, capture=capture)
+    if metrics_port is not None:
+        from GMC_metrics import registry
+        registry.attach(device)
+        registry.serve(metrics_port)
+    device.get_version()
+    return device
+def device_id(device) -> str:
+    """Serial number of <device>, or its port name on firmware without GETSERIAL
+    """
+    from GMC_device import GMCError
+    try:
+        return device.get_serial()
+    except GMCError:
+        return device.name
+def stop_on_signals(stream, interrupt: bool = False):
+    """Stops <stream> on SIGTERM as well as Ctrl-C, for running under a service manager
+
+    With <interrupt> Ctrl-C calls stream.stop() too instead of raising KeyboardInterrupt
+    """
+    import signal
+    signal.signal(signal.SIGTERM, lambda signum, frame: stream.stop())
+    if interrupt:
+        signal.signal(signal.SIGINT, lambda signum, frame: stream.stop())
+def cmd_ports(args):
+    if args.probe:
+        from GMC_discovery import Discovery
+        for record in Discovery().discover():
+            print(f"{record.port}\t{record.version}\t{record.serial}\t{record.key}")
+        return
+    from GMC_device import find_ports
+    for port_name in find_ports():
+        print(port_name)
+def cmd_count(args):
+    from GMC_acquisition import HeartbeatStream
+    from GMC_stats import RollingStats, conversion_factor
+    device = open_device(args.port, capture=args.capture)
+    stats = RollingStats(factor=conversion_factor(device.model))
+    stream = HeartbeatStream(device)
+    stream.callbacks.append(lambda timestamp, count: stats.update(count))
+    stop_on_signals(stream)
+    try:
+        stream.run(args.seconds)
+    except KeyboardInterrupt:
+        pass # report what was counted so far
+    finally:
+        device.close()
+    run = stats.run()
+    if args.json:
+        import json
+        print(json.dumps(dict(run, model=device.model, missed=stream.clock.missed)))
+    else:
+        if stream.clock.missed:
+            print(f"{stream.clock.missed} samples were lost, the rate covers the {run['seconds']} s received",
+                  file=sys.stderr)
+        print(f"{run['counts']} counts in {run['seconds']} s: {run['cpm']:.2f} CPM "
+              f"({run['cpm_low']:.2f} - {run['cpm_high']:.2f}), {run['usvh']:.3f} uSv/h")
+def cmd_log(args):
+    from GMC_acquisition import HeartbeatStream
+    from GMC_store import TimeSeriesStore
+    device = open_device(args.port, args.metrics, args.capture)
+    store = TimeSeriesStore(args.store).device(device_id(device))
+    stream = HeartbeatStream(device)
+    def record(timestamp, count):
+        clock = stream.clock
+        wall = clock.wall(timestamp)
+        store.append(wall, count, clock.flags)
+        if not args.quiet:
+            print(f"{wall:.3f} {count} {clock.flags}", flush=True)
+    stream.callbacks.append(record)
+    if args.alarm:
+        from GMC_alarm import RateAlarm
+        alarm = RateAlarm()
+        alarm.callbacks.append(lambda event: print(format_alarm(event), file=sys.stderr, flush=True))
+        stream.callbacks.append(lambda timestamp, count: alarm.update(stream.clock.wall(timestamp), count))
+    stop_on_signals(stream)
+    try:
+        stream.run(args.seconds)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        device.close()
+        store.close()
+def format_alarm(event, device: str = '') -> str:
+    import time
+    when = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(event.timestamp))
+    prefix = f"{device}: " if device else ''
+    if event.kind == 'clear':
+        return f"{prefix}{when} clear, {event.rate*60:.1f} CPM during the alarm"
+    return (f"{prefix}{when} {event.kind} to {event.rate*60:.1f} CPM from a background of "
+            f"{event.background*60:.1f} CPM ({event.ratio:g}x statistic)")
+def cmd_alarms(args):
+    """Runs the rate alarm over the samples recorded in a sample store
+    """
+    from GMC_alarm import THRESHOLD, RateAlarm
+    from GMC_store import TimeSeriesStore
+    store = TimeSeriesStore(args.store, readonly=True)
+    start = parse_time(args.start) if args.start else None
+    end = parse_time(args.end) if args.end else None
+    found = 0
+    try:
+        for device in args.device or store.devices():
+            for event in RateAlarm(threshold=args.threshold or THRESHOLD).scan(store.device(device).query(start, end)):
+                print(format_alarm(event, device))
+                found += event.kind != 'clear'
+    finally:
+        store.close()
+    return 1 if found else 0
+def cmd_proxy(args):
+    """Shares the counter on <port> with other programs through a GMC_proxy.SerialProxy
+    """
+    from GMC_proxy import SerialProxy, parse_address
+    device = open_device(args.port, args.metrics)
+    serial_number = device_id(device)
+    proxy = SerialProxy(device, parse_address(args.address), allow_writes=args.allow_writes,
+                        allow_remote=args.allow_remote)
+    store = None
+    if args.store:
+        from GMC_store import TimeSeriesStore
+        store = TimeSeriesStore(args.store).device(serial_number)
+        clock = lambda: proxy.stream.clock
+        proxy.stream.callbacks.append(lambda timestamp, count: store.append(clock().wall(timestamp), count, clock().flags))
+    stop_on_signals(proxy.stream)
+    try:
+        proxy.start(serial_number)
+        print(f"Sharing {device.version} on {proxy.address}", file=sys.stderr)
+        proxy.wait()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        proxy.stop()
+        device.close()
+        if store is not None:
+            store.close()
+def run_summary(state: dict) -> str:
+    """Two lines on a GMC_longrun checkpoint
+    """
+    import time
+    run = state['run']
+    if state['complete']:
+        progress = "complete"
+    elif state['duration'] is None:
+        progress = "until stopped" + (", stopped" if state['stopped'] else "")
+    else:
+        progress = f"{state['seconds']*100/state['duration']:.1f}% of {state['duration']} s"
+        progress += ", stopped" if state['stopped'] else ""
+    updated = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(state['updated'])) if state['updated'] else "never"
+    return (f"{state['serial']}: {state['seconds']} s counted ({progress}), {state['missed']} lost, "
+            f"{state['offline']:.0f} s offline, {state['resumes']} resumes, last sample {updated}\n"
+            f"{run['counts']} counts: {run['cpm']:.2f} CPM ({run['cpm_low']:.2f} - {run['cpm_high']:.2f}), "
+            f"{run['usvh']:.3f} uSv/h")
+def cmd_longrun(args):
+    """Counts for hours or days, checkpointing to <checkpoint> and resuming from it if it exists
+
+    A replugged counter is found again by its serial number and the run goes on.
+    """
+    import os
+    from GMC_discovery import Discovery
+    from GMC_longrun import LongRun
+    device = open_device(args.port, args.metrics)
+    serial_number = device_id(device)
+    if os.path.exists(args.checkpoint):
+        try:
+            run = LongRun.resume(args.checkpoint, device, serial_number)
+        except ValueError as e:
+            device.close()
+            print(f"longrun: {e}", file=sys.stderr)
+            return 2
+    else:
+        duration = args.days*86400 + args.hours*3600 + args.minutes*60
+        run = LongRun(device, duration or None, args.checkpoint, serial_number)
+    store = None
+    if args.store:
+        from GMC_store import TimeSeriesStore
+        store = TimeSeriesStore(args.store).device(serial_number)
+        run.callbacks.append(lambda timestamp, count: store.append(run.stream.clock.wall(timestamp), count,
+                                                                   run.stream.clock.flags))
+    discovery = Discovery()
+    def reconnect():
+        try:
+            run.device.close()
+        except OSError:
+            pass
+        record = discovery.find(serial_number)
+        return open_device(record.port, args.metrics) if record is not None else None
+    stop_on_signals(run)
+    try:
+        state = run.run(reconnect)
+    except KeyboardInterrupt:
+        run.stop()
+        run.save()
+        state = run.snapshot()
+    finally:
+        run.device.close()
+        if store is not None:
+            store.close()
+    print(run_summary(state))
+def cmd_status(args):
+    """Prints the totals and partial results of a long run from its checkpoint
+    """
+    from GMC_longrun import read_checkpoint
+    state = read_checkpoint(args.checkpoint)
+    if args.json:
+        import json
+        print(json.dumps(state, indent=1))
+    else:
+        print(run_summary(state))
+def cmd_telemetry(args):
+    """Polls CPM, battery, temperature, gyro and clock of one or more counters
+    """
+    from GMC_telemetry import TelemetryPoller
+    poller = TelemetryPoller(args.interval)
+    devices = []
+    try:
+        for port_name in args.ports:
+            device = open_device(port_name)
+            devices.append(device)
+            name = device_id(device)
+            poller.add(device, name if name not in poller.devices else device.name)
+        if args.json:
+            import json
+            poller.callbacks.append(lambda t: print(json.dumps(dict(t._asdict(), clock=t.clock.isoformat())), flush=True))
+        else:
+            print("Device\tCPM\tBattery(V)\tTemp(C)\tGyro\tClock offset(s)\tLatency(ms)")
+            poller.callbacks.append(lambda t: print(f"{t.device}\t{t.cpm}\t{t.battery:.1f}\t{t.temperature:.1f}\t"
+                                                    f"{','.join(map(str, t.gyro))}\t{t.clock_offset:+.0f}\t"
+                                                    f"{t.latency*1000:.1f}", flush=True))
+        poller.error_callbacks.append(lambda name, e: print(f"{name}: {e}", file=sys.stderr, flush=True))
+        stop_on_signals(poller)
+        poller.run(args.count)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for device in devices:
+            device.close()
+    return 1 if poller.errors else 0
+def cmd_tail(args):
+    """Prints the samples of a running proxy
+    """
+    from GMC_proxy import ProxyConnection, parse_address
+    connection = ProxyConnection(parse_address(args.address))
+    hello = connection.hello
+    print(f"# {hello.get('version')} {hello.get('serial')} on {hello.get('port')}", file=sys.stderr)
+    try:
+        if args.request:
+            print(connection.command(args.request.upper()).hex().upper())
+            if args.seconds is None:
+                return
+        for n, (timestamp, count, flags) in enumerate(connection, 1):
+            print(f"{timestamp:.3f} {count} {flags}", flush=True)
+            if args.seconds is not None and n >= args.seconds:
+                break
+    except KeyboardInterrupt:
+        pass
+    finally:
+        connection.close()
+def parse_assignment(config, assignment: str) -> tuple:
+    """Splits 'name=value' and converts value to the type of the config field
+
+    Exits with a message for a value the field cannot hold exactly: a fraction for
+    a whole number field, a number out of its range or text too long for it.
+    """
+    import struct
+    name, sep, value = assignment.partition('=')
+    if not sep or not (name in config.field_names() or name == 'tube1_voltage_percent'):
+        raise SystemExit(f"unknown config field in {assignment!r}, choose from: "
+                         + ', '.join(config.field_names() + ['tube1_voltage_percent']))
+    current = getattr(config, name)
+    if isinstance(current, str):
+        size = getattr(type(config), name).struct.size
+        if not value.isascii() or len(value) > size:
+            raise SystemExit(f"{assignment!r}: {name} takes up to {size:d} ASCII characters")
+        return name, value
+    try:
+        number = float(value)
+    except ValueError:
+        raise SystemExit(f"{assignment!r}: {name} takes a number")
+    if name == 'tube1_voltage_percent':
+        if not 0 <= number <= 100:
+            raise SystemExit(f"{assignment!r}: {name} takes 0-100")
+        return name, number
+    field = getattr(type(config), name)
+    if isinstance(current, int):
+        high = 2**(8*field.struct.size) - 1 # the int fields are unsigned
+        if not number.is_integer() or not 0 <= number <= high:
+            raise SystemExit(f"{assignment!r}: {name} takes a whole number 0-{high:d}")
+        return name, int(number)
+    try:
+        field.struct.pack(number)
+    except (struct.error, OverflowError):
+        raise SystemExit(f"{assignment!r}: {number} does not fit {name}")
+    return name, number
+def cmd_config_dump(args):
+    from GMC_config import DeviceConfig
+    device = open_device(args.port)
+    try:
+        config = DeviceConfig.read(device)
+    finally:
+        device.close()
+    if args.raw:
+        if args.output:
+            with open(args.output, 'wb') as f:
+                f.write(bytes(config))
+        else:
+            sys.stdout.buffer.write(bytes(config))
+        return
+    import json
+    text = json.dumps(dict(config.fields(), tube1_voltage_percent=config.tube1_voltage_percent), indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text)
+    else:
+        print(text)
+def cmd_config_set(args):
+    from GMC_config import config_cache
+    device = open_device(args.port)
+    try:
+        target = config_cache.get(device).copy()
+        for assignment in args.fields:
+            name, value = parse_assignment(target, assignment)
+            setattr(target, name, value)
+        config = config_cache.write(device, target)
+    finally:
+        config_cache.invalidate(device)
+        device.close()
+    for name, value in sorted(config.fields().items()):
+        if any(a.partition('=')[0] == name for a in args.fields):
+            print(f"{name} = {value}")
+    print(f"tube1_voltage_percent = {config.tube1_voltage_percent:.1f}")
+def cmd_history(args):
+    from GMC_history import HistoryDownloader, parse_history_file
+    device = open_device(args.port)
+    downloader = HistoryDownloader(device)
+    def progress(offset, size):
+        if not args.quiet:
+            print(f"\r{offset*100//size:3d}% {offset}/{size} bytes", end='', file=sys.stderr, flush=True)
+    try:
+        complete = downloader.download(args.output, progress)
+    except KeyboardInterrupt:
+        complete = False
+    finally:
+        device.close()
+    if not args.quiet:
+        print(file=sys.stderr)
+    if not complete:
+        print("Download interrupted, run the same command again to resume", file=sys.stderr)
+        return 1
+    if args.csv:
+        import csv
+        with open(args.csv, 'w', newline='') as f:
+            wr = csv.writer(f)
+            wr.writerow(['Timestamp', 'Count', 'Mode'])
+            wr.writerows((s.timestamp.isoformat(sep=' '), s.count, s.mode) for s in parse_history_file(args.output))
+    if args.export:
+        from GMC_export import export_history
+        export_history(args.output, args.export)
+def parse_time(text: str) -> float:
+    """Seconds since the epoch from a number or an ISO 8601 date and time
+    """
+    from datetime import datetime
+    try:
+        return float(text)
+    except ValueError:
+        return datetime.fromisoformat(text).timestamp()
+def cmd_export(args):
+    """Exports a sample store directory, a binary count log or a downloaded history file
+    """
+    import os
+    from GMC_export import export_format
+    try:
+        export_format(args.output)
+    except ValueError as e:
+        print(f"export: {e}", file=sys.stderr)
+        return 2
+    if os.path.isdir(args.source):
+        from GMC_export import export_store
+        rows = export_store(args.source, args.output, args.device,
+                            parse_time(args.start) if args.start else None, parse_time(args.end) if args.end else None)
+    elif args.source.endswith('.gmclog'):
+        from GMC_export import export_count_log
+        from GMC_log import CountLog
+        log = CountLog.load_binary(args.source)
+        export_count_log(log, args.output)
+        rows = len(log)
+    else:
+        from GMC_export import export_history
+        rows = export_history(args.source, args.output)
+    print(f"{rows} rows written to {args.output}")
+def cmd_replay(args):
+    """Runs a capture of a log or count session through acquisition, statistics and the sample store
+    """
+    import time
+    from GMC_acquisition import HeartbeatStream
+    from GMC_capture import ReplayEnd, ReplaySerial
+    from GMC_device import GMCDevice
+    from GMC_stats import RollingStats, conversion_factor
+    port = ReplaySerial(args.capture, args.speed)
+    device = GMCDevice(port)
+    start = time.perf_counter()
+    device.resync()
+    device.get_version()
+    store = None
+    if args.store:
+        from GMC_store import TimeSeriesStore
+        store = TimeSeriesStore(args.store).device(device_id(device))
+    stats = RollingStats(factor=conversion_factor(device.model))
+    stream = HeartbeatStream(device)
+    def record(timestamp, count):
+        stats.update(count)
+        if store is not None:
+            store.append(stream.clock.wall(timestamp), count, stream.clock.flags)
+    stream.callbacks.append(record)
+    try:
+        stream.run()
+    except ReplayEnd:
+        pass # the whole capture was played
+    finally:
+        if store is not None:
+            store.close()
+    run = stats.run()
+    print(f"{device.version}: {stream.clock.samples} samples, {stream.clock.missed} lost, "
+          f"{port.mismatches} commands differing from the capture, replayed in {time.perf_counter() - start:.2f} s")
+    print(f"{run['counts']} counts in {run['seconds']} s: {run['cpm']:.2f} CPM "
+          f"({run['cpm_low']:.2f} - {run['cpm_high']:.2f}), {run['usvh']:.3f} uSv/h")
+def cmd_sweep(args):
+    from GMC_sweep import PlateauSweep, find_plateau, sweep_voltages
+    device = open_device(args.port)
+    sweep = PlateauSweep(device, sweep_voltages(args.start, args.stop, args.step), args.dwell, args.settle)
+    stop_on_signals(sweep, interrupt=True) # the sweep ends with the steps so far and restores the voltage
+    print("Voltage(%)\tCounts\tSeconds\tCPM\tCPM low\tCPM high")
+    def progress(step):
+        print(f"{step.voltage:.1f}\t{step.counts}\t{step.seconds}\t{step.cpm:.2f}\t{step.cpm_low:.2f}\t{step.cpm_high:.2f}",
+              flush=True)
+    try:
+        steps = sweep.run(progress)
+    finally:
+        device.close()
+    plateau = find_plateau(steps)
+    if plateau is None:
+        print("No plateau found", file=sys.stderr)
+        return 1
+    print(f"Plateau {plateau.start:.1f}% - {plateau.end:.1f}%, slope {plateau.slope:.2f}% per point, "
+          f"set-point {plateau.setpoint:.1f}%")
+def make_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(prog='GMC_cli', description="Headless GMC Geiger counter terminal")
+    commands = parser.add_subparsers(dest='command', required=True)
+    p = commands.add_parser('ports', help="list serial ports")
+    p.add_argument('--probe', action='store_true', help="probe every port at once and list the counters found")
+    p.set_defaults(func=cmd_ports)
+    p = commands.add_parser('count', help="timed count")
+    p.add_argument('port')
+    p.add_argument('--seconds', type=int, default=60)
+    p.add_argument('--json', action='store_true', help="print the result as JSON")
+    p.add_argument('--capture', help="record all serial traffic to this file")
+    p.set_defaults(func=cmd_count)
+    p = commands.add_parser('log', help="record per second counts to a sample store until stopped")
+    p.add_argument('port')
+    p.add_argument('--store', default='samples', help="sample store directory (default: samples)")
+    p.add_argument('--seconds', type=int, help="stop after this many samples")
+    p.add_argument('--quiet', action='store_true', help="do not print samples")
+    p.add_argument('--metrics', type=int, metavar='HTTP_PORT', help="serve Prometheus metrics on this port")
+    p.add_argument('--capture', help="record all serial traffic to this file")
+    p.add_argument('--alarm', action='store_true', help="report sudden count rate changes on stderr")
+    p.set_defaults(func=cmd_log)
+    p = commands.add_parser('proxy', help="share a counter's samples and commands with other programs")
+    p.add_argument('port')
+    p.add_argument('--address', help="socket path, or [HOST:]PORT for TCP (default: gmc-proxy.sock in the temp directory)")
+    p.add_argument('--store', help="also record the samples to this sample store directory")
+    p.add_argument('--metrics', type=int, metavar='HTTP_PORT', help="serve Prometheus metrics on this port")
+    p.add_argument('--allow-writes', action='store_true',
+                   help="let clients run any command, configuration writes and FACTORYRESET included")
+    p.add_argument('--allow-remote', action='store_true', help="allow a TCP address other than the loopback interface")
+    p.set_defaults(func=cmd_proxy)
+    p = commands.add_parser('longrun', help="count for hours or days with checkpoints, resuming from an existing one")
+    p.add_argument('port')
+    p.add_argument('checkpoint', help="checkpoint file, the run resumes from it if it exists")
+    p.add_argument('--days', type=int, default=0)
+    p.add_argument('--hours', type=int, default=0)
+    p.add_argument('--minutes', type=int, default=0)
+    p.add_argument('--store', help="also record the samples to this sample store directory")
+    p.add_argument('--metrics', type=int, metavar='HTTP_PORT', help="serve Prometheus metrics on this port")
+    p.set_defaults(func=cmd_longrun)
+    p = commands.add_parser('status', help="totals and partial results of a long run, also while it runs")
+    p.add_argument('checkpoint')
+    p.add_argument('--json', action='store_true', help="print the whole checkpoint as JSON")
+    p.set_defaults(func=cmd_status)
+    p = commands.add_parser('telemetry', help="poll CPM, battery, temperature, gyro and clock of one or more counters")
+    p.add_argument('ports', nargs='+')
+    p.add_argument('--interval', type=float, default=60.0, help="seconds between polls (default: 60)")
+    p.add_argument('--count', type=int, help="stop after this many polls")
+    p.add_argument('--json', action='store_true', help="one JSON object per reading")
+    p.set_defaults(func=cmd_telemetry)
+    p = commands.add_parser('tail', help="print the samples of a running proxy")
+    p.add_argument('--address', help="address the proxy serves on")
+    p.add_argument('--seconds', type=int, help="stop after this many samples")
+    p.add_argument('--command', dest='request', help="send one command, such as GETCPM, and print its response in hex")
+    p.set_defaults(func=cmd_tail)
+    p = commands.add_parser('config', help="dump or change the device configuration")
+    config_commands = p.add_subparsers(dest='config_command', required=True)
+    p = config_commands.add_parser('dump')
+    p.add_argument('port')
+    p.add_argument('--output', help="file to write (default: stdout)")
+    p.add_argument('--raw', action='store_true', help="write the raw config image instead of JSON")
+    p.set_defaults(func=cmd_config_dump)
+    p = config_commands.add_parser('set')
+    p.add_argument('port')
+    p.add_argument('fields', nargs='+', metavar='NAME=VALUE')
+    p.set_defaults(func=cmd_config_set)
+    p = commands.add_parser('history', help="download the history flash, resuming an interrupted download")
+    p.add_argument('port')
+    p.add_argument('output')
+    p.add_argument('--csv', help="also write the parsed samples as CSV")
+    p.add_argument('--export', help="also write the parsed samples to a .parquet, .arrow or .npz file")
+    p.add_argument('--quiet', action='store_true', help="no progress output")
+    p.set_defaults(func=cmd_history)
+    p = commands.add_parser('sweep', help="tube voltage plateau sweep, restores the voltage afterwards")
+    p.add_argument('port')
+    p.add_argument('--start', type=float, default=30.0, help="first voltage in percent")
+    p.add_argument('--stop', type=float, default=80.0, help="last voltage in percent")
+    p.add_argument('--step', type=float, default=2.0)
+    p.add_argument('--dwell', type=int, default=60, help="seconds counted at every step")
+    p.add_argument('--settle', type=float, default=2.0, help="seconds for the voltage to settle")
+    p.set_defaults(func=cmd_sweep)
+    p = commands.add_parser('export', help="export samples, a count log or history to Parquet, Arrow or NumPy")
+    p.add_argument('source', help="sample store directory, .gmclog count log or downloaded history file")
+    p.add_argument('output', help="file ending in .parquet, .arrow, .feather or .npz")
+    p.add_argument('--device', action='append', help="device to export from a sample store, repeatable (default: all)")
+    p.add_argument('--start', help="first time to export, ISO 8601 or seconds since the epoch")
+    p.add_argument('--end', help="time to stop before")
+    p.set_defaults(func=cmd_export)
+    p = commands.add_parser('alarms', help="find sudden count rate changes in recorded samples")
+    p.add_argument('store', help="sample store directory")
+    p.add_argument('--device', action='append', help="device to scan, repeatable (default: all)")
+    p.add_argument('--start', help="first time to scan, ISO 8601 or seconds since the epoch")
+    p.add_argument('--end', help="time to stop before")
+    p.add_argument('--threshold', type=float, help="log-likelihood ratio that raises an alarm (default: GMC_alarm.THRESHOLD)")
+    p.set_defaults(func=cmd_alarms)
+    p = commands.add_parser('replay', help="replay a capture of a log or count session")
+    p.add_argument('capture')
+    p.add_argument('--speed', type=float, default=1000.0, help="times real time (default: 1000)")
+    p.add_argument('--store', help="also record the samples to this sample store directory")
+    p.set_defaults(func=cmd_replay)
+    return parser
+def main(argv: list = None) -> int:
+    args = make_parser().parse_args(argv)
+    from GMC_device import GMCError
+    try:
+        return args.func(args) or 0
+    except (GMCError, OSError, ModuleNotFoundError) as e: # OSError includes serial.SerialException
+        print(f"{args.command}: {e}", file=sys.stderr)
+        return 2
+if __name__ == '__main__':
+    sys.exit(main())
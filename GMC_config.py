@@ -0,0 +1,256 @@
+"""Configuration read/write engine for GQ GMC Geiger counters
+
+The configuration is a flat image (512 bytes on the GMC-500+/600 series) that
+has to be erased with <ECFG>> and rewritten byte by byte with <WCFG..>>.
+DeviceConfig gives named access to the image and config_cache keeps one image
+per open device so repeated reads do not touch the serial link.
+"""
+import struct, threading, time
+from functools import partial
+from GMC_device import ACK, GMCError
+
+ERASED_BYTE = 0xFF # value of a config byte after <ECFG>>
+CFG_SIZE = 512 # config size of the GMC-500+/600 series
+TUBE1_VOLTAGE_ADDRESS = 330
+
+num_to_bytes = partial(int.to_bytes, byteorder='big')
+
+class ConfigWriteError(GMCError):
+    """Raised when a configuration image could not be written and verified
+    """
+    def __init__(self, message: str, failed: list = ()):
+        super().__init__(message)
+        self.failed = list(failed) # addresses that never verified
+def read_config(device) -> bytes:
+    """Reads the raw configuration image from a GMCDevice
+    """
+    return device.get_config()
+def wcfg_packet(address: int, value: int, size: int = CFG_SIZE) -> bytes:
+    """Builds a <WCFG[A1][A0][D0]>> packet
+
+    Images larger than 256 bytes use a two byte address, smaller ones a single byte
+    """
+    addr_len = 2 if size > 256 else 1
+    return b'<WCFG' + num_to_bytes(address, addr_len) + num_to_bytes(value, 1) + b'>>'
+class ConfigTransaction:
+    """Writes a target configuration image to a device with as few round trips as possible
+
+    Only the bytes that differ from the erased state are written, the <WCFG>> packets
+    are sent in windows of <window> packets and their 0xAA acks are collected in bulk.
+    A single read-back at the end verifies the image and only the addresses that did
+    not verify are written again.
+    """
+    def __init__(self, device, target, current: bytes = None, window: int = 32, retries: int = 3):
+        self.device = device
+        self.target = bytes(target)
+        self.current = current # image currently on the device, read when needed
+        self.window = window # number of WCFG packets in flight before collecting acks
+        self.retries = retries
+        self.bad_acks = 0 # count of acks that were not 0xAA or never arrived
+        self.written = 0 # number of WCFG packets sent
+        self.updated = None # time.monotonic() of the last CFGUPDATE, when the new settings took effect
+    def changed_addresses(self) -> list:
+        """Addresses whose value differs between the device image and the target
+        """
+        return [a for a in range(len(self.target)) if self.current[a] != self.target[a]]
+    def commit(self) -> bytes:
+        """Runs the transaction and returns the verified image read back from the device
+        """
+        size = len(self.target)
+        device = self.device
+        with device.lock: # nothing else may talk to the device mid transaction
+            if self.current is None:
+                self.current = read_config(device)
+            if not self.changed_addresses():
+                return bytes(self.current) # nothing to do
+            device.erase_config()
+            pending = [a for a in range(size) if self.target[a] != ERASED_BYTE]
+            for attempt in range(self.retries + 1):
+                self._write(pending)
+                device.update_config()
+                self.updated = time.monotonic()
+                readback = read_config(device)
+                pending = [a for a in range(size) if readback[a] != self.target[a]]
+                if not pending:
+                    self.current = readback
+                    return readback
+        raise ConfigWriteError(f"{len(pending):d} config addresses failed to verify", pending)
+    def _write(self, addresses: list):
+        """Sends WCFG packets for <addresses> in pipelined windows
+        """
+        size = len(self.target)
+        device = self.device
+        for start in range(0, len(addresses), self.window):
+            chunk = addresses[start:start + self.window]
+            packets = b''.join(wcfg_packet(a, self.target[a], size) for a in chunk)
+            device.write(packets)
+            acks = device.read(len(chunk), device.deadline('WCFG', len(packets), len(chunk))) # acks of the whole window at once
+            self.written += len(chunk)
+            bad_acks = len(chunk) - acks.count(ACK)
+            self.bad_acks += bad_acks # failures are caught by the read-back
+            if device.metrics is not None:
+                device.metrics.bad_acks += bad_acks
+def write_config(device, target, current: bytes = None, **kwargs) -> bytes:
+    """Writes <target> to the device, see ConfigTransaction
+    """
+    return ConfigTransaction(device, target, current, **kwargs).commit()
+def tube_voltage_percent(cfg) -> float:
+    """Tube 1 voltage percentage of a config image
+    """
+    return cfg[TUBE1_VOLTAGE_ADDRESS]*(2/3) # convert from out of 150 to out of 100
+class ConfigField:
+    """Typed field of a config image, packed with the struct format <fmt> at <offset>
+    """
+    def __init__(self, offset: int, fmt: str = 'B'):
+        self.offset = offset
+        self.struct = struct.Struct(fmt)
+    def __set_name__(self, owner, name):
+        self.name = name
+    def __get__(self, config, owner=None):
+        if config is None:
+            return self
+        return self.struct.unpack_from(config.view, self.offset)[0]
+    def __set__(self, config, value):
+        self.struct.pack_into(config.view, self.offset, value)
+    @property
+    def addresses(self) -> range:
+        return range(self.offset, self.offset + self.struct.size)
+class ConfigText(ConfigField):
+    """Zero padded ASCII field of a config image
+    """
+    def __init__(self, offset: int, length: int):
+        super().__init__(offset, f'{length:d}s')
+    def __get__(self, config, owner=None):
+        if config is None:
+            return self
+        raw = config.view[self.offset:self.offset + self.struct.size].tobytes()
+        return raw.split(b'\x00')[0].rstrip(b'\xff').decode('ascii', 'replace')
+    def __set__(self, config, value: str):
+        self.struct.pack_into(config.view, self.offset, value.encode('ascii'))
+class DeviceConfig:
+    """Configuration image of a GMC-500+/600 with named, typed fields
+
+    The image is a bytearray and every field is read and written in place
+    through a memoryview, so no copies are made.
+    """
+    power_off = ConfigField(0)
+    alarm = ConfigField(1)
+    speaker = ConfigField(2)
+    calibration_cpm_0 = ConfigField(8, '>H')
+    calibration_usv_0 = ConfigField(10, '>f')
+    calibration_cpm_1 = ConfigField(14, '>H')
+    calibration_usv_1 = ConfigField(16, '>f')
+    calibration_cpm_2 = ConfigField(20, '>H')
+    calibration_usv_2 = ConfigField(22, '>f')
+    save_data_type = ConfigField(32)
+    max_cpm = ConfigField(49, '>H')
+    baudrate = ConfigField(57)
+    wifi_ssid = ConfigText(69, 64)
+    wifi_password = ConfigText(133, 64)
+    website = ConfigText(197, 32)
+    url = ConfigText(229, 32)
+    user_id = ConfigText(261, 32)
+    counter_id = ConfigText(293, 32)
+    tube1_voltage = ConfigField(TUBE1_VOLTAGE_ADDRESS) # out of 150
+    def __init__(self, image = b''):
+        self.image = bytearray(image)
+        self.view = memoryview(self.image)
+    @classmethod
+    def read(cls, device):
+        """Reads a fresh image from a GMCDevice
+        """
+        return cls(read_config(device))
+    @classmethod
+    def field_names(cls) -> list:
+        return [name for name, attr in vars(cls).items() if isinstance(attr, ConfigField)]
+    @property
+    def tube1_voltage_percent(self) -> float:
+        return tube_voltage_percent(self.view)
+    @tube1_voltage_percent.setter
+    def tube1_voltage_percent(self, voltage_percent: float):
+        self.tube1_voltage = round(voltage_percent*(0.01)*150)
+    def fields(self) -> dict:
+        """All named fields and their values
+        """
+        return {name: getattr(self, name) for name in self.field_names()}
+    def copy(self):
+        return type(self)(self.image)
+    def diff(self, other) -> list:
+        """List of (address, own value, other value) for every byte that differs
+        """
+        return [(a, x, y) for a, (x, y) in enumerate(zip(self.view, memoryview(bytes(other)))) if x != y]
+    def diff_fields(self, other) -> dict:
+        """Named fields that differ, as {name: (own value, other value)}
+        """
+        other = other if isinstance(other, DeviceConfig) else DeviceConfig(other)
+        changed = {a for a, x, y in self.diff(other)}
+        cls = type(self)
+        return {name: (getattr(self, name), getattr(other, name)) for name in self.field_names()
+                if changed.intersection(getattr(cls, name).addresses)}
+    def __len__(self):
+        return len(self.image)
+    def __getitem__(self, index):
+        return self.view[index]
+    def __bytes__(self):
+        return bytes(self.image)
+    def __eq__(self, other):
+        if isinstance(other, DeviceConfig):
+            return self.image == other.image
+        return NotImplemented
+class ConfigCache:
+    """Holds one DeviceConfig per open GMCDevice
+
+    An image is only read from the device when none is cached. It is replaced by the
+    verified read-back of a config write and dropped by invalidate(), which must be
+    called after <CFGUPDATE>> or <FACTORYRESET>> and when the device is closed.
+    Reads and writes hold only their own device's lock during the serial transaction;
+    the cache lock guards the stored images, so other devices are never held up.
+    """
+    def __init__(self):
+        self._configs = {}
+        self._lock = threading.Lock()
+    def get(self, device) -> DeviceConfig:
+        config = self.cached(device)
+        if config is not None:
+            return config
+        with device.lock: # one read per device, even with several callers
+            config = self.cached(device)
+            if config is None:
+                config = DeviceConfig.read(device)
+                with self._lock:
+                    self._configs[device] = config
+            return config
+    def cached(self, device) -> DeviceConfig:
+        """The cached config of <device> without reading it, None if there is none
+        """
+        with self._lock:
+            return self._configs.get(device)
+    def invalidate(self, device):
+        with self._lock:
+            self._configs.pop(device, None)
+    def write(self, device, target, **kwargs) -> DeviceConfig:
+        """Writes <target> through a ConfigTransaction and caches the verified image
+        """
+        with device.lock: # no other command between reading the current image and the write
+            current = self.get(device)
+            return self.commit(device, ConfigTransaction(device, target, bytes(current), **kwargs))
+    def commit(self, device, transaction: ConfigTransaction) -> DeviceConfig:
+        """Commits a prepared ConfigTransaction and caches the verified image
+        """
+        with device.lock:
+            try:
+                image = transaction.commit()
+            except Exception:
+                self.invalidate(device) # device state is unknown
+                raise
+            config = DeviceConfig(image)
+            with self._lock:
+                self._configs[device] = config
+            return config
+config_cache = ConfigCache()
+def set_tube_voltage(device, voltage_percent: float, cache: ConfigCache = config_cache) -> DeviceConfig:
+    """Writes a tube 1 voltage percentage (0-100%) and returns the new config
+    """
+    target = cache.get(device).copy()
+    target.tube1_voltage_percent = voltage_percent
+    return cache.write(device, target)
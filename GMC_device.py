@@ -0,0 +1,332 @@
+"""Headless serial protocol layer for GQ GMC Geiger counters (see GQ-RFC1201.txt)
+
+GMCDevice knows the exact response length of every command, reads exactly that
+many bytes against a per-command deadline and drains stray heartbeat data so one
+late byte cannot desynchronise the commands that follow. It has no Qt dependency
+and is shared by the GUI and the headless tools.
+"""
+import os, threading, time
+from datetime import datetime
+import serial
+
+BAUDRATE = 115200
+ACK = b'\xAA'
+BYTE_TIME = 10/BAUDRATE # seconds per byte on the wire (8N1)
+
+# bytes returned by each command on the original GMC-280/300/320 firmware
+RESPONSE_LENGTHS = {
+    'GETVER': 14, 'GETCPM': 2, 'HEARTBEAT1': 0, 'HEARTBEAT0': 0, 'GETVOLT': 1,
+    'SPIR': None, 'GETCFG': 256, 'ECFG': 1, 'WCFG': 1, 'KEY': 0, 'GETSERIAL': 7,
+    'POWEROFF': 0, 'CFGUPDATE': 1, 'SETDATEYY': 1, 'SETDATEMM': 1, 'SETDATEDD': 1,
+    'SETTIMEHH': 1, 'SETTIMEMM': 1, 'SETTIMESS': 1, 'FACTORYRESET': 1, 'REBOOT': 0,
+    'SETDATETIME': 1, 'GETDATETIME': 7, 'GETTEMP': 4, 'GETGYRO': 7, 'POWERON': 0,
+}
+# the GMC-500+/600 series return wider values and a 512 byte config
+LARGE_MODEL_LENGTHS = {'GETCPM': 4, 'GETVOLT': 5, 'GETCFG': 512}
+LARGE_MODELS = ('GMC-500', 'GMC-600')
+# time the device needs on top of the wire time before it answers
+PROCESSING_TIME = {'ECFG': 0.5, 'CFGUPDATE': 0.3, 'FACTORYRESET': 1.0, 'GETCFG': 0.1, 'SPIR': 0.2}
+DEFAULT_PROCESSING_TIME = 0.05
+VERSION_TAIL_TIME = 0.02 # GMC-500+ versions are one byte longer than the RFC's 14
+QUIET_TIME = 0.05 # silence on the line that counts as resynchronised
+MAX_SPIR_LENGTH = 4096
+
+def find_ports() -> list:
+    """Finds the serial ports currently open
+       and returns them as a list
+    """
+    import serial.tools.list_ports
+    ports = serial.tools.list_ports.comports()
+
+    available_ports = [p.name for p in ports]
+    available_ports += [p for p in os.environ.get('GMC_PORTS', '').split(os.pathsep) if p] #extra ports such as GMC_emulator ptys
+
+    return available_ports
+class GMCError(Exception):
+    """Base class for protocol errors
+    """
+class GMCTimeout(GMCError):
+    """Raised when a response did not arrive in full before its deadline
+    """
+    def __init__(self, command: str, expected: int, received: bytes):
+        super().__init__(f"{command}: received {len(received):d} of {expected:d} bytes")
+        self.command = command
+        self.expected = expected
+        self.received = received
+class GMCAckError(GMCError):
+    """Raised when a command answered with something other than 0xAA
+    """
+def parse_voltage(data: bytes) -> float:
+    if len(data) == 1:
+        return data[0]/10
+    return float(data.decode('ascii').strip(' vV\x00')) # ASCII on the GMC-500+/600
+def parse_datetime(data: bytes) -> datetime:
+    return datetime(2000 + data[0], *data[1:6])
+def parse_temperature(data: bytes) -> float:
+    temperature = data[0] + data[1]/10
+    return -temperature if data[2] else temperature
+def parse_gyro(data: bytes) -> tuple:
+    return tuple(int.from_bytes(data[i:i+2], byteorder='big') for i in (0, 2, 4))
+class GMCDevice:
+    """Protocol level access to one GQ GMC Geiger counter on a serial port
+
+    Every command is a transaction under one lock: the request is written, then
+    exactly the documented number of response bytes is read before a deadline made
+    of the wire time plus the device's processing time.
+    """
+    def __init__(self, port, version: str = ''):
+        self.port = port # serial.Serial or any object with write/read/timeout
+        self.lock = threading.RLock()
+        self.streaming = False # heartbeat mode on
+        self.version = ''
+        self.lengths = dict(RESPONSE_LENGTHS)
+        self.heartbeat_size = 2
+        self._heartbeat_buffer = bytearray() # partial heartbeat sample
+        self.metrics = None # GMC_metrics.DeviceMetrics recording this device's I/O
+        self.pipelining = True # answers several commands sent in one write, see pipeline()
+        if version:
+            self._set_version(version)
+    @classmethod
+    def open(cls, port_name: str, baudrate: int = BAUDRATE, capture: str = None, resync: bool = True):
+        """Opens <port_name> and stops any heartbeat left running on the device, unless not <resync>
+
+        The port is locked for exclusive access, so opening a port another program
+        has open raises serial.SerialException (an OSError) instead of sharing it.
+        With <capture> all traffic is recorded to that file, see GMC_capture
+        """
+        port = serial.Serial(port_name, baudrate, timeout=1, exclusive=True) # always exclusive on Windows
+        if capture:
+            from GMC_capture import CaptureSerial
+            port = CaptureSerial(port, capture)
+        device = cls(port)
+        if resync:
+            device.resync()
+        return device
+    @property
+    def name(self) -> str:
+        return getattr(self.port, 'port', None) or repr(self.port)
+    @property
+    def model(self) -> str:
+        return self.version[0:7]
+    @property
+    def cfg_size(self) -> int:
+        return self.lengths['GETCFG']
+    def _set_version(self, version: str):
+        self.version = version
+        self.lengths = dict(RESPONSE_LENGTHS)
+        if self.model in LARGE_MODELS:
+            self.lengths.update(LARGE_MODEL_LENGTHS)
+            self.heartbeat_size = 4 # 32 bit counts per second
+        else:
+            self.heartbeat_size = 2
+    def close(self):
+        with self.lock:
+            try:
+                self.write(b'<HEARTBEAT0>>') # leave the device quiet for the next program
+            except OSError:
+                pass # unplugged, the port still has to be closed
+            self.streaming = False
+            self.port.close()
+### Raw transport
+    def write(self, data: bytes):
+        self.port.write(data)
+        if self.metrics is not None:
+            self.metrics.bytes_out += len(data)
+    def read(self, size: int, timeout: float) -> bytes:
+        """Reads up to <size> bytes, returning whatever arrived within <timeout> seconds
+        """
+        deadline = time.monotonic() + timeout
+        data = bytearray()
+        remaining = timeout
+        while True:
+            self.port.timeout = max(remaining, 0)
+            data += self.port.read(size - len(data))
+            remaining = deadline - time.monotonic()
+            if len(data) >= size or remaining <= 0:
+                if self.metrics is not None:
+                    self.metrics.bytes_in += len(data)
+                return bytes(data)
+    def read_exact(self, size: int, timeout: float, command: str = '') -> bytes:
+        data = self.read(size, timeout)
+        if len(data) != size:
+            raise GMCTimeout(command, size, data)
+        return data
+    def drain(self) -> bytes:
+        """Discards and returns any bytes already waiting on the port
+        """
+        waiting = getattr(self.port, 'in_waiting', 0)
+        return self.read(waiting, 0) if waiting else b''
+    def resync(self):
+        """Turns the heartbeat off and waits for the line to go quiet
+        """
+        with self.lock:
+            self.write(b'<HEARTBEAT0>>')
+            self.streaming = False
+            while self.read(64, QUIET_TIME):
+                pass # stray heartbeat bytes
+    def deadline(self, name: str, request_size: int, response_size: int) -> float:
+        """Time allowed for a command to be sent and answered
+        """
+        return (request_size + response_size)*BYTE_TIME + PROCESSING_TIME.get(name, DEFAULT_PROCESSING_TIME)
+    def command(self, name: str, params: bytes = b'', response_size: int = None) -> bytes:
+        """Sends <name><params> and returns its complete response
+        """
+        if response_size is None:
+            response_size = self.lengths[name]
+        request = b'<' + name.encode() + params + b'>>'
+        with self.lock:
+            if self.streaming and name != 'HEARTBEAT0':
+                raise GMCError(f"{name}: heartbeat is running on {self.name}")
+            self.drain()
+            start = time.perf_counter()
+            self.write(request)
+            if not response_size:
+                return b''
+            try:
+                response = self.read_exact(response_size, self.deadline(name, len(request), response_size), name)
+            except GMCTimeout:
+                if self.metrics is not None:
+                    self.metrics.timeout(name)
+                self.resync() # a late reply must not answer the next command
+                raise
+            if self.metrics is not None:
+                self.metrics.command(name, time.perf_counter() - start)
+            return response
+    def acked(self, name: str, params: bytes = b''):
+        """Sends a command that answers 0xAA
+        """
+        confirmation = self.command(name, params)
+        if confirmation != ACK:
+            if self.metrics is not None:
+                self.metrics.bad_acks += 1
+            raise GMCAckError(f"{name} failed: " + confirmation.hex().upper())
+    def pipeline(self, names: list) -> list:
+        """Sends commands without parameters in one write and returns their responses in order
+
+        All responses have fixed lengths, so they are read back as one block and
+        split: one round trip for the lot. A device that does not answer all of
+        them in time gets the commands one at a time from then on.
+        """
+        sizes = [self.lengths[name] for name in names]
+        if not self.pipelining:
+            return [self.command(name) for name in names]
+        request = b''.join(b'<' + name.encode() + b'>>' for name in names)
+        label = '+'.join(names)
+        with self.lock:
+            if self.streaming:
+                raise GMCError(f"{label}: heartbeat is running on {self.name}")
+            self.drain()
+            start = time.perf_counter()
+            self.write(request)
+            timeout = (len(request) + sum(sizes))*BYTE_TIME + sum(PROCESSING_TIME.get(name, DEFAULT_PROCESSING_TIME)
+                                                                  for name in names)
+            try:
+                data = self.read_exact(sum(sizes), timeout, label)
+            except GMCTimeout:
+                if self.metrics is not None:
+                    self.metrics.timeout(label)
+                self.resync()
+                self.pipelining = False
+                return [self.command(name) for name in names]
+            if self.metrics is not None:
+                self.metrics.command(label, time.perf_counter() - start)
+        responses = []
+        offset = 0
+        for size in sizes:
+            responses.append(data[offset:offset + size])
+            offset += size
+        return responses
+    def check_sentinel(self, name: str, data: bytes) -> bytes:
+        """Returns the response of a command that ends with 0xAA, raising GMCAckError without it
+        """
+        if data[-1:] != ACK:
+            if self.metrics is not None:
+                self.metrics.bad_acks += 1
+            self.resync()
+            raise GMCAckError(f"{name}: missing 0xAA sentinel in " + data.hex().upper())
+        return data
+### Commands
+    def get_version(self) -> str:
+        with self.lock:
+            version = self.command('GETVER')
+            version += self.read(1, VERSION_TAIL_TIME)
+            self._set_version(version.decode('ascii', 'replace'))
+        return self.version
+    def get_serial(self) -> str:
+        return self.command('GETSERIAL').hex().upper()
+    def get_cpm(self) -> int:
+        return int.from_bytes(self.command('GETCPM'), byteorder='big')
+    def get_battery_voltage(self) -> float:
+        return parse_voltage(self.command('GETVOLT'))
+    def read_flash(self, address: int, length: int) -> bytes:
+        """Reads <length> bytes of history flash at <address> with <SPIR>>
+        """
+        if not 0 < length <= MAX_SPIR_LENGTH:
+            raise ValueError(f"SPIR length must be 1-{MAX_SPIR_LENGTH:d}")
+        params = address.to_bytes(3, byteorder='big') + length.to_bytes(2, byteorder='big')
+        return self.command('SPIR', params, length)
+    def get_config(self) -> bytes:
+        return self.command('GETCFG')
+    def erase_config(self):
+        self.acked('ECFG')
+    def write_config_byte(self, address: int, value: int):
+        addr_len = 2 if self.cfg_size > 256 else 1
+        self.acked('WCFG', address.to_bytes(addr_len, byteorder='big') + bytes((value,)))
+    def update_config(self):
+        self.acked('CFGUPDATE')
+    def send_key(self, key: int):
+        self.command('KEY', str(key).encode())
+    def power_off(self):
+        self.command('POWEROFF')
+    def power_on(self):
+        self.command('POWERON')
+    def reboot(self):
+        self.command('REBOOT')
+        self.streaming = False
+    def factory_reset(self):
+        self.acked('FACTORYRESET')
+    def set_clock_field(self, name: str, value: int):
+        """Sets one clock field, <name> is one of SETDATEYY, SETDATEMM, SETDATEDD, SETTIMEHH, SETTIMEMM, SETTIMESS
+        """
+        self.acked(name, bytes((value,)))
+    def set_datetime(self, when: datetime = None):
+        when = when or datetime.now()
+        self.acked('SETDATETIME', bytes((when.year % 100, when.month, when.day, when.hour, when.minute, when.second)))
+    def get_datetime(self) -> datetime:
+        return parse_datetime(self._sentinel('GETDATETIME'))
+    def get_temperature(self) -> float:
+        return parse_temperature(self._sentinel('GETTEMP'))
+    def get_gyro(self) -> tuple:
+        return parse_gyro(self._sentinel('GETGYRO'))
+    def _sentinel(self, name: str) -> bytes:
+        """Runs a command whose response ends with 0xAA
+        """
+        return self.check_sentinel(name, self.command(name))
+### Heartbeat
+    def start_heartbeat(self):
+        with self.lock:
+            self.command('HEARTBEAT1')
+            self._heartbeat_buffer.clear()
+            self.streaming = True
+    def stop_heartbeat(self):
+        self.resync()
+    def heartbeat_backlog(self) -> int:
+        """Number of complete heartbeat samples already waiting to be read
+        """
+        return (len(self._heartbeat_buffer) + getattr(self.port, 'in_waiting', 0))//self.heartbeat_size
+    def read_heartbeat(self, timeout: float = 1.5):
+        """Returns the next counts per second sample, or None if none arrived in <timeout>
+        """
+        counts = self.feed_heartbeat(self.read(self.heartbeat_size - len(self._heartbeat_buffer), timeout))
+        return counts[0] if counts else None # a partial sample is kept for the next call
+    def feed_heartbeat(self, data: bytes) -> list:
+        """Frames raw heartbeat bytes into counts, keeping any trailing partial sample
+        """
+        buffer = self._heartbeat_buffer
+        buffer += data
+        size = self.heartbeat_size
+        end = len(buffer) - len(buffer) % size
+        mask = 0xFFFFFFFF if size > 2 else 0x3FFF # bits 14,15 are reserved on 2 byte samples
+        counts = [int.from_bytes(buffer[i:i+size], byteorder='big') & mask for i in range(0, end, size)]
+        del buffer[:end]
+        return counts
@@ -0,0 +1,139 @@
+"""Concurrent discovery of GMC counters on the serial ports of the host
+
+Every candidate port is probed at the same time with <GETVER>> and <GETSERIAL>>,
+so finding a counter takes one probe's time however many adapters there are.
+Ports are opened for exclusive access, so a port another program has open, a
+proxy or a running count, is skipped instead of having its replies stolen.
+Counters found are cached in a JSON file keyed by the USB adapter's VID:PID and
+location, so a known counter is matched to its port again at startup or after
+being replugged without probing the other ports.
+"""
+import json, os, time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from GMC_device import GMCDevice, GMCError, GMCTimeout
+
+DEFAULT_CACHE_PATH = 'devices.json'
+PROBE_WORKERS = 16
+
+PortInfo = namedtuple('PortInfo', 'port key')
+DeviceRecord = namedtuple('DeviceRecord', 'port key serial version')
+
+def candidate_ports() -> list:
+    """PortInfo of every serial port, plus the ports listed in GMC_PORTS
+    """
+    import serial.tools.list_ports
+    ports = []
+    for p in serial.tools.list_ports.comports():
+        if p.vid is not None:
+            key = f'{p.vid:04X}:{p.pid:04X}:{p.location or p.device}'
+        else:
+            key = p.device # not a USB adapter
+        ports.append(PortInfo(p.device, key))
+    ports += [PortInfo(p, p) for p in os.environ.get('GMC_PORTS', '').split(os.pathsep) if p]
+    return ports
+def probe(port: PortInfo) -> DeviceRecord:
+    """Identifies the counter on <port>, returns None if there is none or another program has the port
+
+    The heartbeat is left as it was found. A counter still streaming for a
+    program that went away garbles the first <GETVER>> reply; it is quietened
+    for the probe and its heartbeat turned back on afterwards.
+    """
+    try:
+        device = GMCDevice.open(port.port, resync=False)
+    except OSError:
+        return None # busy or gone
+    streaming = False
+    try:
+        version = read_version(device)
+        if version and not version.startswith('GMC'): # maybe heartbeat samples mixed into the reply
+            device.resync()
+            version = read_version(device)
+            streaming = version.startswith('GMC') # it only answered with the heartbeat off
+        if not version.startswith('GMC'):
+            return None
+        try:
+            serial_number = device.get_serial()
+        except GMCError:
+            serial_number = '' # firmware without GETSERIAL
+        return DeviceRecord(port.port, port.key, serial_number, version)
+    except (GMCError, OSError):
+        return None
+    finally:
+        try:
+            if streaming:
+                device.command('HEARTBEAT1')
+        except (GMCError, OSError):
+            pass
+        device.port.close()
+def read_version(device) -> str:
+    """The <GETVER>> reply of a GMCDevice as text, as much of it as arrived
+    """
+    device.drain()
+    try:
+        return device.get_version()
+    except GMCTimeout as e:
+        return e.received.decode('ascii', 'replace')
+class DeviceCache:
+    """Known counters by port key, kept in a JSON file
+    """
+    def __init__(self, path: str = DEFAULT_CACHE_PATH):
+        self.path = path
+        self.records = {}
+        try:
+            with open(path) as f:
+                self.records = json.load(f)
+        except (OSError, ValueError):
+            pass # first run or unreadable, start empty
+    def get(self, key: str) -> dict:
+        return self.records.get(key)
+    def update(self, record: DeviceRecord):
+        self.records[record.key] = {'port': record.port, 'serial': record.serial,
+                                    'version': record.version, 'seen': time.time()}
+    def save(self):
+        """Atomically replaces the cache file
+        """
+        temp = self.path + '.tmp'
+        with open(temp, 'w') as f:
+            json.dump(self.records, f, indent=1)
+        os.replace(temp, self.path)
+class Discovery:
+    """Finds counters on the host's ports and remembers where they were
+    """
+    def __init__(self, cache: DeviceCache = None, workers: int = PROBE_WORKERS):
+        self.cache = cache if cache is not None else DeviceCache()
+        self.workers = workers
+    def probe_all(self, ports: list) -> list:
+        """Probes <ports> concurrently and caches the counters found
+        """
+        if not ports:
+            return []
+        with ThreadPoolExecutor(min(self.workers, len(ports))) as pool:
+            records = [record for record in pool.map(probe, ports) if record is not None]
+        for record in records:
+            self.cache.update(record)
+        if records:
+            self.cache.save()
+        return records
+    def discover(self, exclude: tuple = ()) -> list:
+        """DeviceRecords of every counter present, ports in <exclude> are not touched
+        """
+        return self.probe_all([p for p in candidate_ports() if p.port not in exclude])
+    def reconnect(self, exclude: tuple = ()) -> list:
+        """DeviceRecords of the cached counters present now, probing only their ports
+
+        Ports are matched by VID:PID and location, so a counter replugged into
+        the same socket is found under its new port name.
+        """
+        return self.probe_all([p for p in candidate_ports()
+                               if p.port not in exclude and self.cache.get(p.key) is not None])
+    def find(self, serial_number: str, exclude: tuple = ()) -> DeviceRecord:
+        """The counter with <serial_number>, trying its cached port before all others
+        """
+        ports = [p for p in candidate_ports() if p.port not in exclude]
+        known = [p for p in ports if (self.cache.get(p.key) or {}).get('serial') == serial_number]
+        for records in (self.probe_all(known), self.probe_all([p for p in ports if p not in known])):
+            for record in records:
+                if record.serial == serial_number:
+                    return record
+        return None
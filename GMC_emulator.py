@@ -0,0 +1,295 @@
+"""Software GQ GMC Geiger counter on a pseudo-terminal (POSIX only)
+
+GMCEmulator answers the GQ-RFC1201 commands on the slave side of a pty, so the
+terminal, the headless tools and the benchmarks can open it like a real port.
+Counts are Poisson distributed; wire and link latency, ack delays and faults
+(dropped, corrupted or truncated replies and stray bytes) can be injected.
+
+Run it standalone with
+    python GMC_emulator.py --cpm 30 --link /tmp/gmc0
+and open the printed port (or add it to the GMC_PORTS environment variable so
+it shows up in the port list).
+"""
+import argparse, math, os, random, select, sys, threading, time
+from collections import deque
+from datetime import datetime, timedelta
+from GMC_config import TUBE1_VOLTAGE_ADDRESS
+from GMC_device import LARGE_MODEL_LENGTHS, LARGE_MODELS, RESPONSE_LENGTHS
+from GMC_history import flash_size
+
+ACK = b'\xAA'
+# parameter bytes following each command name, WCFG depends on the config size
+PARAM_LENGTHS = {'SPIR': 5, 'KEY': 1, 'SETDATEYY': 1, 'SETDATEMM': 1, 'SETDATEDD': 1,
+                 'SETTIMEHH': 1, 'SETTIMEMM': 1, 'SETTIMESS': 1, 'SETDATETIME': 6}
+COMMANDS = sorted(RESPONSE_LENGTHS, key=len, reverse=True) # longest match first
+FAULTS = ('drop', 'corrupt', 'short', 'stray')
+
+def poisson(rng: random.Random, mean: float) -> int:
+    """Poisson distributed random count
+    """
+    if mean <= 0:
+        return 0
+    if mean > 500: # normal approximation for high rates
+        return max(0, round(rng.gauss(mean, math.sqrt(mean))))
+    limit, k, p = math.exp(-mean), 0, rng.random()
+    while p > limit:
+        k += 1
+        p *= rng.random()
+    return k
+class GMCEmulator:
+    """Emulated GMC counter serving one pty
+
+    <cpm> is the mean count rate, <byte_latency> the delay per reply byte (the
+    wire time at 115200 baud is ~87us), <link_latency> the USB-serial turnaround
+    every reply is delayed by without holding up the next command, <ack_delay>
+    the device time spent before every 0xAA ack and <faults> maps a fault name in
+    FAULTS to its probability per reply.
+    <heartbeat_interval> can be shortened to load test the acquisition path.
+    """
+    def __init__(self, version: str = 'GMC-500+Re 2.42', cpm: float = 30.0, byte_latency: float = 0.0,
+                 ack_delay: float = 0.0, faults: dict = None, heartbeat_interval: float = 1.0,
+                 serial_number: bytes = b'\xF4\x88\x00\x12\x34\x56\x78', seed: int = None,
+                 link_latency: float = 0.0):
+        self.version = version
+        self.cpm = cpm
+        self.byte_latency = byte_latency
+        self.link_latency = link_latency
+        self.outbox = deque() # (due time, data) replies still on the link
+        self.ack_delay = ack_delay
+        self.faults = dict(faults or {})
+        self.heartbeat_interval = heartbeat_interval
+        self.serial_number = serial_number
+        self.rng = random.Random(seed)
+        large = version[0:7] in LARGE_MODELS
+        self.lengths = dict(RESPONSE_LENGTHS, **(LARGE_MODEL_LENGTHS if large else {}))
+        self.heartbeat_size = 4 if large else 2
+        self.cfg_size = self.lengths['GETCFG']
+        self.factory_config = self._default_config()
+        self.config = bytearray(self.factory_config) # what GETCFG returns
+        self.flash_config = bytearray(self.config) # what ECFG/WCFG change until CFGUPDATE
+        self.flash = self._default_history(flash_size(version[0:7]))
+        self.clock_offset = timedelta(0) # device clock minus host clock
+        self.heartbeat = False
+        self.powered = True
+        self.commands = {} # command name -> number received
+        self.master = self.slave = None
+        self.port_name = None
+        self.stop_flag = False
+        self.thread = None
+    def _default_config(self) -> bytearray:
+        cfg = bytearray(self.cfg_size)
+        if self.cfg_size > TUBE1_VOLTAGE_ADDRESS:
+            cfg[TUBE1_VOLTAGE_ADDRESS] = 100 # out of 150
+        return cfg
+    def _default_history(self, size: int) -> bytearray:
+        """Erased flash holding one hour of CPS history
+        """
+        flash = bytearray(b'\xFF'*size)
+        start = datetime.now().replace(microsecond=0) - timedelta(hours=1)
+        record = bytearray(b'\x55\xAA\x00' + bytes((start.year % 100, start.month, start.day,
+                                                    start.hour, start.minute, start.second)) + b'\x55\xAA\x01')
+        record += bytes(min(poisson(self.rng, self.cpm/60), 0x54) for i in range(3600)) # no 0x55 tag bytes
+        flash[0:len(record)] = record[:size]
+        return flash
+### pty handling
+    def start(self) -> str:
+        """Creates the pty, starts serving it and returns its port name
+        """
+        import pty, tty
+        self.master, self.slave = pty.openpty()
+        tty.setraw(self.slave) # no echo or line editing on the device side
+        self.port_name = os.ttyname(self.slave)
+        self.stop_flag = False
+        self.thread = threading.Thread(target=self.serve, daemon=True)
+        self.thread.start()
+        return self.port_name
+    def stop(self):
+        self.stop_flag = True
+        if self.thread:
+            self.thread.join()
+        for fd in (self.master, self.slave):
+            if fd is not None:
+                os.close(fd)
+        self.master = self.slave = None
+    def __enter__(self):
+        self.start()
+        return self
+    def __exit__(self, *exc):
+        self.stop()
+    def serve(self):
+        buffer = bytearray()
+        next_beat = time.monotonic() + self.heartbeat_interval
+        while not self.stop_flag:
+            wait = max(0, next_beat - time.monotonic()) if self.heartbeat else 0.05
+            if self.outbox:
+                wait = min(wait, max(0, self.outbox[0][0] - time.monotonic()))
+            readable = select.select([self.master], [], [], min(wait, 0.05))[0]
+            while self.outbox and self.outbox[0][0] <= time.monotonic():
+                os.write(self.master, self.outbox.popleft()[1])
+            if readable:
+                buffer += os.read(self.master, 4096)
+                for name, params in self.parse(buffer):
+                    self.handle(name, params)
+                    if name == 'HEARTBEAT1':
+                        next_beat = time.monotonic() + self.heartbeat_interval
+            if self.heartbeat and time.monotonic() >= next_beat:
+                next_beat += self.heartbeat_interval
+                if not self.fault('drop'):
+                    count = poisson(self.rng, self.cpm*self.heartbeat_interval/60)
+                    self.send(min(count, 2**(8*self.heartbeat_size) - 1).to_bytes(self.heartbeat_size, 'big'))
+    def parse(self, buffer: bytearray):
+        """Yields complete (name, params) commands from <buffer>, leaving partial ones
+        """
+        while True:
+            start = buffer.find(b'<')
+            if start < 0:
+                buffer.clear()
+                return
+            del buffer[:start]
+            for name in COMMANDS:
+                if buffer[1:1 + len(name)] == name.encode():
+                    break
+            else:
+                if len(buffer) < 1 + len(COMMANDS[0]) and buffer.find(b'>>') < 0:
+                    return # possibly incomplete name
+                del buffer[:1] # unknown command, resync on the next '<'
+                continue
+            param_len = PARAM_LENGTHS.get(name, 0)
+            if name == 'WCFG':
+                param_len = 3 if self.cfg_size > 256 else 2
+            end = 1 + len(name) + param_len
+            if len(buffer) < end + 2:
+                return
+            if buffer[end:end + 2] != b'>>':
+                del buffer[:1]
+                continue
+            params = bytes(buffer[1 + len(name):end])
+            del buffer[:end + 2]
+            yield name, params
+### Replies
+    def fault(self, name: str) -> bool:
+        return self.rng.random() < self.faults.get(name, 0)
+    def send(self, data: bytes):
+        if self.byte_latency:
+            time.sleep(len(data)*self.byte_latency)
+        if self.link_latency:
+            self.outbox.append((time.monotonic() + self.link_latency, data))
+        else:
+            os.write(self.master, data)
+    def reply(self, data: bytes):
+        """Sends a reply after applying any injected faults
+        """
+        if self.fault('stray'):
+            self.send(bytes(self.heartbeat_size)) # a late heartbeat sample
+        if self.fault('drop'):
+            return
+        if self.fault('corrupt'):
+            data = bytes((data[0] ^ 0xFF,)) + data[1:]
+        if self.fault('short'):
+            data = data[:len(data)//2]
+        if data:
+            self.send(data)
+    def ack(self):
+        if self.ack_delay:
+            time.sleep(self.ack_delay)
+        self.reply(ACK)
+    def now(self) -> datetime:
+        return datetime.now() + self.clock_offset
+    def set_clock(self, **fields):
+        now = self.now()
+        if 'year' in fields:
+            fields['year'] += 2000
+        self.clock_offset = now.replace(**fields) - datetime.now()
+    def handle(self, name: str, params: bytes):
+        self.commands[name] = self.commands.get(name, 0) + 1
+        if not self.powered and name != 'POWERON':
+            return
+        if name == 'GETVER':
+            self.reply(self.version.encode())
+        elif name == 'GETSERIAL':
+            self.reply(self.serial_number)
+        elif name == 'GETCPM':
+            self.reply(poisson(self.rng, self.cpm).to_bytes(self.lengths['GETCPM'], 'big'))
+        elif name == 'HEARTBEAT1':
+            self.heartbeat = True
+        elif name == 'HEARTBEAT0':
+            self.heartbeat = False
+        elif name == 'GETVOLT':
+            self.reply(b'4.90v' if self.lengths['GETVOLT'] == 5 else bytes((49,)))
+        elif name == 'SPIR':
+            address = int.from_bytes(params[0:3], 'big')
+            length = int.from_bytes(params[3:5], 'big')
+            data = bytes(self.flash[address:address + length])
+            self.reply(data + b'\xFF'*(length - len(data)))
+        elif name == 'GETCFG':
+            self.reply(bytes(self.config))
+        elif name == 'ECFG':
+            self.flash_config[:] = b'\xFF'*self.cfg_size
+            self.ack()
+        elif name == 'WCFG':
+            address = int.from_bytes(params[:-1], 'big')
+            if address < self.cfg_size:
+                self.flash_config[address] = params[-1]
+            self.ack()
+        elif name == 'CFGUPDATE':
+            self.config[:] = self.flash_config
+            self.ack()
+        elif name == 'FACTORYRESET':
+            self.config[:] = self.flash_config[:] = self.factory_config
+            self.ack()
+        elif name in ('SETDATEYY', 'SETDATEMM', 'SETDATEDD', 'SETTIMEHH', 'SETTIMEMM', 'SETTIMESS'):
+            field = {'SETDATEYY': 'year', 'SETDATEMM': 'month', 'SETDATEDD': 'day',
+                     'SETTIMEHH': 'hour', 'SETTIMEMM': 'minute', 'SETTIMESS': 'second'}[name]
+            self.set_clock(**{field: params[0]})
+            self.ack()
+        elif name == 'SETDATETIME':
+            self.set_clock(year=params[0], month=params[1], day=params[2],
+                           hour=params[3], minute=params[4], second=params[5])
+            self.ack()
+        elif name == 'GETDATETIME':
+            now = self.now()
+            self.reply(bytes((now.year % 100, now.month, now.day, now.hour, now.minute, now.second)) + ACK)
+        elif name == 'GETTEMP':
+            self.reply(bytes((23, 5, 0)) + ACK)
+        elif name == 'GETGYRO':
+            self.reply(b'\x00\x10\xFF\xF0\x01\x00' + ACK)
+        elif name == 'REBOOT':
+            self.heartbeat = False
+        elif name == 'POWEROFF':
+            self.powered = self.heartbeat = False
+        elif name == 'POWERON':
+            self.powered = True
+        # KEY has no reply
+def main():
+    parser = argparse.ArgumentParser(description="Emulated GQ GMC Geiger counter on a pty")
+    parser.add_argument('--version', default='GMC-500+Re 2.42', help="GETVER reply")
+    parser.add_argument('--cpm', type=float, default=30.0, help="mean counts per minute")
+    parser.add_argument('--byte-latency', type=float, default=0.0, help="seconds per reply byte")
+    parser.add_argument('--link-latency', type=float, default=0.0, help="USB-serial turnaround in seconds")
+    parser.add_argument('--ack-delay', type=float, default=0.0, help="seconds before every 0xAA ack")
+    parser.add_argument('--heartbeat-interval', type=float, default=1.0)
+    parser.add_argument('--fault', action='append', default=[], metavar='NAME=P',
+                        help="fault probability per reply, NAME is one of " + ", ".join(FAULTS))
+    parser.add_argument('--link', help="also make the pty available under this path")
+    parser.add_argument('--seed', type=int)
+    args = parser.parse_args()
+    faults = {name: float(p) for name, p in (f.split('=') for f in args.fault)}
+    emulator = GMCEmulator(args.version, args.cpm, args.byte_latency, args.ack_delay, faults,
+                           args.heartbeat_interval, seed=args.seed, link_latency=args.link_latency)
+    port_name = emulator.start()
+    if args.link:
+        if os.path.islink(args.link):
+            os.remove(args.link)
+        os.symlink(port_name, args.link)
+    print(f"Emulating {args.version} on {args.link or port_name}", flush=True)
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        emulator.stop()
+        if args.link and os.path.islink(args.link):
+            os.remove(args.link)
+if __name__ == '__main__':
+    main()
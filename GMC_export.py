@@ -0,0 +1,208 @@
+"""Columnar export of count logs, sample stores and history downloads
+
+Data is written a column at a time, in chunks, to a binary format analysis tools
+load directly instead of parsing CSV row by row:
+    .parquet           Parquet, one zstd compressed row group per chunk (needs pyarrow)
+    .arrow, .feather   Arrow IPC file of zstd compressed record batches (needs pyarrow)
+    .npz               NumPy archive of one deflate compressed .npy per column (needs only NumPy)
+Every format carries the same JSON metadata: the source, a description and unit
+of each column, and the names behind index columns such as 'device'.
+
+    columns, metadata = read_columns('samples.npz')
+"""
+import json, zipfile
+from datetime import datetime
+
+CHUNK_ROWS = 1 << 20 # rows per Parquet row group or Arrow record batch
+COMPRESSION = 'zstd'
+FORMATS = {'.parquet': 'parquet', '.arrow': 'arrow', '.feather': 'arrow', '.npz': 'npz'}
+FILE_FILTERS = {'parquet': "Parquet (*.parquet)", 'arrow': "Arrow IPC (*.arrow *.feather)",
+                'npz': "NumPy Archive (*.npz)"}
+METADATA_KEY = 'gmc' # schema metadata key in Parquet and Arrow files, array name in .npz
+SAMPLE_RECORD = [('timestamp', '<f8'), ('count', '<u4'), ('flags', '<u2'), ('reserved', '<u2')] # GMC_store.RECORD
+
+def _numpy():
+    try:
+        import numpy
+    except ModuleNotFoundError:
+        raise ModuleNotFoundError("columnar export needs NumPy: pip install numpy") from None
+    return numpy
+def _pyarrow():
+    try:
+        import pyarrow
+    except ModuleNotFoundError:
+        raise ModuleNotFoundError("Parquet and Arrow export need pyarrow: pip install pyarrow, "
+                                  "or export to .npz") from None
+    return pyarrow
+def export_format(filename: str) -> str:
+    """'parquet', 'arrow' or 'npz', from the extension of <filename>
+    """
+    for extension, name in FORMATS.items():
+        if filename.lower().endswith(extension):
+            return name
+    raise ValueError(f"{filename}: unknown export format, use one of {', '.join(FORMATS)}")
+def available_formats() -> list:
+    """Export formats the installed packages can write
+    """
+    formats = []
+    for name, loader in (('parquet', _pyarrow), ('arrow', _pyarrow), ('npz', _numpy)):
+        try:
+            loader()
+        except ModuleNotFoundError:
+            continue
+        formats.append(name)
+    return formats
+class ColumnWriter:
+    """Writes chunks of columns to <filename> in the format its extension names
+
+    <columns> lists (name, NumPy dtype) in file order. Parquet and Arrow chunks
+    go to disk as they are written; an .npz keeps them until close(), since
+    each of its columns is stored in one piece.
+    """
+    def __init__(self, filename: str, columns: list, metadata: dict):
+        self.filename = filename
+        self.format = export_format(filename)
+        self.np = _numpy()
+        self.names = [name for name, dtype in columns]
+        self.dtypes = {name: self.np.dtype(dtype) for name, dtype in columns}
+        self.metadata = metadata
+        self.rows = 0
+        self.writer = None
+        if self.format == 'npz':
+            self.chunks = {name: [] for name in self.names}
+            return
+        pa = _pyarrow()
+        self.schema = pa.schema([pa.field(name, pa.from_numpy_dtype(self.dtypes[name])) for name in self.names],
+                                metadata={METADATA_KEY: json.dumps(metadata)})
+        if self.format == 'parquet':
+            import pyarrow.parquet as pq
+            self.writer = pq.ParquetWriter(filename, self.schema, compression=COMPRESSION)
+        else:
+            import pyarrow.ipc
+            self.writer = pyarrow.ipc.new_file(filename, self.schema,
+                                               options=pyarrow.ipc.IpcWriteOptions(compression=COMPRESSION))
+    def __enter__(self):
+        return self
+    def __exit__(self, *exc):
+        self.close()
+    def write(self, chunk: dict):
+        """Appends one chunk, <chunk> maps every column name to an array of equal length
+        """
+        arrays = [self.np.asarray(chunk[name], dtype=self.dtypes[name]) for name in self.names]
+        if not len(arrays[0]):
+            return
+        self.rows += len(arrays[0])
+        if self.format == 'npz':
+            for name, values in zip(self.names, arrays):
+                self.chunks[name].append(values)
+            return
+        pa = _pyarrow()
+        batch = pa.RecordBatch.from_arrays([pa.array(values) for values in arrays], schema=self.schema)
+        if self.format == 'parquet':
+            self.writer.write_batch(batch, row_group_size=len(batch))
+        else:
+            self.writer.write_batch(batch)
+    def close(self):
+        if self.format != 'npz':
+            if self.writer is not None:
+                self.writer.close()
+                self.writer = None
+            return
+        np = self.np
+        with zipfile.ZipFile(self.filename, 'w', zipfile.ZIP_DEFLATED) as archive:
+            for name in self.names:
+                chunks = self.chunks[name]
+                values = np.concatenate(chunks) if chunks else np.empty(0, self.dtypes[name])
+                with archive.open(name + '.npy', 'w', force_zip64=True) as f:
+                    np.lib.format.write_array(f, values, allow_pickle=False)
+                chunks.clear() # frees the column before the next one is concatenated
+            with archive.open(METADATA_KEY + '.npy', 'w') as f:
+                np.lib.format.write_array(f, np.array(json.dumps(self.metadata)), allow_pickle=False)
+def write_columns(filename: str, columns: dict, metadata: dict, chunk_rows: int = CHUNK_ROWS):
+    """Writes whole columns, <columns> maps names to arrays, CHUNK_ROWS rows at a time
+    """
+    np = _numpy()
+    arrays = {name: np.asarray(values) for name, values in columns.items()}
+    rows = len(next(iter(arrays.values()))) if arrays else 0
+    with ColumnWriter(filename, [(name, values.dtype) for name, values in arrays.items()], metadata) as writer:
+        for start in range(0, rows, chunk_rows):
+            writer.write({name: values[start:start + chunk_rows] for name, values in arrays.items()})
+def read_columns(filename: str) -> tuple:
+    """Returns ({name: NumPy array}, metadata) of an exported file
+    """
+    np = _numpy()
+    if export_format(filename) == 'npz':
+        with np.load(filename, allow_pickle=False) as archive:
+            metadata = json.loads(str(archive[METADATA_KEY])) if METADATA_KEY in archive.files else {}
+            return {name: archive[name] for name in archive.files if name != METADATA_KEY}, metadata
+    pa = _pyarrow()
+    if export_format(filename) == 'parquet':
+        import pyarrow.parquet as pq
+        table = pq.read_table(filename)
+    else:
+        import pyarrow.ipc
+        with pa.OSFile(filename, 'rb') as source:
+            table = pyarrow.ipc.open_file(source).read_all()
+    metadata = json.loads((table.schema.metadata or {}).get(METADATA_KEY.encode(), b'{}'))
+    return {name: table.column(name).to_numpy() for name in table.column_names}, metadata
+def export_count_log(log, filename: str):
+    """Writes a GMC_log.CountLog, each column straight from its typed array
+    """
+    np = _numpy()
+    columns = {name: np.frombuffer(log.columns[name], dtype=typecode) for name, typecode, header in log.COLUMNS}
+    metadata = {'source': 'count log', 'exported': datetime.now().isoformat(timespec='seconds'),
+                'columns': {name: header for name, typecode, header in log.COLUMNS}}
+    write_columns(filename, columns, metadata)
+def export_store(root: str, filename: str, device_ids: list = None, start: float = None, end: float = None) -> int:
+    """Writes the samples of a GMC_store.TimeSeriesStore at <root> and returns the number of rows
+
+    Every segment range is one chunk, read from its mmap without unpacking
+    records. The 'device' column indexes metadata['devices']. <start> and
+    <end> limit the samples to start <= timestamp < end, seconds since the epoch.
+    """
+    from GMC_store import HEADER, TimeSeriesStore
+    np = _numpy()
+    record = np.dtype(SAMPLE_RECORD)
+    store = TimeSeriesStore(root, readonly=True)
+    device_ids = list(device_ids) if device_ids else store.devices()
+    metadata = {'source': 'sample store', 'exported': datetime.now().isoformat(timespec='seconds'),
+                'devices': device_ids, 'start': start, 'end': end,
+                'columns': {'timestamp': 'Timestamp (seconds since the epoch)', 'device': 'Device (index into devices)',
+                            'count': 'Counts per second', 'flags': 'Flags (1 gap before, 2 read from a backlog)'}}
+    columns = [('timestamp', 'f8'), ('device', 'u2'), ('count', 'u4'), ('flags', 'u2')]
+    try:
+        with ColumnWriter(filename, columns, metadata) as writer:
+            for index, device_id in enumerate(device_ids):
+                for segment, lo, hi in store.device(device_id).ranges(start, end):
+                    records = np.frombuffer(segment.map, dtype=record, count=hi - lo,
+                                            offset=HEADER.size + lo*record.itemsize)
+                    writer.write({'timestamp': records['timestamp'].copy(), 'device': np.full(hi - lo, index, 'u2'),
+                                  'count': records['count'].copy(), 'flags': records['flags'].copy()})
+                    del records # the map cannot close while a view of it exists
+            return writer.rows
+    finally:
+        store.close()
+def export_history(path: str, filename: str, default_start: datetime = None) -> int:
+    """Writes the samples of a downloaded history flash file and returns the number of rows
+
+    Timestamps are the counter's local time. The 'mode' column indexes metadata['modes'].
+    """
+    from GMC_history import SAVE_MODES, parse_history_file
+    np = _numpy()
+    modes = [name for name, interval in SAVE_MODES.values()]
+    metadata = {'source': 'history', 'file': path, 'exported': datetime.now().isoformat(timespec='seconds'),
+                'modes': modes,
+                'columns': {'timestamp': 'Timestamp (device local time)', 'count': 'Count',
+                            'mode': 'Save mode (index into modes)'}}
+    columns = [('timestamp', 'datetime64[s]'), ('count', 'u4'), ('mode', 'u1')]
+    with ColumnWriter(filename, columns, metadata) as writer:
+        chunk = ([], [], [])
+        for sample in parse_history_file(path, default_start):
+            chunk[0].append(sample.timestamp)
+            chunk[1].append(sample.count)
+            chunk[2].append(modes.index(sample.mode))
+            if len(chunk[0]) >= CHUNK_ROWS:
+                writer.write(dict(zip(('timestamp', 'count', 'mode'), chunk)))
+                chunk = ([], [], [])
+        writer.write(dict(zip(('timestamp', 'count', 'mode'), chunk)))
+        return writer.rows
@@ -0,0 +1,167 @@
+"""History flash download and parsing for GQ GMC Geiger counters
+
+HistoryDownloader pulls the on-device history flash with back-to-back <SPIR>>
+requests of the maximum length and streams every chunk straight to disk (or into
+a caller supplied buffer such as an mmap). A small JSON checkpoint next to the
+output file lets an interrupted download resume where it stopped.
+
+parse_history turns the raw flash into timestamped count samples.
+"""
+import json, mmap, os
+from collections import namedtuple
+from datetime import datetime, timedelta
+from GMC_device import MAX_SPIR_LENGTH
+
+FLASH_SIZES = {'GMC-280': 0x10000, 'GMC-300': 0x10000, 'GMC-320': 0x100000,
+               'GMC-500': 0x100000, 'GMC-600': 0x100000}
+DEFAULT_FLASH_SIZE = 0x10000
+EMPTY_BYTE = 0xFF # erased flash
+EMPTY_RUN = 16 # consecutive erased bytes treated as unused flash
+
+HistorySample = namedtuple('HistorySample', 'timestamp count mode')
+# save modes from the 55 AA 00 date stamp: (name, seconds per sample)
+SAVE_MODES = {0: ('off', None), 1: ('CPS', 1), 2: ('CPM', 60), 3: ('CPM/hour', 3600),
+              4: ('CPS threshold', 1), 5: ('CPM threshold', 60)}
+DEFAULT_MODE = 1 # CPS, assumed for the records before the first date stamp when a default start is given
+TAG = b'\x55\xAA'
+
+def flash_size(model: str) -> int:
+    return FLASH_SIZES.get(model, DEFAULT_FLASH_SIZE)
+class HistoryDownloader:
+    """Downloads the history flash of a GMCDevice in <chunk_size> SPIR requests
+
+    Progress is checkpointed to <path>.checkpoint every <checkpoint_every> chunks
+    and removed once the download is complete.
+    """
+    def __init__(self, device, size: int = None, chunk_size: int = MAX_SPIR_LENGTH, checkpoint_every: int = 16):
+        self.device = device
+        self.size = size or flash_size(device.model)
+        self.chunk_size = chunk_size
+        self.checkpoint_every = checkpoint_every
+        self.interrupt_flag = False # set from another thread to stop after the current chunk
+    def chunks(self, start: int = 0):
+        """Yields (address, data) for every chunk from <start> to the end of the flash
+        """
+        for address in range(start, self.size, self.chunk_size):
+            if self.interrupt_flag:
+                return
+            yield address, self.device.read_flash(address, min(self.chunk_size, self.size - address))
+    def download_into(self, buffer, start: int = 0, progress = None) -> int:
+        """Downloads into a writable buffer (bytearray, mmap, ...) and returns the bytes read
+        """
+        view = memoryview(buffer)
+        end = start
+        for address, data in self.chunks(start):
+            end = address + len(data)
+            view[address:end] = data
+            if progress:
+                progress(end, self.size)
+        return end - start
+    def download(self, path: str, progress = None) -> bool:
+        """Streams the flash to <path>, resuming from a checkpoint if one matches
+
+        Returns True once the whole flash is on disk, False if interrupted
+        """
+        serial_number = self.device.get_serial()
+        offset = self._resume_offset(path, serial_number)
+        with open(path, 'r+b' if offset else 'wb') as f:
+            f.truncate(offset)
+            f.seek(offset)
+            for n, (address, data) in enumerate(self.chunks(offset), 1):
+                f.write(data)
+                offset = address + len(data)
+                if n % self.checkpoint_every == 0:
+                    self._checkpoint(f, path, offset, serial_number)
+                if progress:
+                    progress(offset, self.size)
+            self._checkpoint(f, path, offset, serial_number)
+        if offset >= self.size:
+            os.remove(checkpoint_path(path))
+            return True
+        return False
+    def _resume_offset(self, path: str, serial_number: str) -> int:
+        try:
+            with open(checkpoint_path(path)) as f:
+                checkpoint = json.load(f)
+        except (OSError, ValueError):
+            return 0
+        if checkpoint.get('serial') != serial_number or checkpoint.get('size') != self.size:
+            return 0 # another device or flash layout
+        if not os.path.exists(path):
+            return 0
+        offset = min(checkpoint['offset'], os.path.getsize(path))
+        return offset - offset % self.chunk_size # restart on a chunk boundary
+    def _checkpoint(self, f, path: str, offset: int, serial_number: str):
+        """Flushes the data and atomically records how much of it is on disk
+        """
+        f.flush()
+        os.fsync(f.fileno())
+        temp = checkpoint_path(path) + '.tmp'
+        with open(temp, 'w') as c:
+            json.dump({'offset': offset, 'size': self.size, 'serial': serial_number}, c)
+        os.replace(temp, checkpoint_path(path))
+def checkpoint_path(path: str) -> str:
+    return path + '.checkpoint'
+def parse_history(data, default_start: datetime = None):
+    """Yields HistorySample(timestamp, count, mode) from raw history flash
+
+    Records are count bytes between tags:
+        55 AA 00 YY MM DD HH MM SS 55 AA DD   date stamp and save mode DD
+        55 AA 01 DH DL                        two byte count
+        55 AA 02 LL <LL ASCII bytes>          note, skipped
+        55 AA 03 B2 B1 B0 / 55 AA 04 B3..B0   three / four byte count
+    Runs of erased 0xFF bytes are unused flash and are skipped. Records before the
+    first date stamp have no time and are skipped, unless <default_start> is given:
+    they are then timestamped from it in DEFAULT_MODE.
+    """
+    find = data.find if hasattr(data, 'find') else bytes(data).find
+    with memoryview(data) as view:
+        yield from _parse(view, find, default_start)
+def _parse(data, find, timestamp):
+    size = len(data)
+    mode = DEFAULT_MODE if timestamp else None
+    interval = SAVE_MODES[mode][1] if timestamp else None
+    pos = 0
+    while pos < size:
+        byte = data[pos]
+        if byte == 0x55 and data[pos+1:pos+2] == b'\xAA' and pos + 2 < size:
+            tag = data[pos+2]
+            if tag == 0x00 and pos + 12 <= size:
+                yy, mm, dd, hh, mi, ss = data[pos+3:pos+9]
+                try:
+                    timestamp = datetime(2000 + yy, mm, dd, hh, mi, ss)
+                except ValueError:
+                    timestamp = None # corrupt stamp, wait for the next one
+                mode = data[pos+11]
+                interval = SAVE_MODES.get(mode, (None, None))[1]
+                pos += 12
+                continue
+            if tag in (0x01, 0x03, 0x04):
+                width = 2 if tag == 0x01 else (3 if tag == 0x03 else 4)
+                count = int.from_bytes(data[pos+3:pos+3+width], byteorder='big')
+                pos += 3 + width
+                if timestamp and interval:
+                    yield HistorySample(timestamp, count, SAVE_MODES[mode][0])
+                    timestamp += timedelta(seconds=interval)
+                continue
+            if tag == 0x02 and pos + 3 < size:
+                pos += 4 + data[pos+3]
+                continue
+        if byte == EMPTY_BYTE and bytes(data[pos:pos+EMPTY_RUN]) == b'\xFF'*EMPTY_RUN:
+            next_tag = find(TAG, pos) # jump over unused flash
+            if next_tag < 0:
+                return
+            pos = next_tag
+            continue
+        if timestamp and interval:
+            yield HistorySample(timestamp, byte, SAVE_MODES[mode][0])
+            timestamp += timedelta(seconds=interval)
+        pos += 1
+def parse_history_file(path: str, default_start: datetime = None):
+    """Parses a downloaded history file through an mmap instead of loading it
+    """
+    with open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+            yield from parse_history(m, default_start)
@@ -0,0 +1,84 @@
+"""Columnar log of timed counts
+
+CountLog keeps one array per column instead of a dict per run, so an entry costs
+a few bytes and exports write whole column slices at a time. The binary format
+is a small JSON header followed by the raw column arrays.
+"""
+import csv, json, struct, sys
+from array import array
+
+BINARY_MAGIC = b'GMCLOG1\n'
+EXPORT_CHUNK = 65536 # rows per CSV write
+
+class CountLog:
+    """Log of timed count results stored as typed arrays
+
+    COLUMNS lists (name, array typecode, CSV header) for every column.
+    """
+    COLUMNS = (('total_count', 'Q', 'Total Counts'),
+               ('duration', 'Q', 'Duration (seconds)'),
+               ('missed', 'Q', 'Missed Samples'),
+               ('voltage', 'd', 'Tube Voltage (%)'))
+    def __init__(self):
+        self.columns = {name: array(typecode) for name, typecode, header in self.COLUMNS}
+    def __len__(self):
+        return len(self.columns[self.COLUMNS[0][0]])
+    def append(self, log: dict):
+        """Appends one entry, <log> maps column names to values
+        """
+        for name, column in self.columns.items():
+            column.append(log.get(name, 0))
+    def row(self, index: int) -> dict:
+        return {name: column[index] for name, column in self.columns.items()}
+    def value(self, index: int, column: int):
+        return self.columns[self.COLUMNS[column][0]][index]
+    def pop(self) -> dict:
+        """Removes and returns the last entry
+        """
+        return {name: column.pop() for name, column in self.columns.items()}
+    def clear(self):
+        for column in self.columns.values():
+            del column[:]
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self.row(index)
+    def export_csv(self, filename: str):
+        """Writes the log as CSV, EXPORT_CHUNK rows at a time
+        """
+        columns = [self.columns[name] for name, typecode, header in self.COLUMNS]
+        with open(filename, 'w', newline='') as f:
+            wr = csv.writer(f)
+            wr.writerow(['#'] + [header for name, typecode, header in self.COLUMNS])
+            for start in range(0, len(self), EXPORT_CHUNK):
+                end = min(start + EXPORT_CHUNK, len(self))
+                wr.writerows(zip(range(start + 1, end + 1), *(column[start:end] for column in columns)))
+    def export_binary(self, filename: str):
+        """Writes the log as a JSON header followed by the raw column arrays
+        """
+        header = json.dumps({'rows': len(self), 'byteorder': sys.byteorder,
+                             'columns': [[name, typecode, array(typecode).itemsize]
+                                         for name, typecode, title in self.COLUMNS]}).encode()
+        with open(filename, 'wb') as f:
+            f.write(BINARY_MAGIC + struct.pack('<I', len(header)) + header)
+            for name, typecode, title in self.COLUMNS:
+                self.columns[name].tofile(f)
+    @classmethod
+    def load_binary(cls, filename: str):
+        log = cls()
+        rows = 0
+        with open(filename, 'rb') as f:
+            if f.read(len(BINARY_MAGIC)) != BINARY_MAGIC:
+                raise ValueError(f"{filename} is not a binary count log")
+            header = json.loads(f.read(struct.unpack('<I', f.read(4))[0]))
+            rows = header['rows']
+            for name, typecode, itemsize in header['columns']:
+                column = array(typecode)
+                column.fromfile(f, header['rows'])
+                if header['byteorder'] != sys.byteorder:
+                    column.byteswap()
+                if name in log.columns:
+                    log.columns[name] = column
+        for name, column in log.columns.items():
+            if len(column) < rows:
+                column.extend(array(column.typecode, bytes(column.itemsize*(rows - len(column))))) # written before the column existed
+        return log
@@ -0,0 +1,185 @@
+"""Counts of unbounded duration with crash-safe checkpoints
+
+LongRun counts for any number of device seconds in constant memory: samples pass
+through a HeartbeatStream's fixed ring and RollingStats' fixed windows, and only
+the running totals grow. Every CHECKPOINT_INTERVAL seconds the totals and the
+partial statistics are written atomically to a small JSON checkpoint. After a
+crash or a USB replug, LongRun.resume carries on from the checkpoint with the
+same totals instead of starting again; the time the counter was away is kept
+as <offline> and not counted. read_checkpoint gives any other program the
+partial results of a count that is still running.
+
+A checkpoint is <complete> once the duration is reached and <stopped> when the
+run was stopped on purpose; find_unfinished offers neither for resuming.
+"""
+import json, os, time
+from GMC_acquisition import HeartbeatStream
+from GMC_stats import RollingStats, conversion_factor
+
+CHECKPOINT_INTERVAL = 60 # seconds between checkpoints
+RECONNECT_INTERVAL = 5 # seconds between attempts to find a replugged counter
+CHECKPOINT_VERSION = 1
+
+def read_checkpoint(path: str) -> dict:
+    with open(path) as f:
+        return json.load(f)
+def write_checkpoint(path: str, state: dict):
+    """Replaces <path> atomically, a crash leaves the old or the new checkpoint
+    """
+    temp = path + '.tmp'
+    with open(temp, 'w') as f:
+        json.dump(state, f, indent=1)
+    os.replace(temp, path)
+def abandon(path: str):
+    """Marks the run checkpointed at <path> stopped, so it is not offered for resuming
+    """
+    state = read_checkpoint(path)
+    state['stopped'] = True
+    write_checkpoint(path, state)
+def checkpoint_name(directory: str, serial_number: str) -> str:
+    """A new checkpoint path in <directory> for a run on <serial_number>, named by the current time
+    """
+    os.makedirs(directory, exist_ok=True)
+    return os.path.join(directory, f"{serial_number}-{time.strftime('%Y%m%d-%H%M%S')}.json")
+def find_unfinished(directory: str, serial_number: str) -> str:
+    """The newest checkpoint in <directory> of a run on <serial_number> that did not finish, or None
+    """
+    try:
+        names = sorted((n for n in os.listdir(directory) if n.startswith(serial_number + '-') and n.endswith('.json')),
+                       reverse=True)
+    except OSError:
+        return None
+    for name in names:
+        path = os.path.join(directory, name)
+        try:
+            state = read_checkpoint(path)
+        except (OSError, ValueError):
+            continue # damaged
+        if not state.get('complete') and not state.get('stopped'):
+            return path
+    return None
+class LongRun:
+    """Counts <duration> device seconds on a GMCDevice, or until stop() when None
+
+    <callbacks> are passed on to every HeartbeatStream the run uses, <service>
+    is the stream's service (see GMC_scheduler). Checkpoints go to <path> when given.
+    """
+    def __init__(self, device, duration: int = None, path: str = None, serial_number: str = '',
+                 ring = None, service = None, interval: float = CHECKPOINT_INTERVAL):
+        self.device = device
+        self.duration = duration
+        self.path = path
+        self.serial_number = serial_number
+        self.ring = ring
+        self.service = service
+        self.interval = interval
+        self.callbacks = []
+        self.stats = RollingStats(factor=conversion_factor(device.model))
+        self.counts = 0
+        self.seconds = 0 # device seconds elapsed, lost samples included
+        self.missed = 0
+        self.offline = 0.0 # seconds the counter was unplugged or the program was down
+        self.started = time.time()
+        self.updated = None # wall time of the latest sample
+        self.resumes = 0
+        self.complete = False
+        self.stopped = False
+        self.stream = None
+        self.stop_flag = False
+        self._base = (0, 0) # seconds and missed before the current stream
+        self._saved = time.monotonic()
+    @classmethod
+    def resume(cls, path: str, device, serial_number: str = '', **kwargs):
+        """Continues the run checkpointed at <path> on <device>, also after it was stopped
+        """
+        state = read_checkpoint(path)
+        if state.get('complete'):
+            raise ValueError(f"{path}: the run is already complete")
+        if serial_number and state.get('serial') and state['serial'] != serial_number:
+            raise ValueError(f"{path} is a run on {state['serial']}, not {serial_number}")
+        run = cls(device, state['duration'], path, serial_number or state.get('serial', ''), **kwargs)
+        run.counts, run.seconds, run.missed = state['counts'], state['seconds'], state['missed']
+        run.offline, run.started, run.updated = state['offline'], state['started'], state['updated']
+        run.resumes = state['resumes'] + 1
+        run.stats.run_counts = run.counts
+        run.stats.run_seconds = run.seconds - run.missed # samples actually counted
+        return run
+    @property
+    def remaining(self) -> int:
+        return None if self.duration is None else max(0, self.duration - self.seconds)
+    def _sample(self, timestamp: float, count: int):
+        clock = self.stream.clock
+        self.counts += count
+        self.seconds = self._base[0] + clock.ticks
+        self.missed = self._base[1] + clock.missed
+        self.updated = clock.wall(timestamp)
+        self.stats.update(count)
+        if self.path and time.monotonic() - self._saved >= self.interval:
+            self.save()
+    def _stream(self):
+        """Streams on the current device until the run is done, stopped or the port fails
+        """
+        if self.updated is not None: # carrying on after a gap
+            self.offline += max(0.0, time.time() - self.updated - 1)
+        self._base = (self.seconds, self.missed)
+        self.stream = HeartbeatStream(self.device, self.ring)
+        self.stream.service = self.service
+        self.stream.callbacks = [self._sample] + self.callbacks
+        if self.stop_flag: # stopped before the stream existed
+            return
+        self.stream.run(self.remaining)
+    def run(self, reconnect = None) -> dict:
+        """Counts until the duration is reached or stop() is called, returns snapshot()
+
+        Without <reconnect> a port error ends the run with a checkpoint saved, ready
+        to resume. With it, reconnect() is called every RECONNECT_INTERVAL seconds
+        until it returns a new GMCDevice for the same counter, and the run goes on.
+        """
+        self.stop_flag = False
+        try:
+            while not self.stop_flag and not self.complete:
+                try:
+                    self._stream()
+                except OSError:
+                    self.save()
+                    if reconnect is None:
+                        raise
+                    self.device = self._reconnect(reconnect)
+                    if self.device is None:
+                        break # stopped while waiting
+                    self.resumes += 1
+                    continue
+                self.complete = self.duration is not None and self.seconds >= self.duration
+        finally:
+            self.save()
+        return self.snapshot()
+    def _reconnect(self, reconnect):
+        while not self.stop_flag:
+            time.sleep(RECONNECT_INTERVAL)
+            try:
+                device = reconnect()
+            except OSError:
+                device = None
+            if device is not None:
+                return device
+        return None
+    def stop(self):
+        self.stop_flag = True
+        self.stopped = True
+        if self.stream:
+            self.stream.stop()
+    def snapshot(self) -> dict:
+        """Totals and partial statistics of the run so far, as written to the checkpoint
+        """
+        return {'version': CHECKPOINT_VERSION, 'serial': self.serial_number, 'port': self.device.name,
+                'model': self.device.model, 'duration': self.duration, 'counts': self.counts,
+                'seconds': self.seconds, 'missed': self.missed, 'offline': round(self.offline, 3),
+                'started': self.started, 'updated': self.updated, 'resumes': self.resumes,
+                'complete': self.complete, 'stopped': self.stopped, 'run': self.stats.run(),
+                'windows': {str(size): stats for size, stats in self.stats.snapshot().items() if size != 'run'}}
+    def save(self):
+        """Atomically replaces the checkpoint
+        """
+        self._saved = time.monotonic()
+        if self.path:
+            write_checkpoint(self.path, self.snapshot())
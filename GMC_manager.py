@@ -0,0 +1,140 @@
+"""Concurrent acquisition from several GQ GMC Geiger counters in one process
+
+DeviceManager opens any number of ports and runs their heartbeat streams on a
+small pool of reader threads (one by default), not one thread per device. On
+POSIX the readers sleep in a selector until a port has data; elsewhere they poll
+every port in turn. Every sample goes into its device's SampleRing and into one
+merged, timestamped stream.
+"""
+import queue, selectors, threading, time
+from collections import deque, namedtuple
+from GMC_acquisition import DEFAULT_CAPACITY, POLL_TIME, SampleRing
+from GMC_device import GMCDevice
+from GMC_timing import SampleClock
+
+IDLE_TIME = 0.02 # pause between polling rounds when ports can not be selected
+
+MergedSample = namedtuple('MergedSample', 'timestamp device count flags', defaults=(0,))
+
+class DeviceManager:
+    """Owns a set of GMCDevices and streams their heartbeats concurrently
+
+    Devices are keyed by port name. While streaming, the manager's readers are the
+    only ones reading the ports, so nothing else should send commands.
+    """
+    def __init__(self, workers: int = 1, capacity: int = DEFAULT_CAPACITY):
+        self.workers = workers
+        self.capacity = capacity
+        self.devices = {} # name -> GMCDevice
+        self.rings = {} # name -> SampleRing
+        self.clocks = {} # name -> SampleClock giving samples their event times
+        self.errors = {} # name -> exception that stopped the device
+        self.samples = deque(maxlen=capacity) # merged MergedSample stream, oldest dropped when full
+        self._ready = threading.Condition()
+        self.callbacks = [] # callback(timestamp, name, count) for every sample
+        self.stop_flag = False
+        self.threads = []
+    def open(self, port_name: str) -> GMCDevice:
+        """Opens a port, identifies the counter on it and adds it to the manager
+        """
+        device = GMCDevice.open(port_name)
+        device.get_version()
+        return self.add(device)
+    def add(self, device: GMCDevice) -> GMCDevice:
+        self.devices[device.name] = device
+        self.rings[device.name] = SampleRing(self.capacity)
+        self.clocks[device.name] = SampleClock()
+        return device
+    def close(self, name: str):
+        device = self.devices.pop(name)
+        self.rings.pop(name, None)
+        self.clocks.pop(name, None)
+        device.close()
+    def close_all(self):
+        self.stop()
+        for name in list(self.devices):
+            self.close(name)
+    @property
+    def streaming(self) -> bool:
+        return any(thread.is_alive() for thread in self.threads)
+    def start(self):
+        """Turns the heartbeat on for every device and starts the reader threads
+        """
+        self.stop_flag = False
+        self.errors.clear()
+        names = list(self.devices)
+        for name in names:
+            clock = self.clocks[name]
+            self.clocks[name] = SampleClock(clock.interval, clock.period) # a new schedule, same drift
+            self.devices[name].start_heartbeat()
+        shards = [names[i::self.workers] for i in range(self.workers)]
+        self.threads = [threading.Thread(target=self._reader, args=(shard,), daemon=True)
+                        for shard in shards if shard]
+        for thread in self.threads:
+            thread.start()
+    def stop(self):
+        """Stops the readers and turns every heartbeat off
+        """
+        self.stop_flag = True
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+        for name, device in self.devices.items():
+            if name not in self.errors:
+                device.stop_heartbeat()
+    def get(self, timeout: float = None) -> MergedSample:
+        """Next sample of the merged stream, raises queue.Empty after <timeout>
+        """
+        with self._ready:
+            if not self._ready.wait_for(lambda: self.samples, timeout):
+                raise queue.Empty
+            return self.samples.popleft()
+    def _reader(self, names: list):
+        devices = [self.devices[name] for name in names]
+        try:
+            selector = selectors.DefaultSelector()
+            for device in devices:
+                selector.register(device.port.fileno(), selectors.EVENT_READ, device)
+        except (AttributeError, OSError, ValueError):
+            selector = None # ports without a selectable file descriptor
+        active = list(devices)
+        while active and not self.stop_flag:
+            if selector:
+                ready = [key.data for key, events in selector.select(POLL_TIME)]
+            else:
+                ready = active
+            timestamp = time.monotonic()
+            idle = True
+            for device in ready:
+                try:
+                    waiting = device.port.in_waiting
+                    data = device.read(waiting, 0) if waiting else b''
+                except OSError as error:
+                    self.errors[device.name] = error # only this device stops
+                    active.remove(device)
+                    if selector:
+                        selector.unregister(device.port.fileno())
+                    continue
+                if data:
+                    idle = False
+                    self._deliver(timestamp, device, device.feed_heartbeat(data))
+            if not selector and idle:
+                time.sleep(IDLE_TIME)
+        if selector:
+            selector.close()
+    def _deliver(self, arrival: float, device: GMCDevice, counts: list):
+        ring = self.rings[device.name]
+        clock = self.clocks[device.name]
+        metrics = device.metrics
+        waiting = device.heartbeat_backlog() + len(counts) # samples read together are a backlog
+        for count in counts:
+            waiting -= 1
+            timestamp, flags, missed = clock.stamp(arrival, waiting)
+            ring.append(timestamp, count)
+            if metrics is not None:
+                metrics.heartbeat(arrival)
+            with self._ready:
+                self.samples.append(MergedSample(timestamp, device.name, count, flags))
+                self._ready.notify()
+            for callback in self.callbacks:
+                callback(timestamp, device.name, count)
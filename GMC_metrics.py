@@ -0,0 +1,193 @@
+"""Per-device I/O instrumentation with a Prometheus text endpoint
+
+A GMCDevice with a DeviceMetrics attached in its <metrics> attribute records
+command latency histograms, bytes in and out, timeouts, bad acks and heartbeat
+timing. Recording is a few integer additions per call, so metrics can stay on;
+a device without metrics pays one `is None` check.
+
+Read the figures in process with registry.snapshot(), or over HTTP:
+    server = registry.serve(9354) # http://127.0.0.1:9354/metrics
+"""
+import bisect, threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5) # seconds
+HEARTBEAT_INTERVAL = 1.0 # seconds between heartbeat samples
+LATE_FACTOR = 1.25 # a sample later than this many intervals is late
+DEFAULT_PORT = 9354
+
+class Histogram:
+    """Fixed bucket histogram, observe() is a bisect and two additions
+    """
+    def __init__(self, buckets: tuple = LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0]*(len(buckets) + 1) # last one is +Inf
+        self.sum = 0.0
+        self.count = 0
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+    def cumulative(self) -> list:
+        """(upper bound, observations <= bound) for every bucket, ending with +Inf
+        """
+        total = 0
+        result = []
+        for bound, count in zip(self.buckets + (float('inf'),), self.counts):
+            total += count
+            result.append((bound, total))
+        return result
+    def quantile(self, q: float) -> float:
+        """Upper bound of the bucket holding the <q> quantile
+        """
+        rank = q*self.count
+        for bound, total in self.cumulative():
+            if total >= rank and total:
+                return bound
+        return 0.0
+class DeviceMetrics:
+    """Counters of one device, updated from its I/O thread
+
+    The I/O thread adds commands to <latency> and <timeouts> at any time, so readers
+    on other threads iterate over a copy (list() of a dict is atomic under the GIL).
+    """
+    def __init__(self, name: str, heartbeat_interval: float = HEARTBEAT_INTERVAL):
+        self.name = name
+        self.heartbeat_interval = heartbeat_interval
+        self.latency = {} # command name: Histogram
+        self.timeouts = {} # command name: count
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.bad_acks = 0
+        self.heartbeats = 0
+        self.missed_heartbeats = 0
+        self.late_heartbeats = 0
+        self.last_heartbeat = None # time.monotonic() of the previous sample
+        self.signals_queued = 0 # GUI signals emitted
+        self.signals_delivered = 0 # GUI signals handled by their slot
+        self.max_queue_depth = 0
+    def command(self, name: str, seconds: float):
+        histogram = self.latency.get(name)
+        if histogram is None:
+            histogram = self.latency[name] = Histogram()
+        histogram.observe(seconds)
+    def timeout(self, name: str):
+        self.timeouts[name] = self.timeouts.get(name, 0) + 1
+    def heartbeat(self, timestamp: float):
+        """Records a heartbeat sample stamped with time.monotonic()
+        """
+        last = self.last_heartbeat
+        self.last_heartbeat = timestamp
+        self.heartbeats += 1
+        if last is None:
+            return
+        intervals = (timestamp - last)/self.heartbeat_interval
+        if intervals > LATE_FACTOR:
+            self.late_heartbeats += 1
+            self.missed_heartbeats += max(0, round(intervals) - 1)
+    def heartbeat_stopped(self):
+        self.last_heartbeat = None # the gap until the next stream is not a miss
+    def signal_queued(self):
+        self.signals_queued += 1
+        depth = self.signals_queued - self.signals_delivered
+        if depth > self.max_queue_depth:
+            self.max_queue_depth = depth
+    def signal_delivered(self):
+        self.signals_delivered += 1
+    @property
+    def queue_depth(self) -> int:
+        return self.signals_queued - self.signals_delivered
+    def snapshot(self) -> dict:
+        """Plain dict of every figure, with p50/p99 latency estimates per command
+        """
+        return {'bytes_in': self.bytes_in, 'bytes_out': self.bytes_out, 'bad_acks': self.bad_acks,
+                'timeouts': dict(self.timeouts), 'heartbeats': self.heartbeats,
+                'missed_heartbeats': self.missed_heartbeats, 'late_heartbeats': self.late_heartbeats,
+                'queue_depth': self.queue_depth, 'max_queue_depth': self.max_queue_depth,
+                'commands': {name: {'count': h.count, 'sum': h.sum, 'p50': h.quantile(0.5), 'p99': h.quantile(0.99)}
+                             for name, h in list(self.latency.items())}}
+def _label(value: str) -> str:
+    return str(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
+def _bound(bound: float) -> str:
+    return '+Inf' if bound == float('inf') else repr(bound)
+class MetricsRegistry:
+    """All DeviceMetrics of the process, keyed by device name
+    """
+    def __init__(self):
+        self.devices = {}
+        self._lock = threading.Lock()
+    def device(self, name: str) -> DeviceMetrics:
+        with self._lock:
+            metrics = self.devices.get(name)
+            if metrics is None:
+                metrics = self.devices[name] = DeviceMetrics(name)
+            return metrics
+    def attach(self, device) -> DeviceMetrics:
+        """Starts recording the I/O of a GMCDevice
+        """
+        device.metrics = self.device(device.name)
+        return device.metrics
+    def snapshot(self) -> dict:
+        with self._lock:
+            devices = list(self.devices.values())
+        return {metrics.name: metrics.snapshot() for metrics in devices}
+    def render(self) -> str:
+        """Prometheus text exposition format (version 0.0.4)
+        """
+        with self._lock:
+            devices = list(self.devices.values())
+        lines = []
+        def family(name, kind, help_text, samples):
+            lines.append(f'# HELP {name} {help_text}')
+            lines.append(f'# TYPE {name} {kind}')
+            for suffix, labels, value in samples:
+                text = ','.join(f'{k}="{_label(v)}"' for k, v in labels)
+                lines.append(f'{name}{suffix}{{{text}}} {value}')
+        latency = []
+        for m in devices:
+            for command, h in sorted(list(m.latency.items())):
+                labels = (('device', m.name), ('command', command))
+                latency += [('_bucket', labels + (('le', _bound(b)),), n) for b, n in h.cumulative()]
+                latency += [('_sum', labels, h.sum), ('_count', labels, h.count)]
+        family('gmc_command_latency_seconds', 'histogram', "Time from request to complete response", latency)
+        family('gmc_bytes_in_total', 'counter', "Bytes read from the device",
+               [('', (('device', m.name),), m.bytes_in) for m in devices])
+        family('gmc_bytes_out_total', 'counter', "Bytes written to the device",
+               [('', (('device', m.name),), m.bytes_out) for m in devices])
+        family('gmc_timeouts_total', 'counter', "Responses that did not arrive in full before their deadline",
+               [('', (('device', m.name), ('command', c)), n) for m in devices for c, n in sorted(list(m.timeouts.items()))])
+        family('gmc_bad_acks_total', 'counter', "Acks that were not 0xAA",
+               [('', (('device', m.name),), m.bad_acks) for m in devices])
+        family('gmc_heartbeats_total', 'counter', "Heartbeat samples received",
+               [('', (('device', m.name),), m.heartbeats) for m in devices])
+        family('gmc_heartbeats_missed_total', 'counter', "Heartbeat samples that never arrived",
+               [('', (('device', m.name),), m.missed_heartbeats) for m in devices])
+        family('gmc_heartbeats_late_total', 'counter', "Heartbeat samples that arrived late",
+               [('', (('device', m.name),), m.late_heartbeats) for m in devices])
+        family('gmc_signal_queue_depth', 'gauge', "GUI signals emitted but not yet handled",
+               [('', (('device', m.name),), m.queue_depth) for m in devices])
+        family('gmc_signal_queue_depth_max', 'gauge', "Highest GUI signal queue depth seen",
+               [('', (('device', m.name),), m.max_queue_depth) for m in devices])
+        return '\n'.join(lines) + '\n'
+    def serve(self, port: int = DEFAULT_PORT, host: str = '127.0.0.1') -> ThreadingHTTPServer:
+        """Serves /metrics on a daemon thread, stop it with server.shutdown()
+        """
+        registry = self
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] not in ('/', '/metrics'):
+                    self.send_error(404)
+                    return
+                body = registry.render().encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+            def log_message(self, format, *args):
+                pass # scrapes are not worth a line on stderr each
+        server = ThreadingHTTPServer((host, port), Handler)
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        return server
+registry = MetricsRegistry()
@@ -0,0 +1,141 @@
+"""Multi-resolution min/max/mean decimation for plotting long sample series
+
+SeriesPyramid keeps every sample and above them levels of buckets, each level
+FACTOR times coarser than the one below, holding the first timestamp, min, max
+and sum of its samples. A view is reduced to one (min, max, mean) per pixel
+column from the coarsest level whose buckets are still no wider than a column,
+so drawing 10 days costs about as much as drawing 10 seconds: a few buckets per
+column, whatever the span. An append updates the newest bucket of every level,
+so the pyramid is always complete up to the latest sample.
+"""
+from array import array
+from bisect import bisect_left
+
+FACTOR = 4 # samples per bucket of the level below
+TOP_BUCKETS = 64 # a level is added once the top level holds more buckets than this
+
+class Level:
+    """Buckets of <span> samples
+    """
+    def __init__(self, span: int):
+        self.span = span
+        self.times = array('d') # timestamp of each bucket's first sample
+        self.mins = array('d')
+        self.maxs = array('d')
+        self.sums = array('d')
+        self.counts = array('I') # samples in each bucket, <span> except in the newest
+    def __len__(self):
+        return len(self.times)
+    def add(self, timestamp: float, value: float):
+        """Adds a sample to the newest bucket, starting a new one when it is full
+        """
+        if not self.counts or self.counts[-1] >= self.span:
+            self.times.append(timestamp)
+            self.mins.append(value)
+            self.maxs.append(value)
+            self.sums.append(value)
+            self.counts.append(1)
+            return
+        if value < self.mins[-1]:
+            self.mins[-1] = value
+        if value > self.maxs[-1]:
+            self.maxs[-1] = value
+        self.sums[-1] += value
+        self.counts[-1] += 1
+class SeriesPyramid:
+    """All samples of one series and the min/max/mean levels above them
+    """
+    def __init__(self, factor: int = FACTOR):
+        self.factor = factor
+        self.times = array('d')
+        self.values = array('d')
+        self.levels = [] # levels[k] has buckets of factor**(k+1) samples
+    def __len__(self):
+        return len(self.times)
+    @property
+    def first(self) -> float:
+        return self.times[0] if self.times else None
+    @property
+    def last(self) -> float:
+        return self.times[-1] if self.times else None
+    def append(self, timestamp: float, value: float):
+        """Adds a sample, timestamps must not decrease
+        """
+        self.times.append(timestamp)
+        self.values.append(value)
+        for level in self.levels:
+            level.add(timestamp, value)
+        top = self.levels[-1] if self.levels else None
+        if len(top if top is not None else self.times) > TOP_BUCKETS:
+            self._add_level()
+    def extend(self, times, values):
+        for timestamp, value in zip(times, values):
+            self.append(timestamp, value)
+    def _add_level(self):
+        """Builds a level one FACTOR coarser than the current top from the top's buckets
+        """
+        span = self.factor**(len(self.levels) + 1)
+        level = Level(span)
+        if not self.levels:
+            for timestamp, value in zip(self.times, self.values):
+                level.add(timestamp, value)
+        else:
+            below = self.levels[-1]
+            for i in range(0, len(below), self.factor):
+                j = min(i + self.factor, len(below))
+                level.times.append(below.times[i])
+                level.mins.append(min(below.mins[i:j]))
+                level.maxs.append(max(below.maxs[i:j]))
+                level.sums.append(sum(below.sums[i:j]))
+                level.counts.append(sum(below.counts[i:j]))
+        self.levels.append(level)
+    def interval(self) -> float:
+        """Mean time between samples
+        """
+        if len(self.times) < 2:
+            return 1.0
+        return (self.times[-1] - self.times[0])/(len(self.times) - 1) or 1.0
+    def columns(self, start: float, end: float, n: int) -> list:
+        """(column, min, max, mean) of every one of <n> equal columns from <start> to <end> that has samples
+
+        A bucket is put in the column its first sample falls in.
+        """
+        if n <= 0 or end <= start or not self.times:
+            return []
+        width = (end - start)/n
+        k = 0 # coarsest level whose buckets are no wider than a column
+        interval = self.interval()
+        while k < len(self.levels) and self.levels[k].span*interval <= width:
+            k += 1
+        if k == 0:
+            times, mins, maxs, sums, counts = self.times, self.values, self.values, self.values, None
+        else:
+            level = self.levels[k - 1]
+            times, mins, maxs, sums, counts = level.times, level.mins, level.maxs, level.sums, level.counts
+        result = []
+        column = -1
+        low = high = total = 0.0
+        samples = 0
+        for i in range(bisect_left(times, start), bisect_left(times, end)):
+            c = int((times[i] - start)/width)
+            if c != column:
+                if samples:
+                    result.append((column, low, high, total/samples))
+                column, low, high, total, samples = c, mins[i], maxs[i], 0.0, 0
+            else:
+                if mins[i] < low:
+                    low = mins[i]
+                if maxs[i] > high:
+                    high = maxs[i]
+            total += sums[i]
+            samples += counts[i] if counts is not None else 1
+        if samples:
+            result.append((column, low, high, total/samples))
+        return result
+    def value_range(self, start: float, end: float) -> tuple:
+        """(min, max) of the samples from <start> to <end>, or None if there are none
+        """
+        columns = self.columns(start, end, TOP_BUCKETS)
+        if not columns:
+            return None
+        return min(c[1] for c in columns), max(c[2] for c in columns)
@@ -0,0 +1,338 @@
+"""Local proxy sharing one counter between several programs
+
+SerialProxy owns the counter's port. It runs the only heartbeat stream and fans
+every sample out to any number of clients on a Unix socket, or a TCP socket on
+127.0.0.1 where Unix sockets are not available. Commands from clients go
+through the device's CommandScheduler, the one queue for the port, and run
+between two samples, so clients never touch the heartbeat state.
+
+There is no authentication, so by default a TCP socket is only bound to the
+loopback interface and clients may only run the read commands in READ_COMMANDS.
+allow_remote serves other hosts and allow_writes passes every other command on
+too, configuration writes, FACTORYRESET and POWEROFF included.
+
+The protocol is one JSON object per line, so a client can be written in anything:
+    proxy -> client  {"type": "hello", "port": ..., "version": ..., "serial": ...}
+                     {"type": "sample", "time": <seconds since the epoch>, "count": n, "flags": f}
+                     {"type": "reply", "id": ..., "data": <hex>}, or "error": <message> instead of "data"
+    client -> proxy  {"id": ..., "command": "GETCPM", "params": <hex>, "response_size": n}
+                     "params" and "response_size" only where the command needs them: SPIR
+                     reads the length from its params, and "response_size" is only taken for
+                     a command GMCDevice does not know
+                     {"subscribe": false} stops the samples, true starts them again
+Samples are encoded once for all clients. A client that reads too slowly loses
+samples instead of holding up the others; replies are never dropped.
+"""
+import ipaddress, itertools, json, os, queue, socket, socketserver, tempfile, threading
+from concurrent.futures import Future
+from GMC_acquisition import HeartbeatStream
+from GMC_device import GMCError, MAX_SPIR_LENGTH
+from GMC_scheduler import CommandScheduler, PRIORITY_LOW, PRIORITY_NORMAL
+
+DEFAULT_TCP_PORT = 9355
+CLIENT_BACKLOG = 1024 # samples queued for a client before its samples are dropped
+REFUSED_COMMANDS = ('HEARTBEAT0', 'HEARTBEAT1') # the proxy's stream owns the heartbeat
+READ_COMMANDS = ('GETVER', 'GETCPM', 'GETVOLT', 'SPIR', 'GETCFG', 'GETSERIAL', 'GETDATETIME',
+                 'GETTEMP', 'GETGYRO') # all a client may run unless writes are allowed
+MAX_PARAMS = 16 # bytes of parameters from a client, SETDATETIME takes 6
+MAX_RESPONSE_SIZE = MAX_SPIR_LENGTH # of a command the proxy has no response length for
+
+def default_address():
+    """A socket path in the temp directory, or 127.0.0.1:DEFAULT_TCP_PORT without Unix sockets
+    """
+    if hasattr(socketserver, 'ThreadingUnixStreamServer'):
+        return os.path.join(tempfile.gettempdir(), 'gmc-proxy.sock')
+    return ('127.0.0.1', DEFAULT_TCP_PORT)
+def parse_address(text: str):
+    """'PORT' or 'HOST:PORT' for TCP, anything else is a socket path
+    """
+    if text is None:
+        return default_address()
+    if text.isdigit():
+        return ('127.0.0.1', int(text))
+    host, sep, port = text.rpartition(':')
+    if sep and host and port.isdigit():
+        return (host, int(port))
+    return text
+def is_loopback(host: str) -> bool:
+    if host == 'localhost':
+        return True
+    try:
+        return ipaddress.ip_address(host).is_loopback
+    except ValueError:
+        return False # a host name
+def encode(message: dict) -> bytes:
+    return json.dumps(message, separators=(',', ':')).encode() + b'\n'
+class Subscriber:
+    """A connected client and its queue of lines to send
+    """
+    def __init__(self):
+        self.queue = queue.Queue()
+        self.subscribed = True
+        self.dropped = 0 # samples lost because the client fell behind
+    def send(self, line: bytes, droppable: bool = False):
+        if droppable and self.queue.qsize() >= CLIENT_BACKLOG:
+            self.dropped += 1
+            return
+        self.queue.put(line)
+    def write_loop(self, wfile):
+        """Sends queued lines until close(), on the client's writer thread
+        """
+        while True:
+            line = self.queue.get()
+            if line is None:
+                return
+            try:
+                wfile.write(line)
+            except OSError:
+                return # gone, the reader notices too
+    def close(self):
+        self.queue.put(None)
+class ProxyHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        proxy = self.server.proxy
+        client = Subscriber()
+        writer = threading.Thread(target=client.write_loop, args=(self.wfile,), daemon=True)
+        writer.start()
+        client.send(proxy.hello)
+        proxy.add(client)
+        try:
+            for line in self.rfile:
+                proxy.request(client, line)
+        except OSError:
+            pass # connection reset
+        finally:
+            proxy.remove(client)
+            client.close()
+            writer.join(1)
+class SerialProxy:
+    """Serves the samples and commands of one GMCDevice to local clients at <address>
+
+    <allow_writes> passes on every command but the heartbeat ones, not just READ_COMMANDS,
+    <allow_remote> allows a TCP address that is not on the loopback interface
+    """
+    def __init__(self, device, address = None, ring = None, allow_writes: bool = False, allow_remote: bool = False):
+        self.device = device
+        self.address = address if address is not None else default_address()
+        self.allow_writes = allow_writes
+        self.allow_remote = allow_remote
+        self.scheduler = CommandScheduler(device)
+        self.stream = HeartbeatStream(device, ring)
+        self.stream.service = self.scheduler.service # client commands run between samples
+        self.stream.callbacks.append(self.publish)
+        self.clients = set()
+        self.lock = threading.Lock()
+        self.server = None
+        self.streaming = None # Future of the stream's run on the scheduler
+        self.hello = b''
+    def start(self, serial_number: str = ''):
+        """Starts serving and streaming, returns self
+        """
+        self.hello = encode({'type': 'hello', 'port': self.device.name, 'version': self.device.version,
+                             'serial': serial_number})
+        self.server = self._make_server()
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.scheduler.start()
+        self.streaming = self.scheduler.submit(self.stream.run, priority=PRIORITY_LOW)
+        return self
+    def _make_server(self):
+        if isinstance(self.address, str):
+            if os.path.exists(self.address):
+                probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                try:
+                    probe.connect(self.address)
+                except OSError:
+                    os.unlink(self.address) # left behind by a proxy that crashed
+                else:
+                    raise OSError(f"a proxy is already serving {self.address}")
+                finally:
+                    probe.close()
+            server = socketserver.ThreadingUnixStreamServer(self.address, ProxyHandler)
+        else:
+            if not self.allow_remote and not is_loopback(self.address[0]):
+                raise OSError(f"{self.address[0]} is not a loopback address, the proxy has no authentication")
+            socketserver.ThreadingTCPServer.allow_reuse_address = True
+            server = socketserver.ThreadingTCPServer(self.address, ProxyHandler)
+        server.daemon_threads = True
+        server.proxy = self
+        return server
+    def wait(self, timeout: float = None):
+        """Waits for the stream to end, raising its error if it failed
+        """
+        return self.streaming.result(timeout)
+    def add(self, client: Subscriber):
+        with self.lock:
+            self.clients.add(client)
+    def remove(self, client: Subscriber):
+        with self.lock:
+            self.clients.discard(client)
+    def publish(self, timestamp: float, count: int):
+        """Sends a sample to every subscribed client, called by the stream
+        """
+        clock = self.stream.clock
+        line = encode({'type': 'sample', 'time': round(clock.wall(timestamp), 6), 'count': count, 'flags': clock.flags})
+        with self.lock:
+            clients = list(self.clients)
+        for client in clients:
+            if client.subscribed:
+                client.send(line, droppable=True)
+    def request(self, client: Subscriber, line: bytes):
+        """Handles one line from a client
+        """
+        try:
+            message = json.loads(line)
+        except ValueError:
+            message = None
+        if not isinstance(message, dict):
+            client.send(encode({'type': 'reply', 'id': None, 'error': "not a JSON object"}))
+            return
+        if 'subscribe' in message:
+            client.subscribed = bool(message['subscribe'])
+        if 'command' not in message:
+            return
+        request_id = message.get('id')
+        name = str(message['command']).upper()
+        if name in REFUSED_COMMANDS:
+            client.send(encode({'type': 'reply', 'id': request_id, 'error': f"{name}: the proxy owns the heartbeat"}))
+            return
+        if name not in READ_COMMANDS and not self.allow_writes:
+            client.send(encode({'type': 'reply', 'id': request_id, 'error': f"{name}: the proxy only runs read commands"}))
+            return
+        try:
+            params, response_size = self._arguments(name, message)
+            future = self.scheduler.submit(self.device.command, name, params, response_size, priority=PRIORITY_NORMAL)
+        except (ValueError, RuntimeError) as e:
+            client.send(encode({'type': 'reply', 'id': request_id, 'error': str(e)}))
+            return
+        future.add_done_callback(lambda f: client.send(self._reply(request_id, f)))
+    def _arguments(self, name: str, message: dict) -> tuple:
+        """The checked (params, response_size) of a client's command, raises ValueError
+
+        A wrong response length would leave reply bytes to be read as heartbeat
+        samples, or hold the port for as long as a huge one takes, so commands the
+        device knows always get their own length.
+        """
+        params = message.get('params', '')
+        if not isinstance(params, str):
+            raise ValueError(f"{name}: params must be a hex string")
+        params = bytes.fromhex(params)
+        if len(params) > MAX_PARAMS:
+            raise ValueError(f"{name}: more than {MAX_PARAMS:d} bytes of params")
+        response_size = message.get('response_size')
+        if name == 'SPIR':
+            if len(params) != 5:
+                raise ValueError("SPIR: params are a 3 byte address and a 2 byte length")
+            length = int.from_bytes(params[3:], byteorder='big')
+            if not 0 < length <= MAX_SPIR_LENGTH:
+                raise ValueError(f"SPIR length must be 1-{MAX_SPIR_LENGTH:d}")
+            if response_size is not None and response_size != length:
+                raise ValueError("SPIR: the response size is the length in its params")
+            return params, length
+        if name in self.device.lengths:
+            known = self.device.lengths[name]
+            if response_size is not None and response_size != known:
+                raise ValueError(f"{name}: the response size is {known:d} bytes")
+            if name in READ_COMMANDS and params:
+                raise ValueError(f"{name} takes no params")
+            return params, known
+        if type(response_size) is not int or not 0 <= response_size <= MAX_RESPONSE_SIZE:
+            raise ValueError(f"{name} needs a response_size of 0-{MAX_RESPONSE_SIZE:d}")
+        return params, response_size
+    def _reply(self, request_id, future: Future) -> bytes:
+        error = future.exception()
+        if error is not None:
+            return encode({'type': 'reply', 'id': request_id, 'error': str(error)})
+        return encode({'type': 'reply', 'id': request_id, 'data': future.result().hex()})
+    def stop(self):
+        """Stops the stream and the server, the device is left open
+        """
+        self.stream.stop()
+        if self.streaming is not None:
+            try:
+                self.streaming.result(5)
+            except Exception:
+                pass # reported by wait()
+        self.scheduler.close(5)
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            if isinstance(self.address, str) and os.path.exists(self.address):
+                os.unlink(self.address)
+        with self.lock:
+            for client in self.clients:
+                client.close()
+class ProxyConnection:
+    """Client of a SerialProxy
+
+    Iterating yields (time, count, flags) samples until the connection closes;
+    command() can be called from any thread meanwhile.
+    """
+    def __init__(self, address = None, timeout: float = 5.0):
+        address = address if address is not None else default_address()
+        if isinstance(address, str):
+            self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.sock.settimeout(timeout)
+            self.sock.connect(address)
+        else:
+            self.sock = socket.create_connection(address, timeout)
+        self.rfile = self.sock.makefile('rb')
+        self.hello = json.loads(self.rfile.readline() or b'{}')
+        self.sock.settimeout(None) # samples may be far apart
+        self.timeout = timeout
+        self.samples = queue.Queue()
+        self.pending = {} # request id -> Future
+        self.lock = threading.Lock()
+        self._ids = itertools.count(1)
+        self.reader = threading.Thread(target=self._read, daemon=True)
+        self.reader.start()
+    def _read(self):
+        try:
+            for line in self.rfile:
+                message = json.loads(line)
+                if message.get('type') == 'sample':
+                    self.samples.put((message['time'], message['count'], message['flags']))
+                elif message.get('type') == 'reply':
+                    with self.lock:
+                        future = self.pending.pop(message.get('id'), None)
+                    if future is None:
+                        continue
+                    if 'error' in message:
+                        future.set_exception(GMCError(message['error']))
+                    else:
+                        future.set_result(bytes.fromhex(message['data']))
+        except (OSError, ValueError):
+            pass
+        finally:
+            self.samples.put(None)
+            with self.lock:
+                pending, self.pending = self.pending, {}
+            for future in pending.values():
+                future.set_exception(ConnectionError("proxy connection closed"))
+    def _send(self, message: dict):
+        self.sock.sendall(encode(message))
+    def command(self, name: str, params: bytes = b'', response_size: int = None) -> bytes:
+        """Runs a command on the proxy's counter and returns its response
+        """
+        request_id = next(self._ids)
+        future = Future()
+        with self.lock:
+            self.pending[request_id] = future
+        message = {'id': request_id, 'command': name, 'params': params.hex()}
+        if response_size is not None:
+            message['response_size'] = response_size
+        self._send(message)
+        return future.result(self.timeout)
+    def subscribe(self, subscribed: bool = True):
+        self._send({'subscribe': subscribed})
+    def __iter__(self):
+        while True:
+            sample = self.samples.get()
+            if sample is None:
+                return
+            yield sample
+    def close(self):
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.sock.close()
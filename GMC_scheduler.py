@@ -0,0 +1,99 @@
+"""Prioritised command scheduler, the single owner of a GMCDevice's port
+
+Every command for a device is submitted to its CommandScheduler and runs on the
+scheduler's one thread, highest priority (lowest number) first, returning a
+concurrent.futures.Future. A long job such as a timed count also runs there; a
+HeartbeatStream with its <service> set to the scheduler's service() lets queued
+commands through between two samples, pausing the heartbeat only as long as
+the commands take, so telemetry can be polled during a count.
+"""
+import itertools, queue, threading
+from concurrent.futures import Future
+
+PRIORITY_HIGH = 0 # user actions: config writes, resets
+PRIORITY_NORMAL = 10 # reads and telemetry polls
+PRIORITY_LOW = 20 # long jobs: counts, history downloads; never run from service()
+_CLOSE = float('inf') # sorts after every job
+
+class CommandScheduler:
+    """Runs the commands of one device on a single owner thread
+    """
+    def __init__(self, device):
+        self.device = device
+        self.queue = queue.PriorityQueue() # (priority, order, future, fn, args)
+        self._order = itertools.count() # keeps jobs of equal priority in submission order
+        self.thread = None
+        self.closed = False
+        self.pauses = 0 # times the heartbeat was paused for commands
+    def start(self):
+        self.thread = threading.Thread(target=self._run, name=f'GMC scheduler {self.device.name}', daemon=True)
+        self.thread.start()
+        return self
+    def submit(self, fn, *args, priority: int = PRIORITY_NORMAL) -> Future:
+        """Queues fn(*args) and returns the Future of its result
+        """
+        if self.closed:
+            raise RuntimeError(f"scheduler of {self.device.name} is closed")
+        future = Future()
+        self.queue.put((priority, next(self._order), future, fn, args))
+        return future
+    def run(self, fn, *args, priority: int = PRIORITY_NORMAL):
+        """Runs fn(*args) on the owner thread and waits for its result, for worker threads
+        """
+        if threading.current_thread() is self.thread:
+            return fn(*args) # already the owner, queueing would deadlock
+        return self.submit(fn, *args, priority=priority).result()
+    def _run(self):
+        while True:
+            job = self.queue.get()
+            if job[0] == _CLOSE:
+                return
+            self._execute(job)
+    def _execute(self, job: tuple):
+        priority, order, future, fn, args = job
+        if not future.set_running_or_notify_cancel():
+            return # cancelled while queued
+        try:
+            result = fn(*args)
+        except BaseException as error:
+            future.set_exception(error)
+        else:
+            future.set_result(result)
+    def service(self) -> bool:
+        """Runs queued commands with the heartbeat paused, returns True if it paused
+
+        Called on the owner thread by a running HeartbeatStream right after a
+        sample, so the pause falls in the quiet time before the next one.
+        """
+        if self.queue.empty():
+            return False
+        pending = []
+        while True:
+            try:
+                job = self.queue.get_nowait()
+            except queue.Empty:
+                break
+            if job[0] >= PRIORITY_LOW:
+                self.queue.put(job) # waits for the running job to finish
+                break
+            pending.append(job)
+        if not pending:
+            return False
+        device = self.device
+        device.stop_heartbeat()
+        self.pauses += 1
+        try:
+            for job in pending:
+                self._execute(job)
+        finally:
+            device.start_heartbeat()
+        return True
+    def close(self, timeout: float = None):
+        """Runs the jobs already queued, then stops the owner thread
+        """
+        if self.closed:
+            return
+        self.closed = True
+        self.queue.put((_CLOSE, next(self._order), None, None, ()))
+        if self.thread:
+            self.thread.join(timeout)
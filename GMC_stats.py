@@ -0,0 +1,106 @@
+"""Count rate statistics: rolling windows, Poisson confidence intervals and dose rate
+
+RollingStats updates sums over several windows (10 s, 1 min, 10 min and the
+whole run) in O(1) per sample. window_stats computes the same statistics over a
+whole array of per-second counts with NumPy. Both use the same formulas, so live
+readouts, exports and offline analysis agree.
+"""
+import math
+from array import array
+from statistics import NormalDist
+
+# uSv/h per CPM of the factory tubes, override per device with conversion_factor
+CONVERSION_FACTORS = {'GMC-280': 0.0065, 'GMC-300': 0.0065, 'GMC-320': 0.0065,
+                      'GMC-500': 0.006, 'GMC-600': 0.006}
+DEFAULT_FACTOR = 0.006
+USVH_TO_MRH = 0.1
+WINDOWS = (10, 60, 600) # seconds
+CONFIDENCE = 0.95
+
+def conversion_factor(model: str, overrides: dict = None) -> float:
+    """uSv/h per CPM for a device model such as 'GMC-500'
+    """
+    factors = dict(CONVERSION_FACTORS, **(overrides or {}))
+    return factors.get(model, DEFAULT_FACTOR)
+def z_score(confidence: float = CONFIDENCE) -> float:
+    return NormalDist().inv_cdf(0.5 + confidence/2)
+def poisson_interval(counts, z: float, sqrt = math.sqrt):
+    """Approximate Garwood interval of a Poisson count (Wilson-Hilferty)
+
+    Works on floats or, with sqrt=numpy.sqrt, on NumPy arrays
+    """
+    low = counts*(1 - 1/(9*counts + (counts == 0)) - z/(3*sqrt(counts + (counts == 0))))**3
+    high = (counts + 1)*(1 - 1/(9*(counts + 1)) + z/(3*sqrt(counts + 1)))**3
+    return low*(counts > 0) + 0.0, high # + 0.0 turns -0.0 into 0.0
+def rate_stats(counts, seconds, factor: float, z: float, sqrt = math.sqrt) -> dict:
+    """CPM, its confidence interval and dose rates of <counts> over <seconds>
+    """
+    low, high = poisson_interval(counts, z, sqrt)
+    per_minute = 60/seconds
+    cpm = counts*per_minute
+    return {'counts': counts, 'seconds': seconds, 'cpm': cpm, 'cpm_low': low*per_minute,
+            'cpm_high': high*per_minute, 'usvh': cpm*factor, 'mrh': cpm*factor*USVH_TO_MRH}
+class RollingWindow:
+    """Sum of the last <size> per-second counts
+    """
+    def __init__(self, size: int):
+        self.size = size
+        self.counts = array('L', bytes(array('L').itemsize*size))
+        self.total = 0 # samples ever added
+        self.sum = 0
+    def add(self, count: int):
+        i = self.total % self.size
+        self.sum += count - self.counts[i]
+        self.counts[i] = count
+        self.total += 1
+    @property
+    def seconds(self) -> int:
+        return min(self.total, self.size)
+class RollingStats:
+    """Live statistics of a per-second count stream
+
+    <factor> is the uSv/h per CPM of the tube, see conversion_factor
+    """
+    def __init__(self, windows: tuple = WINDOWS, factor: float = DEFAULT_FACTOR, confidence: float = CONFIDENCE):
+        self.windows = {size: RollingWindow(size) for size in windows}
+        self.factor = factor
+        self.z = z_score(confidence)
+        self.run_counts = 0
+        self.run_seconds = 0
+    def update(self, count: int):
+        self.run_counts += count
+        self.run_seconds += 1
+        for window in self.windows.values():
+            window.add(count)
+    def window(self, size: int) -> dict:
+        """Statistics of the last <size> seconds
+        """
+        window = self.windows[size]
+        return rate_stats(window.sum, max(window.seconds, 1), self.factor, self.z)
+    def run(self) -> dict:
+        """Statistics of the whole run
+        """
+        return rate_stats(self.run_counts, max(self.run_seconds, 1), self.factor, self.z)
+    def snapshot(self) -> dict:
+        """Statistics of every window and the run, keyed by window size and 'run'
+        """
+        stats = {size: self.window(size) for size in self.windows}
+        stats['run'] = self.run()
+        return stats
+def window_stats(counts, window: int = None, factor: float = DEFAULT_FACTOR, confidence: float = CONFIDENCE) -> dict:
+    """Rolling statistics over an array of per-second counts with NumPy
+
+    Element i covers the <window> seconds ending at sample i (fewer at the start),
+    or the run up to sample i when <window> is None. Values are NumPy arrays.
+    """
+    try:
+        import numpy as np
+    except ModuleNotFoundError:
+        raise ModuleNotFoundError("window_stats needs NumPy: pip install numpy") from None
+    counts = np.asarray(counts, dtype=np.float64)
+    cumulative = np.cumsum(counts)
+    seconds = np.arange(1, len(counts) + 1, dtype=np.float64)
+    if window is not None:
+        cumulative[window:] = cumulative[window:] - cumulative[:-window].copy()
+        seconds = np.minimum(seconds, window)
+    return rate_stats(cumulative, seconds, factor, z_score(confidence), np.sqrt)
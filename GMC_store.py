@@ -0,0 +1,187 @@
+"""Append-only, memory-mapped store of per-second count samples
+
+Every device gets a directory of fixed size segment files. A segment is a 32 byte
+header followed by fixed width records (wall clock timestamp, count, flags), and
+is written through an mmap, so an append is a couple of memory writes and costs
+no system call. The header's record count is updated after the record itself,
+so a crash loses at most the sample being written.
+
+Timestamps only ever increase, so a range query finds its segments by their
+first timestamp and its records through a sparse index holding every
+INDEX_STRIDE-th timestamp; nothing is scanned and nothing is loaded up front.
+"""
+import bisect, math, mmap, os, re, struct
+from array import array
+
+SEGMENT_MAGIC = b'GMCSEG1\x00'
+HEADER = struct.Struct('<8sQd8x') # magic, record count, first timestamp
+RECORD = struct.Struct('<dIHH') # timestamp (s since epoch), count, flags, reserved
+SEGMENT_RECORDS = 1 << 17 # ~36 hours of 1 Hz data, 2 MB
+INDEX_STRIDE = 1024
+SEGMENT_NAME = re.compile(r'^(\d{8})\.seg$')
+
+class Segment:
+    """One mmapped segment file
+    """
+    def __init__(self, path: str, capacity: int = SEGMENT_RECORDS, readonly: bool = False):
+        self.path = path
+        self.readonly = readonly
+        exists = os.path.exists(path)
+        self.file = open(path, 'rb' if readonly else ('r+b' if exists else 'w+b'))
+        if not exists:
+            self.file.truncate(HEADER.size + capacity*RECORD.size)
+        size = os.fstat(self.file.fileno()).st_size
+        self.capacity = (size - HEADER.size)//RECORD.size
+        self.map = mmap.mmap(self.file.fileno(), size, access=mmap.ACCESS_READ if readonly else mmap.ACCESS_WRITE)
+        if exists:
+            magic, self.count, self.first = HEADER.unpack_from(self.map, 0)
+            if magic != SEGMENT_MAGIC:
+                raise ValueError(f"{path} is not a sample segment")
+        else:
+            self.count, self.first = 0, 0.0
+            HEADER.pack_into(self.map, 0, SEGMENT_MAGIC, 0, 0.0)
+        self.index = array('d', (self.timestamp(i) for i in range(0, self.count, INDEX_STRIDE)))
+    def timestamp(self, i: int) -> float:
+        return struct.unpack_from('<d', self.map, HEADER.size + i*RECORD.size)[0]
+    @property
+    def last(self) -> float:
+        return self.timestamp(self.count - 1) if self.count else 0.0
+    @property
+    def full(self) -> bool:
+        return self.count >= self.capacity
+    def refresh(self):
+        """Picks up records appended by another process
+        """
+        magic, count, self.first = HEADER.unpack_from(self.map, 0)
+        for i in range(len(self.index)*INDEX_STRIDE, count, INDEX_STRIDE):
+            self.index.append(self.timestamp(i))
+        self.count = count
+    def append(self, timestamp: float, count: int, flags: int = 0):
+        i = self.count
+        RECORD.pack_into(self.map, HEADER.size + i*RECORD.size, timestamp, count, flags, 0)
+        if i % INDEX_STRIDE == 0:
+            self.index.append(timestamp)
+        if i == 0:
+            self.first = timestamp
+        self.count = i + 1
+        HEADER.pack_into(self.map, 0, SEGMENT_MAGIC, self.count, self.first) # commits the record
+    def search(self, timestamp: float) -> int:
+        """Position of the first record at or after <timestamp>
+        """
+        block = max(0, bisect.bisect_left(self.index, timestamp) - 1)
+        lo, hi = block*INDEX_STRIDE, min(self.count, (block + 2)*INDEX_STRIDE)
+        while lo < hi: # binary search inside the indexed block
+            mid = (lo + hi)//2
+            if self.timestamp(mid) < timestamp:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+    def records(self, start: int, end: int):
+        """Yields (timestamp, count, flags) for records <start> to <end> straight from the map
+        """
+        with memoryview(self.map) as view:
+            for timestamp, count, flags, reserved in RECORD.iter_unpack(
+                    view[HEADER.size + start*RECORD.size:HEADER.size + end*RECORD.size]):
+                yield timestamp, count, flags
+    def flush(self):
+        if not self.readonly:
+            self.map.flush()
+    def close(self):
+        self.flush()
+        self.map.close()
+        self.file.close()
+class SampleStore:
+    """Append-only sample store of one device, kept in the directory <path>
+    """
+    def __init__(self, path: str, segment_records: int = SEGMENT_RECORDS, readonly: bool = False):
+        self.path = path
+        self.segment_records = segment_records
+        self.readonly = readonly
+        if not readonly:
+            os.makedirs(path, exist_ok=True)
+        names = sorted(n for n in os.listdir(path) if SEGMENT_NAME.match(n)) if os.path.isdir(path) else []
+        self.segments = [Segment(os.path.join(path, n), segment_records, readonly) for n in names]
+        self._index_segments()
+        self.last_timestamp = self.last
+    def __len__(self):
+        return sum(segment.count for segment in self.segments)
+    @property
+    def first(self) -> float:
+        return self.segments[0].first if self.segments and self.segments[0].count else None
+    @property
+    def last(self) -> float:
+        return self.segments[-1].last if self.segments and self.segments[-1].count else None
+    def _index_segments(self):
+        """First timestamp of every segment, an empty segment sorts last
+        """
+        self.firsts = [segment.first if segment.count else math.inf for segment in self.segments]
+    def append(self, timestamp: float, count: int, flags: int = 0):
+        """Appends a sample, <timestamp> is in seconds since the epoch and never decreases
+        """
+        if self.last_timestamp is not None and timestamp < self.last_timestamp:
+            timestamp = self.last_timestamp # keep the store sorted if the wall clock steps back
+        segment = self.segments[-1] if self.segments else None
+        if segment is None or segment.full:
+            segment = Segment(os.path.join(self.path, f'{len(self.segments):08d}.seg'), self.segment_records)
+            self.segments.append(segment)
+            self.firsts.append(timestamp)
+        elif not segment.count:
+            self.firsts[-1] = timestamp
+        segment.append(timestamp, count, flags)
+        self.last_timestamp = timestamp
+    def refresh(self):
+        """Picks up segments and records appended by a writer in another process
+        """
+        for segment in self.segments:
+            segment.refresh()
+        names = sorted(n for n in os.listdir(self.path) if SEGMENT_NAME.match(n))
+        for name in names[len(self.segments):]:
+            self.segments.append(Segment(os.path.join(self.path, name), self.segment_records, self.readonly))
+        self._index_segments()
+    def ranges(self, start: float = None, end: float = None):
+        """Yields (segment, first record, end record) covering start <= timestamp < end
+        """
+        first_segment = max(0, bisect.bisect_right(self.firsts, start) - 1) if start is not None else 0
+        for segment in self.segments[first_segment:]:
+            if end is not None and segment.count and segment.first >= end:
+                return
+            lo = segment.search(start) if start is not None else 0
+            hi = segment.search(end) if end is not None else segment.count
+            yield segment, lo, hi
+    def query(self, start: float = None, end: float = None):
+        """Yields (timestamp, count, flags) for every sample with start <= timestamp < end
+        """
+        for segment, lo, hi in self.ranges(start, end):
+            yield from segment.records(lo, hi)
+    def flush(self):
+        for segment in self.segments:
+            segment.flush()
+    def close(self):
+        for segment in self.segments:
+            segment.close()
+        self.segments = []
+class TimeSeriesStore:
+    """Sample stores for many devices under one root directory
+    """
+    def __init__(self, root: str, readonly: bool = False):
+        self.root = root
+        self.readonly = readonly
+        self.stores = {}
+    def device(self, device_id: str) -> SampleStore:
+        """Store of <device_id>, usually the counter's serial number
+        """
+        store = self.stores.get(device_id)
+        if store is None:
+            safe_id = re.sub(r'[^\w.-]', '_', device_id)
+            store = self.stores[device_id] = SampleStore(os.path.join(self.root, safe_id), readonly=self.readonly)
+        return store
+    def devices(self) -> list:
+        return sorted(os.listdir(self.root)) if os.path.isdir(self.root) else []
+    def flush(self):
+        for store in self.stores.values():
+            store.flush()
+    def close(self):
+        for store in self.stores.values():
+            store.close()
+        self.stores = {}
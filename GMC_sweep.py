@@ -0,0 +1,132 @@
+"""Unattended tube voltage plateau sweep
+
+PlateauSweep steps the tube 1 voltage over a range and counts for a dwell time at
+every step. Each step is one ConfigTransaction through the config cache, so
+only the bytes the device needs are written, and the settle time is counted
+from the <CFGUPDATE>> that applied the voltage: the read-back verification runs
+while the tube settles. find_plateau then picks the flattest run of steps and a
+set-point a third of the way into it.
+"""
+import time
+from collections import namedtuple
+from GMC_acquisition import HeartbeatStream
+from GMC_config import ConfigTransaction, config_cache
+from GMC_stats import RollingStats, conversion_factor
+
+SETTLE_TIME = 2.0 # seconds for the tube voltage to stabilise after a change
+MAX_PLATEAU_SLOPE = 1.0 # % change in count rate per voltage percentage point
+MIN_PLATEAU_STEPS = 3
+SETPOINT_FRACTION = 1/3 # from the start of the plateau
+
+SweepStep = namedtuple('SweepStep', 'voltage counts seconds cpm cpm_low cpm_high')
+Plateau = namedtuple('Plateau', 'start end slope setpoint')
+
+def sweep_voltages(start: float, stop: float, step: float) -> list:
+    """Voltage percentages from <start> to <stop> inclusive, clamped to 0-100
+    """
+    if step <= 0:
+        raise ValueError("sweep step must be positive")
+    n = int(round(abs(stop - start)/step))
+    direction = 1 if stop >= start else -1
+    return [min(100.0, max(0.0, start + direction*i*step)) for i in range(n + 1)]
+class PlateauSweep:
+    """Runs a voltage sweep on a GMCDevice, see sweep_voltages for the steps
+
+    <service> is passed on to each step's HeartbeatStream (see GMC_scheduler).
+    The original voltage is restored when the sweep ends or is stopped.
+    """
+    def __init__(self, device, voltages: list, dwell: int = 60, settle: float = SETTLE_TIME,
+                 cache = config_cache, service = None):
+        self.device = device
+        self.voltages = voltages
+        self.dwell = dwell
+        self.settle = settle
+        self.cache = cache
+        self.service = service
+        self.steps = []
+        self.stream = None
+        self.interrupt_flag = False
+    def set_voltage(self, voltage_percent: float) -> float:
+        """Writes a voltage and returns the time.monotonic() it took effect
+        """
+        current = self.cache.get(self.device)
+        target = current.copy()
+        target.tube1_voltage_percent = voltage_percent
+        transaction = ConfigTransaction(self.device, target, bytes(current))
+        self.cache.commit(self.device, transaction)
+        return transaction.updated if transaction.updated is not None else time.monotonic()
+    def count(self, seconds: int) -> dict:
+        stats = RollingStats(factor=conversion_factor(self.device.model))
+        self.stream = HeartbeatStream(self.device)
+        self.stream.service = self.service
+        self.stream.callbacks.append(lambda timestamp, count: stats.update(count))
+        self.stream.run(seconds)
+        return stats.run()
+    def run(self, progress = None) -> list:
+        """Sweeps every voltage, calling progress(step) after each, and returns the SweepSteps
+
+        A step cut short by stop() is left out, its few seconds would skew the fit.
+        """
+        self.interrupt_flag = False
+        self.steps = []
+        original = self.cache.get(self.device).tube1_voltage_percent
+        try:
+            for voltage in self.voltages:
+                if self.interrupt_flag:
+                    break
+                updated = self.set_voltage(voltage)
+                voltage = self.cache.get(self.device).tube1_voltage_percent # as stored, in steps of 1/150
+                time.sleep(max(0.0, self.settle - (time.monotonic() - updated))) # read-back time counts as settling
+                if self.interrupt_flag:
+                    break
+                run = self.count(self.dwell)
+                if self.interrupt_flag:
+                    break
+                step = SweepStep(voltage, run['counts'], run['seconds'], run['cpm'], run['cpm_low'], run['cpm_high'])
+                self.steps.append(step)
+                if progress:
+                    progress(step)
+        except BaseException:
+            try:
+                self.set_voltage(original)
+            except Exception:
+                pass # the port failed too, the sweep's own error is the one to report
+            raise
+        self.set_voltage(original)
+        return self.steps
+    def stop(self):
+        self.interrupt_flag = True
+        if self.stream:
+            self.stream.stop()
+def find_plateau(steps: list, max_slope: float = MAX_PLATEAU_SLOPE, min_steps: int = MIN_PLATEAU_STEPS) -> Plateau:
+    """Longest run of steps whose count rate changes by at most <max_slope> % per voltage point,
+    or by no more than the steps' confidence intervals allow
+
+    The slope reported is the least squares slope over the run, in % per voltage
+    percentage point relative to the run's mean rate. Returns None if no run has <min_steps> steps.
+    """
+    steps = sorted(steps, key=lambda s: s.voltage)
+    def flat(a, b):
+        mean = (a.cpm + b.cpm)/2
+        if mean <= 0 or b.voltage == a.voltage:
+            return False
+        if a.cpm_low <= b.cpm_high and b.cpm_low <= a.cpm_high:
+            return True # the difference is within counting statistics
+        return abs(b.cpm - a.cpm)/mean*100/abs(b.voltage - a.voltage) <= max_slope
+    best = None
+    start = 0
+    for end in range(1, len(steps) + 1):
+        if end == len(steps) or not flat(steps[end - 1], steps[end]):
+            if end - start >= min_steps and (best is None or end - start > best[1] - best[0]):
+                best = (start, end)
+            start = end
+    if best is None:
+        return None
+    run = steps[best[0]:best[1]]
+    n = len(run)
+    mean_v = sum(s.voltage for s in run)/n
+    mean_cpm = sum(s.cpm for s in run)/n
+    slope = sum((s.voltage - mean_v)*(s.cpm - mean_cpm) for s in run)/sum((s.voltage - mean_v)**2 for s in run)
+    setpoint_target = run[0].voltage + SETPOINT_FRACTION*(run[-1].voltage - run[0].voltage)
+    setpoint = min(run, key=lambda s: abs(s.voltage - setpoint_target)).voltage # a voltage that was measured
+    return Plateau(run[0].voltage, run[-1].voltage, slope/mean_cpm*100, setpoint)
@@ -0,0 +1,125 @@
+"""Telemetry snapshots of GQ GMC Geiger counters in one round trip
+
+read_telemetry sends GETCPM, GETVOLT, GETTEMP, GETGYRO and GETDATETIME as one
+write with GMCDevice.pipeline and splits the fixed-length replies, checking the
+0xAA sentinel that ends GETTEMP, GETGYRO and GETDATETIME, into one Telemetry
+record. TelemetryPoller reads a snapshot from every counter of a fleet at a
+fixed rate, all counters at once, so a health check costs one round trip per
+counter and a slow or unplugged counter does not hold up the others.
+"""
+import threading, time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from GMC_device import parse_datetime, parse_gyro, parse_temperature, parse_voltage
+
+TELEMETRY_COMMANDS = ('GETCPM', 'GETVOLT', 'GETTEMP', 'GETGYRO', 'GETDATETIME')
+SENTINEL_COMMANDS = ('GETTEMP', 'GETGYRO', 'GETDATETIME')
+DEFAULT_INTERVAL = 60.0 # seconds between polls of a fleet
+
+# <time> is the host time of the reply in seconds since the epoch, <clock> the counter's
+# own datetime and <clock_offset> how far it is ahead of the host in whole seconds (+-1 s,
+# the clock has no fractions), <latency> the round trip
+Telemetry = namedtuple('Telemetry', 'device time cpm battery temperature gyro clock clock_offset latency')
+
+def read_telemetry(device, name: str = None) -> Telemetry:
+    """Reads a Telemetry snapshot of a GMCDevice, <name> identifies it in the record (default: its port)
+    """
+    sent = time.time()
+    start = time.perf_counter()
+    responses = dict(zip(TELEMETRY_COMMANDS, device.pipeline(TELEMETRY_COMMANDS)))
+    latency = time.perf_counter() - start
+    now = time.time()
+    host_clock = int((sent + now)/2) # the host time the clock was read, truncated to whole seconds like it
+    for command in SENTINEL_COMMANDS:
+        device.check_sentinel(command, responses[command])
+    clock = parse_datetime(responses['GETDATETIME'])
+    return Telemetry(name or device.name, now, int.from_bytes(responses['GETCPM'], byteorder='big'),
+                     parse_voltage(responses['GETVOLT']), parse_temperature(responses['GETTEMP']),
+                     parse_gyro(responses['GETGYRO']), clock, int(clock.timestamp()) - host_clock, latency)
+class TelemetryPoller:
+    """Polls the Telemetry of several GMCDevices every <interval> seconds
+
+    A device is added with the name its records carry and, if a CommandScheduler
+    owns its port, that scheduler, so a poll waits for the port like any other
+    command. Each record is passed to every callable in <callbacks>; a failed
+    read leaves its exception in errors[name] until the next good one and is
+    passed to every callable in <error_callbacks> as callback(name, exception).
+    """
+    def __init__(self, interval: float = DEFAULT_INTERVAL):
+        self.interval = interval
+        self.devices = {} # name -> (GMCDevice, CommandScheduler or None)
+        self.latest = {} # name -> newest Telemetry
+        self.errors = {} # name -> exception of the last failed read
+        self.callbacks = []
+        self.error_callbacks = []
+        self.executor = None
+        self.workers = 0 # threads of the executor, one per device
+        self.stop_event = threading.Event()
+        self.thread = None
+    def add(self, device, name: str = None, scheduler = None):
+        self.devices[name or device.name] = (device, scheduler)
+    def remove(self, name: str):
+        self.devices.pop(name, None)
+        self.latest.pop(name, None)
+        self.errors.pop(name, None)
+    def _read(self, name: str) -> Telemetry:
+        device, scheduler = self.devices[name]
+        if scheduler is not None:
+            return scheduler.run(read_telemetry, device, name)
+        return read_telemetry(device, name)
+    def poll(self) -> dict:
+        """Reads every device at once and returns {name: Telemetry} of the ones that answered
+        """
+        names = list(self.devices)
+        if self.executor is None or self.workers < len(names):
+            if self.executor is not None:
+                self.executor.shutdown(wait=False)
+            self.workers = max(len(names), 1)
+            self.executor = ThreadPoolExecutor(self.workers, thread_name_prefix='telemetry')
+        futures = {name: self.executor.submit(self._read, name) for name in names}
+        records = {}
+        for name, future in futures.items():
+            try:
+                record = future.result()
+            except Exception as e: # GMCError or OSError of one device
+                self.errors[name] = e
+                for callback in self.error_callbacks:
+                    callback(name, e)
+                continue
+            self.errors.pop(name, None)
+            self.latest[name] = records[name] = record
+            for callback in self.callbacks:
+                callback(record)
+        return records
+    def run(self, polls: int = None):
+        """Polls every <interval> seconds until stop() is called or after <polls> polls
+
+        A poll that overruns the interval delays the next one instead of starting two at once.
+        """
+        self.stop_event.clear()
+        next_poll = time.monotonic()
+        n = 0
+        try:
+            while not self.stop_event.is_set():
+                self.poll()
+                n += 1
+                next_poll = max(next_poll + self.interval, time.monotonic())
+                if polls is not None and n >= polls:
+                    break
+                self.stop_event.wait(next_poll - time.monotonic())
+        finally:
+            if self.executor is not None:
+                self.executor.shutdown()
+                self.executor = None
+        return n
+    def start(self, polls: int = None):
+        """Runs the poller on a background thread
+        """
+        self.thread = threading.Thread(target=self.run, args=(polls,), daemon=True)
+        self.thread.start()
+        return self.thread
+    def stop(self):
+        self.stop_event.set()
+    def join(self, timeout: float = None):
+        if self.thread:
+            self.thread.join(timeout)
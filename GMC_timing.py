@@ -0,0 +1,137 @@
+"""Event time alignment of heartbeat samples
+
+The counter sends one sample per second of its own clock, but the host sees
+them late, jittered and, after a stall, several at once. SampleClock puts every
+sample on the device's schedule instead of its arrival time:
+    a sample arriving more than an interval late with nothing queued behind it
+    means samples were lost, the schedule skips them and the sample is flagged GAP
+    samples read out of a backlog keep their scheduled times and are flagged BURST
+    the schedule's period follows the lower envelope of the arrival times, the
+    arrivals with the least delay, so the device's clock drift is corrected
+
+measure_clock and clock_drift estimate the drift up front from <GETDATETIME>>.
+"""
+import time
+from collections import deque, namedtuple
+
+FLAG_GAP = 0x1 # samples were lost right before this one
+FLAG_BURST = 0x2 # read from a backlog, the timestamp is the scheduled one
+HEARTBEAT_INTERVAL = 1.0 # device seconds per sample
+LATE_TOLERANCE = 0.1 # intervals of jitter allowed before a late sample means one was lost
+ENVELOPE_WINDOW = 60 # samples per lower envelope point
+ENVELOPE_POINTS = 30 # envelope points in the drift fit
+MAX_DRIFT = 0.01 # largest clock rate error believed, as a fraction
+
+ClockSample = namedtuple('ClockSample', 'monotonic wall device')
+
+class SampleClock:
+    """Assigns event times, on the time.monotonic() scale, to a stream of samples
+
+    <period> is the host seconds per device interval if already known, see clock_drift
+    """
+    def __init__(self, interval: float = HEARTBEAT_INTERVAL, period: float = None, window: int = ENVELOPE_WINDOW,
+                 wall_offset: float = None):
+        self.interval = interval
+        self.period = period or interval
+        self.window = window
+        self.origin = None # host time of tick 0
+        self.ticks = 0 # device intervals elapsed, including lost samples
+        self.samples = 0
+        self.missed = 0
+        self.bursts = 0
+        self.flags = 0 # flags of the latest sample
+        self._resumed = False
+        self.envelope = deque(maxlen=ENVELOPE_POINTS) # (tick, arrival) of the least delayed sample per window
+        self._best = None
+        if wall_offset is None:
+            wall_offset = time.time() - time.monotonic() # fixed, so wall clock steps do not move samples
+        self.wall_offset = wall_offset
+    def stamp(self, arrival: float, backlog: int = 0) -> tuple:
+        """Returns (timestamp, flags, missed) for a sample that arrived at <arrival>
+
+        <backlog> is the number of samples already waiting behind this one
+        """
+        flags = missed = 0
+        if self.origin is None:
+            self.origin = arrival
+        elif self._resumed: # the heartbeat restarted on a schedule of its own
+            self.origin = arrival - self.ticks*self.period
+            self._resumed = False
+        expected = self.origin + self.ticks*self.period
+        if arrival < expected: # less delay than any sample so far
+            self.origin += arrival - expected
+            expected = arrival
+        behind = int((arrival - expected)/self.period + LATE_TOLERANCE) # whole intervals late
+        if behind > 0:
+            missed = max(0, behind - backlog)
+            if missed:
+                flags |= FLAG_GAP
+                self.ticks += missed
+                self.missed += missed
+                expected = self.origin + self.ticks*self.period
+            if behind > missed:
+                flags |= FLAG_BURST
+                self.bursts += 1
+        self._track(arrival - expected, arrival)
+        self.ticks += 1
+        self.samples += 1
+        self.flags = flags
+        return expected, flags, missed
+    def _track(self, delay: float, arrival: float):
+        """Keeps the least delayed arrival of every window and refits the period
+        """
+        if self._best is None or delay < self._best[0]:
+            self._best = (delay, self.ticks, arrival)
+        if self.ticks % self.window != self.window - 1:
+            return
+        self.envelope.append(self._best[1:])
+        self._best = None
+        if len(self.envelope) < 2:
+            return
+        (first_tick, first), (last_tick, last) = self.envelope[0], self.envelope[-1]
+        period = (last - first)/(last_tick - first_tick)
+        low, high = self.interval*(1 - MAX_DRIFT), self.interval*(1 + MAX_DRIFT)
+        self.period = min(max(period, low), high)
+        self.origin = last - last_tick*self.period
+    def resume(self):
+        """Starts a new schedule at the next sample, after the heartbeat was paused
+        """
+        self._resumed = True
+    @property
+    def elapsed(self) -> float:
+        """Device seconds covered so far, including lost samples
+        """
+        return self.ticks*self.interval
+    @property
+    def drift(self) -> float:
+        """Host seconds per device second minus one
+        """
+        return self.period/self.interval - 1
+    def wall(self, timestamp: float) -> float:
+        """Converts an event time to seconds since the epoch
+        """
+        return timestamp + self.wall_offset
+def measure_clock(device, timeout: float = 2.5) -> ClockSample:
+    """Host and device time at the moment the device's seconds field ticks over
+
+    Polls <GETDATETIME>> for up to a second, so the reading is as precise as one round trip
+    """
+    previous = device.get_datetime()
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        before = time.monotonic()
+        current = device.get_datetime()
+        after = time.monotonic()
+        if current != previous:
+            midpoint = (before + after)/2
+            return ClockSample(midpoint, midpoint + time.time() - time.monotonic(), current)
+        previous = current
+    raise TimeoutError("device clock did not tick")
+def clock_drift(first: ClockSample, second: ClockSample) -> float:
+    """Host seconds per device second minus one, between two measure_clock readings
+
+    Use SampleClock(period=interval*(1 + drift)). The readings should be hours apart
+    for ppm precision.
+    """
+    device = (second.device - first.device).total_seconds()
+    return (second.monotonic - first.monotonic)/device - 1
@@ -1,32 +1,30 @@
-import os,sys, traceback, csv
-try: 
-    import serial
-except ModuleNotFoundError:
-    os.system("pip install pyserial")
-    import serial
+import os,sys, math, traceback, csv
+import serial
 from PyQt5.QtWidgets import *
 from PyQt5.QtCore import *
 from PyQt5.QtGui import *
 from functools import partial 
 import time
 from datetime import datetime
+from GMC_config import config_cache, set_tube_voltage
+from GMC_device import GMCDevice, GMCError, find_ports
+from GMC_discovery import Discovery
+from GMC_scheduler import CommandScheduler, PRIORITY_HIGH, PRIORITY_LOW
+from GMC_sweep import PlateauSweep, find_plateau, sweep_voltages
+from GMC_capture import capture_path
+from GMC_export import FILE_FILTERS, FORMATS, available_formats, export_count_log, export_store
+from GMC_history import HistoryDownloader
+from GMC_acquisition import SampleRing
+from GMC_log import CountLog
+from GMC_alarm import RateAlarm
+from GMC_longrun import LongRun, RECONNECT_INTERVAL, abandon, checkpoint_name, find_unfinished, read_checkpoint
+from GMC_plot import SeriesPyramid
+from GMC_store import TimeSeriesStore
+from GMC_stats import RollingStats
+from GMC_telemetry import read_telemetry
+from GMC_metrics import registry as metrics_registry
 
-# from matplotlib.backends.backend_qt4agg import FigureCanvasQTAgg as FigureCanvas
-# from matplotlib.backends.backend_qt4agg import NavigationToolbar2QT as NavigationToolbar
-# from matplotlib.figure import Figure
-### Matplot modules needed for plotting
 
-def find_ports() -> list:
-    """Finds the serial ports currently open
-       and returns them as a list
-    """
-    import serial.tools.list_ports
-    import serial
-    ports = serial.tools.list_ports.comports()
-
-    available_ports = [p.name for p in ports]
-
-    return available_ports
 class ThreadSignals(QObject):
     '''
     Defines the signals available from a running worker thread
@@ -43,9 +41,13 @@ class ThreadSignals(QObject):
 
     result
         object data returned from processing, anything
+
+    progress
+        object reported while processing, such as a sweep step
         
     '''
     result = pyqtSignal(object)
+    progress = pyqtSignal(object)
     finished = pyqtSignal()
     interrupt = pyqtSignal() 
     error = pyqtSignal(tuple)
@@ -65,11 +67,14 @@ class CounterSignals(QObject):
         No data
     timer_update
         No data
+    alarm
+        GMC_alarm.AlarmEvent raised or cleared by the count rate
     '''
     new_count = pyqtSignal(int,int)
     count_start = pyqtSignal()
     count_end = pyqtSignal()
     timer_update = pyqtSignal(int)
+    alarm = pyqtSignal(object)
 class SubThread(QThread):
     """Thread separate for the main thread used to perform multiple actions at once
     """
@@ -94,6 +99,7 @@ class SubThread(QThread):
         except: #error handling
             traceback.print_exc()
             exctype, value = sys.exc_info()[:2]
+            self.signals.error.emit((exctype, value, traceback.format_exc()))
         finally:
             self.signals.finished.emit()
             if fn_result: #emits result to function
@@ -138,44 +144,143 @@ class QSelectionDialog(QDialog):
         refresh_button = QPushButton('Refresh',self.buttonBox)
         refresh_button.clicked.connect(lambda : self.update_list(list_generator()))
         self.buttonBox.addButton(refresh_button,QDialogButtonBox.ActionRole)
+class CountLogModel(QAbstractTableModel):
+    """Table model over a CountLog
+
+    Views only ask for the rows they show, so the log can hold any number of runs
+    """
+    FORMATS = {'d': '{:.2f}'.format} #by array typecode, integers are shown as they are
+    def __init__(self, log: CountLog, parent = None):
+        super(CountLogModel, self).__init__(parent)
+        self.log = log
+        self.formats = [self.FORMATS.get(typecode,str) for name, typecode, header in log.COLUMNS]
+    def rowCount(self, parent = QModelIndex()):
+        return 0 if parent.isValid() else len(self.log)
+    def columnCount(self, parent = QModelIndex()):
+        return 0 if parent.isValid() else len(self.log.COLUMNS)
+    def data(self, index, role = Qt.DisplayRole):
+        if role == Qt.DisplayRole and index.isValid():
+            return self.formats[index.column()](self.log.value(index.row(),index.column()))
+        return None
+    def headerData(self, section, orientation, role = Qt.DisplayRole):
+        if role == Qt.DisplayRole:
+            if orientation == Qt.Horizontal:
+                return self.log.COLUMNS[section][2]
+            return str(section+1)
+        return None
+    def append(self, log: dict):
+        row = len(self.log)
+        self.beginInsertRows(QModelIndex(),row,row)
+        self.log.append(log)
+        self.endInsertRows()
+    def pop(self):
+        if len(self.log):
+            row = len(self.log)-1
+            self.beginRemoveRows(QModelIndex(),row,row)
+            self.log.pop()
+            self.endRemoveRows()
+    def clear(self):
+        self.beginResetModel()
+        self.log.clear()
+        self.endResetModel()
+class CountDisplay(QFrame):
+    """LCD style readout of the elapsed time and measurements of a count
+
+    The current values are kept as plain fields. Updates are coalesced and
+    drawn at most once per frame, and only labels whose text changed are set.
+    """
+    FIELDS = (('elapsed','Elapsed Time:',lambda t: f'{t//3600:02}:{t%3600//60:02}:{t%60:02}'),
+              ('count','Count:',str),
+              ('cpm','Average CPM:',lambda v: f'{v:.2f}'),
+              ('cpm_ci','95% CI CPM:',lambda v: f'{v[0]:.1f} - {v[1]:.1f}'),
+              ('cpm_1m','1 min CPM:',lambda v: f'{v:.0f}'),
+              ('usph','Average uSv/h:',lambda v: f'{v:.2f}'),
+              ('mrph','Average mR/h:',lambda v: f'{v:.3f}'))
+    DEFAULTS = {'elapsed': 0, 'count': 0, 'cpm': 0.0, 'cpm_ci': (0.0, 0.0), 'cpm_1m': 0.0, 'usph': 0.0, 'mrph': 0.0}
+    def __init__(self, parent = None, frame_ms: int = 100):
+        super(CountDisplay, self).__init__(parent)
+        self.setFrameStyle(QFrame.StyledPanel | QFrame.Sunken)
+        self.setStyleSheet("font-size: 22px")
+        layout = QGridLayout(self)
+        lcd_ttf_font = QFont("LCD Solid")
+        self.labels = {}
+        self.formats = {}
+        for row, (name, title, fmt) in enumerate(self.FIELDS):
+            title_label = QLabel(title,self)
+            title_label.setFont(lcd_ttf_font)
+            value_label = QLabel(self)
+            value_label.setFont(lcd_ttf_font)
+            value_label.setAlignment(Qt.AlignRight | Qt.AlignVCenter)
+            layout.addWidget(title_label,row,0)
+            layout.addWidget(value_label,row,1)
+            self.labels[name] = value_label
+            self.formats[name] = fmt
+        self.values = {} #latest value of every field
+        self.shown = {} #text currently on every label
+        self.frame_timer = QTimer(self) #coalesces updates within one frame
+        self.frame_timer.setSingleShot(True)
+        self.frame_timer.setInterval(frame_ms)
+        self.frame_timer.timeout.connect(self.flush)
+        self.reset()
+    def set_fields(self, **values):
+        """Stores new field values, they are drawn at the end of the frame
+        """
+        self.values.update(values)
+        if not self.frame_timer.isActive():
+            self.frame_timer.start()
+    def reset(self):
+        self.values.update(self.DEFAULTS)
+        self.flush()
+    def flush(self):
+        """Sets the labels whose text changed since the last frame
+        """
+        for name, value in self.values.items():
+            text = self.formats[name](value)
+            if self.shown.get(name) != text:
+                self.labels[name].setText(text)
+                self.shown[name] = text
 class TimedCounter(QGroupBox):  
     """Timed Counter for the GMC Terminal GUI
     """
-    def __init__(self, port: serial.Serial, title: str = "Timed Count", parent = None):
+    LONG_RUN = 3600 #counts of this many seconds or more are checkpointed
+    RUNS_DIR = 'runs' #checkpoints of long runs
+    def __init__(self, device: GMCDevice, title: str = "Timed Count", parent = None):
         super(TimedCounter, self).__init__()
         self.setTitle(title)
         self.parent = parent
-        self.port = port #port corresponding to connected device
+        self.device = device #connected device
         self.t_layout = QGridLayout()
-        self.timer_log = [] # list holding dictionaries of the total timed counts
+        self.timer_log = CountLog() # columns of the total timed counts
         self.t_signals = CounterSignals() #signals that will notify when a timed count stops or starts
         self.timer_interrupt_flag = False #Flag that can interrupt the count
+        self.samples = SampleRing() #per second (timestamp, count) samples of the counts
+        self.long_run = None #LongRun of the running count
+        self.stats = RollingStats() #rolling statistics of the running count
+        self.rate_alarm = RateAlarm() #watches every sample for sudden rate changes, learns the background across counts
+        self.rate_alarm.callbacks.append(self.t_signals.alarm.emit) #queued to the GUI thread
+        self.store = None #SampleStore every heartbeat sample is recorded to
+        self.scheduler = None #CommandScheduler owning the device's port
         
         self._makeTimerText()
         self._makeTimerTable()
         self._makeTimerBox()
         
-        self.t_signals.count_start.connect(self.parent.disable_btns) #disables buttons when the count is started
-        self.t_signals.count_end.connect(self.parent.enable_btns) #enables buttons when the count is ended
+        self.t_signals.count_start.connect(lambda: self.count_run_btn.setEnabled(False)) #other commands still run during a count
+        self.t_signals.count_end.connect(lambda: self.count_run_btn.setEnabled(self.device is not None)) #the port may have closed meanwhile
         self.t_signals.new_count.connect(self.update_measurement) #connects new_count signal to slot that will update measurements
         self.t_signals.timer_update.connect(self.update_timer)
         self.setLayout(self.t_layout)
     def _makeTimerText(self):
-        """Textbox displaying the data for the timed count
+        """LCD readout displaying the data for the timed count
         """
-        self.timer_text = QTextEdit(self)
         font_db = QFontDatabase()
         lcd_font_id = font_db.addApplicationFont("fonts/LCD_Solid.ttf")
-        lcd_ttf_font = QFont("LCD Solid")
-        self.timer_text.setFont(lcd_ttf_font) #set the font for the timer
-        self.timer_text.setReadOnly(True)
-        self.t_layout.addWidget(self.timer_text,0,0)
-        self.default_text_plain = "Elapsed Time:00:00:00\nCount: 0\nAverage CPM: 0.00\nAverage uSv/h: 0.00\nAverage mR/h: 0.00"
-        self.timer_text.setPlainText(self.default_text_plain)
-        self.timer_text.setStyleSheet("font-size: 22px")
+        self.count_display = CountDisplay(self)
+        self.t_layout.addWidget(self.count_display,0,0)
     def _makeTimerTable(self):
-        self.timer_table = QTableWidget(6,2,self)
-        self.timer_table.setHorizontalHeaderLabels(["Total Counts","Duration (seconds)"])
+        self.timer_model = CountLogModel(self.timer_log,self)
+        self.timer_table = QTableView(self) #only asks the model for the visible rows
+        self.timer_table.setModel(self.timer_model)
         self.timer_table.resizeColumnsToContents()
         self.t_layout.addWidget(self.timer_table,0,1)
     def _makeTimerBox(self):
@@ -184,192 +289,449 @@ class TimedCounter(QGroupBox):
         """
         self.buttonBox = QGridLayout()
         
-        self.buttonBox.addWidget(QLabel('Minutes:',self),0,0) 
+        self.buttonBox.addWidget(QLabel('Days:',self),0,0)
+        self.dayBox = QSpinBox(self)
+        self.dayBox.setMaximum(365)
+        self.dayBox.setSuffix(" d")
+        self.buttonBox.addWidget(self.dayBox,0,1)
+        
+        self.buttonBox.addWidget(QLabel('Hours:',self),0,2)
+        self.hourBox = QSpinBox(self)
+        self.hourBox.setMaximum(23)
+        self.hourBox.setSuffix(" h")
+        self.buttonBox.addWidget(self.hourBox,0,3)
+        
+        self.buttonBox.addWidget(QLabel('Minutes:',self),1,0) 
         self.minuteBox = QSpinBox(self)
         self.minuteBox.setMaximum(59)
         self.minuteBox.setSuffix(" min")
-        self.buttonBox.addWidget(self.minuteBox,0,1)
+        self.buttonBox.addWidget(self.minuteBox,1,1)
         
-        self.buttonBox.addWidget(QLabel('Seconds:',self),0,2)
+        self.buttonBox.addWidget(QLabel('Seconds:',self),1,2)
         self.secondBox = QSpinBox(self)
         self.secondBox.setMaximum(59)
         self.secondBox.setSuffix(" sec")
-        self.buttonBox.addWidget(self.secondBox,0,3)
+        self.buttonBox.addWidget(self.secondBox,1,3)
         
         self.count_run_btn = QPushButton("Run Count",self)
-        self.count_run_btn.clicked.connect(lambda : self.run_count(self.minuteBox.value(),self.secondBox.value()))
-        self.buttonBox.addWidget(self.count_run_btn,0,4)
+        self.count_run_btn.clicked.connect(lambda : self.run_count(self.duration()))
+        self.count_run_btn.setEnabled(False) #until a port is open
+        self.buttonBox.addWidget(self.count_run_btn,1,4)
         
         self.checkbox = QCheckBox("Logging Counts", self)
-        self.buttonBox.addWidget(self.checkbox,1,0,1,2)
+        self.buttonBox.addWidget(self.checkbox,2,0,1,2)
         self.checkbox.setChecked(False)
         
         self.clear_last_btn = QPushButton("Clear Last Count",self)
         self.clear_last_btn.clicked.connect(self.clear_last_row)
-        self.buttonBox.addWidget(self.clear_last_btn,1,2,1,1)
+        self.buttonBox.addWidget(self.clear_last_btn,2,2,1,1)
         
         self.log_clear_btn = QPushButton("Clear Log",self)
         self.log_clear_btn.clicked.connect(self.clear_log)
-        self.buttonBox.addWidget(self.log_clear_btn,1,3,1,1)
+        self.buttonBox.addWidget(self.log_clear_btn,2,3,1,1)
         
         self.timer_interrupt_btn = QPushButton("Stop Count",self)
         self.timer_interrupt_btn.clicked.connect(self.count_interrupt)
-        self.buttonBox.addWidget(self.timer_interrupt_btn,1,4,1,1)
+        self.buttonBox.addWidget(self.timer_interrupt_btn,2,4,1,1)
         
         self.t_layout.addLayout(self.buttonBox,1,0,1,2)
        
 
-    def run_count(self,minutes,seconds):
+    def duration(self) -> int:
+        """Seconds set in the duration spinboxes
+        """
+        return ((self.dayBox.value()*24 + self.hourBox.value())*60 + self.minuteBox.value())*60 + self.secondBox.value()
+    def run_count(self,duration,checkpoint = None):
         """Starts running the thread responsible for handling the timed count
+
+        <checkpoint> is the file of an unfinished long run to resume instead
         """
-        self.timer_text.setPlainText(self.default_text_plain)
+        if self.device is None or self.scheduler is None: #no port open
+            return
+        self.count_display.reset()
+        self.timer_interrupt_flag = False
         
-        self.count_thread = SubThread(self.timed_count,minutes,seconds) 
+        self.count_thread = SubThread(self.scheduler.run,self.timed_count,duration,checkpoint,priority=PRIORITY_LOW) #runs on the port's owner thread
         self.count_thread.signals.result.connect(self.update_timer_log) #connects result signal to slot
                                                                         #that will upddate the timer log
         self.count_thread.signals.finished.connect(self.t_signals.count_end.emit) # stops the timer when the thread is finished
-        if self.port:
-            try:
-                self.t_signals.count_start.emit()
-                self.count_thread.start() #starts thread
-            except:
-                err_msg = QErrorMessage()
-                err_msg.setWindowTitle("Timed Count Error")
-                err_msg.showMessage(traceback.format_exc())
-    def timed_count(self,minutes,seconds):
-        self.port.write(('<HEARTBEAT1>>').encode()) #heartbeat mode on GMC will return total counts every second
-        duration = (minutes*60)+seconds
-        total_counts = 0
-        for t in range(duration): #read in counts every second
-            print(self.port)
-            try: 
-                count = int.from_bytes(self.port.read(4),byteorder="big") 
-                total_counts = total_counts+count
-                
-                if count > 0:
-                    self.t_signals.new_count.emit(total_counts,t+1)
-                if self.timer_interrupt_flag:
-                    self.timer_interrupt_flag = False
-                    log = {'total_count': total_counts, 'duration': t}
-                    break;
-            except serial.serialutil.SerialException:
-                err_msg = QErrorMessage()
-                err_msg.setWindowTitle("Timed Count Error")
-                err_msg.showMessage(traceback.format_exc() + "\nPort was likely disconnected.\nPlease reconnect")
-            self.t_signals.timer_update.emit(t+1)
+        self.count_thread.signals.error.connect(partial(self.parent._thread_error,"Timed Count Error"))
+        try:
+            self.t_signals.count_start.emit()
+            self.count_thread.start() #starts thread
+        except:
+            err_msg = QErrorMessage()
+            err_msg.setWindowTitle("Timed Count Error")
+            err_msg.showMessage(traceback.format_exc())
+    def timed_count(self,duration,checkpoint = None):
+        """Streams heartbeat samples into self.samples for the given duration
+           and returns the log entry of the count
+
+        Counts of LONG_RUN seconds or more are checkpointed to RUNS_DIR, so they
+        can be resumed after a crash or a replug
+        """
+        serial_number = self.parent.device_id
+        if checkpoint is not None:
+            run = LongRun.resume(checkpoint,self.device,serial_number,ring=self.samples,service=self.scheduler.service)
         else:
-            log = {'total_count': total_counts, 'duration': duration}
-        self.port.write(('<HEARTBEAT0>>').encode())
-        return log
+            path = checkpoint_name(self.RUNS_DIR,serial_number) if duration >= self.LONG_RUN else None
+            run = LongRun(self.device,duration,path,serial_number,ring=self.samples,service=self.scheduler.service) #lets queued commands through between samples
+        run.callbacks.append(self._count_sample)
+        self.count_total = run.counts
+        self.count_elapsed = run.seconds
+        self.stats = run.stats #totals of a resumed run carry on
+        self.long_run = run
+        run.run() #heartbeat mode on GMC will return total counts every second
+        self.timer_interrupt_flag = False
+        cfg = config_cache.cached(self.device)
+        return {'total_count': run.counts, 'duration': run.seconds, 'missed': run.missed,
+                'voltage': cfg.tube1_voltage_percent if cfg is not None else 0.0}
+    def _count_sample(self,timestamp,count):
+        """Called from the stream for every heartbeat sample, after the run's totals are updated
+        """
+        clock = self.long_run.stream.clock
+        self.count_total = self.long_run.counts
+        self.count_elapsed = self.long_run.seconds #device seconds, lost samples included
+        if self.store is not None:
+            self.store.append(clock.wall(timestamp),count,clock.flags) #durable right away, survives a crash
+        self.rate_alarm.update(clock.wall(timestamp),count)
+        if count > 0:
+            self.t_signals.new_count.emit(self.count_total,self.count_elapsed)
+        if self.device.metrics is not None:
+            self.device.metrics.signal_queued() #delivered in update_timer
+        self.t_signals.timer_update.emit(self.count_elapsed)
     def count_interrupt(self):
         if not self.timer_interrupt_flag:
             self.timer_interrupt_flag = True
+            if self.long_run:
+                self.long_run.stop()
     def update_timer(self,cur_time):
-        """Updates the timer in the textbox every second
+        """Updates the elapsed time of the readout every second
         """
+        if self.device is not None and self.device.metrics is not None:
+            self.device.metrics.signal_delivered()
         if not self.timer_interrupt_flag:
-            minutes = int((cur_time-(cur_time)%60)/60)
-            seconds = cur_time%60 #convert pure second value into minutes and seconds
-            print(f'count_time: {cur_time:d}, minutes: {minutes:d}, seconds: {seconds:d}')
-            new_elapsed_text = ["Elapsed Time: 00:" +f'{minutes:02}'+":" + f'{seconds:02}']
-      
-            old_text_measurements = self.timer_text.toPlainText().splitlines()[1:5]
-            new_text_lines = new_elapsed_text+old_text_measurements
-            new_text  = '\n'.join(new_text_lines)
-            self.timer_text.setPlainText(new_text) #changes the text
+            self.count_display.set_fields(elapsed=cur_time)
     def update_measurement(self,total_counts,duration):
-        """Updates the measurements in the textbox for every new counts
+        """Updates the measurements of the readout for every new counts
         """
-        if duration < 60:
-            average_cpm = total_counts
-        else:
-            min_duration = duration/60
-            average_cpm = total_counts/min_duration #averages out the CPM after 1 minute
-        average_usph = average_cpm*0.006
-        average_mrph = average_usph*0.1 #unit conversion
-        new_text_lines = ['Count: '+str(total_counts),
-        'Average CPM: '+f'{average_cpm:.2f}',
-        'Average uSv/h: '+f'{average_usph:.2f}',
-        'Average mR/h: '+f'{average_mrph:.3f}']
-        old_text_elasped = self.timer_text.toPlainText().splitlines()[0]
-        new_text_lines.insert(0,old_text_elasped)
-        new_text  = '\n'.join(new_text_lines)
-        self.timer_text.setPlainText(new_text) #changes the text
+        run = self.stats.run() #averages over the whole count, with the device's uSv/h factor
+        self.count_display.set_fields(count=total_counts,cpm=run['cpm'],cpm_ci=(run['cpm_low'],run['cpm_high']),
+                                      cpm_1m=self.stats.window(60)['cpm'],usph=run['usvh'],mrph=run['mrh'])
     def update_timer_log(self, log: dict):
         if self.checkbox.isChecked():
-            self.timer_log.append(log)
-            last_row = len(self.timer_log)
-            log_count = QTableWidgetItem(str(log['total_count']))
-            log_dur  = QTableWidgetItem(str(log['duration']))
-            if self.timer_table.rowCount() < last_row:
-                self.timer_table.insertRow(last_row-1)
-            self.timer_table.setItem(last_row-1,0,log_count)
-            self.timer_table.setItem(last_row-1,1,log_dur) #updates the timer log
+            self.timer_model.append(log) #updates the timer log
     def clear_log(self):
-        self.timer_table.clearContents()
-        self.timer_log=[]
+        self.timer_model.clear()
     def clear_last_row(self):
-        self.timer_table.setItem(len(self.timer_log)-1,0,QTableWidgetItem(''))
-        self.timer_table.setItem(len(self.timer_log)-1,1,QTableWidgetItem(''))
+        self.timer_model.pop()
     def closeEvent(self,event): 
-        self.port.close()
+        self.device.close()
 
         # except AttributeError:
             # pass
-### Potential Plotting widget; unfinished code
-# class CounterPlot(QGroupBox):
-    # def __init__(self, port: serial.Serial, title: str = "Count Graph"):
-        # super(CounterPlot, self).__init__()
-        # self.setTitle(title)
-        # self.port = port
-        # self.p_layout = QVBoxLayout()
-        # self._makePlot()
-        # self._makePlotButtons()
+class PlotCanvas(QWidget):
+    """Count rate plot of SeriesPyramids, one min/max bar and mean line per pixel column
 
-        # layout.addWidget(self.button)
-        # self.setLayout(self.p_layout)
-    # def _makePlot(self):
-        # self.figure = Figure()
-        # self.canvas = FigureCanvas(self.figure)
-        # self.toolbar = NavigationToolbar(self.canvas, self)
-        # self.p_layout.addWidget(self.toolbar)
-        # self.p_layout.addWidget(self.canvas)
-    # def _makePlotButtons(self):
-        # self.buttonBox = QGridLayout()
-        # self.run_cps_btn = QPushButton("Counts Per Second", self)
-        # self.run_cps_btn.clicked.connect(self.run_cps)
-        # self.buttonBox.addWidget(self.run_cps_btn,0,0,1,2)
-        # self.run_cps_btn = QPushButton("Counts Per Second", self)
-        # self.run_cps_btn.clicked.connect(self.run_cps)
-        # self.buttonBox.addWidget(self.run_cps_btn,0,0,1,2)
-    # def run_cps(self):
-        # self.plot_thread = SubThread(self.counts_per_second,minutes,seconds)
-        # self.count_thread.signals.result.connect(self.update_timer_log)
-        # self.count_thread.signals.new_count.connect(self.update_measurement)
-    # def counts_per_second(self):
-        
+    The plot area is cached in a pixmap. While following the newest samples the
+    view moves on in whole pixel columns, so the pixmap is scrolled and only the
+    new columns are drawn. A change of span, size or value range redraws it all.
+    """
+    MARGINS = (52, 8, 10, 24) #left, top, right, bottom space for the axes
+    COLORS = ('#1f77b4','#d62728','#2ca02c','#ff7f0e','#9467bd','#8c564b')
+    TIME_STEPS = (1,2,5,10,15,30,60,120,300,600,900,1800,3600,7200,10800,21600,43200,86400,172800,604800)
+    MIN_SPAN = 10
+    MAX_SPAN = 400*86400
+    follow_changed = pyqtSignal(bool)
+    def __init__(self, parent = None):
+        super(PlotCanvas, self).__init__(parent)
+        self.series = {} #name: SeriesPyramid of counts per second
+        self.colors = {}
+        self.span = 600.0 #seconds across the plot
+        self.end = None #time at the right edge, on the time.monotonic() scale of the samples
+        self.follow = True #keeps the newest sample at the right edge
+        self.scale = 60 #counts per second to CPM
+        self.y_max = 10.0 #CPM at the top edge
+        self.wall_offset = time.time() - time.monotonic()
+        self.utc_offset = datetime.now().astimezone().utcoffset().total_seconds() #ticks fall on local hours and days
+        self.cache = None #QPixmap of the plot area
+        self.drag = None #x and view end where a drag started
+        self.setMinimumSize(400,180)
+        self.setSizePolicy(QSizePolicy.Expanding,QSizePolicy.Expanding)
+    def add_series(self, name: str) -> SeriesPyramid:
+        if name not in self.series:
+            self.series[name] = SeriesPyramid()
+            self.colors[name] = QColor(self.COLORS[(len(self.series) - 1) % len(self.COLORS)])
+        return self.series[name]
+    def plot_rect(self) -> QRect:
+        left, top, right, bottom = self.MARGINS
+        return QRect(left, top, max(1, self.width() - left - right), max(1, self.height() - top - bottom))
+    def latest(self) -> float:
+        return max((s.last for s in self.series.values() if len(s)), default=None)
+    def set_span(self, seconds: float):
+        """Shows <seconds> of samples, None for all of them
+        """
+        if seconds is None:
+            firsts = [s.first for s in self.series.values() if len(s)]
+            seconds = self.latest() - min(firsts) if firsts else self.span
+        self.span = min(max(float(seconds), self.MIN_SPAN), self.MAX_SPAN)
+        if self.follow:
+            self.end = None #re-aligned to the newest sample
+        self.invalidate()
+    def set_follow(self, follow: bool):
+        if follow != self.follow:
+            self.follow = follow
+            self.follow_changed.emit(follow)
+            if follow:
+                self.end = None
+                self.invalidate()
+    def invalidate(self):
+        self.cache = None
+        self.update()
+    def advance(self):
+        """Shows the samples appended since the last call
+        """
+        latest = self.latest()
+        if latest is None:
+            return
+        if not self.follow or self.cache is None or self.end is None:
+            self.invalidate()
+            return
+        rect = self.plot_rect()
+        width = self.span/rect.width()
+        shift = int((latest - self.end)/width) + 1 if latest >= self.end else 0 #whole columns, the newest sample stays in view
+        if shift >= rect.width():
+            self.end = None
+            self.invalidate()
+            return
+        self.end += shift*width
+        if shift:
+            self.cache.scroll(-shift,0,self.cache.rect())
+        redrawn = self._draw_columns(rect.width() - shift - 1, rect.width()) #new columns and the one that was newest
+        if redrawn > self.y_max: #would be clipped
+            self.invalidate()
+        else:
+            self.update()
+    def _draw_columns(self, first: int, last: int) -> float:
+        """Clears and draws plot columns <first> to <last> of the cache, returns the highest CPM drawn
+        """
+        pixmap = self.cache
+        width, height = pixmap.width(), pixmap.height()
+        column = self.span/width
+        start = self.end - self.span
+        first = max(first, 0)
+        painter = QPainter(pixmap)
+        painter.fillRect(first, 0, last - first, height, Qt.white)
+        highest = 0.0
+        y = lambda value: (height - 1) - value*self.scale*(height - 1)/self.y_max
+        context = max(first - 1, 0) #joins the mean line to the column before
+        for name, series in self.series.items():
+            columns = series.columns(start + context*column, start + last*column, last - context)
+            if not columns:
+                continue
+            color = self.colors[name]
+            band = QColor(color)
+            band.setAlpha(90)
+            painter.setPen(QPen(band, 1))
+            painter.drawLines([QLineF(context + c + 0.5, y(low), context + c + 0.5, y(high)) for c, low, high, mean in columns])
+            painter.setPen(QPen(color, 1.5))
+            painter.drawPolyline(QPolygonF([QPointF(context + c + 0.5, y(mean)) for c, low, high, mean in columns]))
+            highest = max(highest, max(high for c, low, high, mean in columns)*self.scale)
+        painter.end()
+        return highest
+    def _redraw(self):
+        """Redraws the whole plot area, fitting the value axis to the samples in view
+        """
+        rect = self.plot_rect()
+        latest = self.latest()
+        if self.end is None or self.follow:
+            width = self.span/rect.width()
+            self.end = (latest + width) if latest is not None else time.monotonic()
+        start = self.end - self.span
+        ranges = [s.value_range(start, self.end) for s in self.series.values()]
+        high = max((r[1] for r in ranges if r is not None), default=0)*self.scale
+        self.y_max = nice_number(max(high*1.1, 10))
+        self.cache = QPixmap(rect.size())
+        self._draw_columns(0, rect.width())
+    def paintEvent(self, event):
+        rect = self.plot_rect()
+        if self.cache is None or self.cache.size() != rect.size():
+            self._redraw()
+        painter = QPainter(self)
+        painter.drawPixmap(rect.topLeft(), self.cache)
+        painter.setPen(self.palette().color(QPalette.WindowText))
+        painter.drawRect(rect.adjusted(0,0,-1,-1))
+        metrics = painter.fontMetrics()
+        y_step = nice_number(self.y_max/max(1, rect.height()//40))
+        value = 0.0
+        while value <= self.y_max:
+            y = rect.bottom() - value*(rect.height() - 1)/self.y_max
+            painter.drawLine(rect.left() - 4, int(y), rect.left(), int(y))
+            painter.drawText(QRect(0, int(y) - 8, rect.left() - 6, 16), Qt.AlignRight | Qt.AlignVCenter, f'{value:g}')
+            value += y_step
+        start = self.end - self.span
+        step = next((s for s in self.TIME_STEPS if s*rect.width()/self.span >= 90), self.TIME_STEPS[-1])
+        fmt = '%H:%M:%S' if step < 60 else ('%H:%M' if step < 86400 else '%d %b')
+        local = self.wall_offset + self.utc_offset
+        tick = ((start + local)//step + 1)*step - local
+        while tick < self.end:
+            x = rect.left() + (tick - start)*rect.width()/self.span
+            painter.drawLine(int(x), rect.bottom(), int(x), rect.bottom() + 4)
+            text = time.strftime(fmt, time.localtime(tick + self.wall_offset))
+            painter.drawText(QRect(int(x) - 40, rect.bottom() + 5, 80, metrics.height()), Qt.AlignHCenter, text)
+            tick += step
+        painter.drawText(QRect(0, rect.bottom() + 5, rect.left() - 6, metrics.height()), Qt.AlignRight, 'CPM')
+        x = rect.left() + 6
+        for name in self.series:
+            painter.setPen(self.colors[name])
+            painter.drawText(x, rect.top() + metrics.ascent() + 2, name)
+            x += metrics.horizontalAdvance(name) + 12
+        painter.end()
+    def wheelEvent(self, event):
+        """Zooms by a factor of 2 per notch, around the cursor unless following
+        """
+        if self.end is None:
+            return
+        rect = self.plot_rect()
+        factor = 0.5**(event.angleDelta().y()/120)
+        span = min(max(self.span*factor, self.MIN_SPAN), self.MAX_SPAN)
+        if not self.follow:
+            anchor = self.end - self.span + (event.pos().x() - rect.left())*self.span/rect.width()
+            self.end = anchor + (self.end - anchor)*span/self.span
+        self.span = span
+        self.invalidate()
+    def mousePressEvent(self, event):
+        if event.button() == Qt.LeftButton and self.end is not None:
+            self.drag = (event.pos().x(), self.end)
+    def mouseMoveEvent(self, event):
+        if self.drag is not None:
+            self.set_follow(False)
+            x, end = self.drag
+            self.end = end - (event.pos().x() - x)*self.span/self.plot_rect().width()
+            self.invalidate()
+    def mouseReleaseEvent(self, event):
+        self.drag = None
+    def mouseDoubleClickEvent(self, event):
+        self.set_follow(True)
+def nice_number(value: float) -> float:
+    """Smallest 1, 2 or 5 times a power of ten not below <value>
+    """
+    exponent = 10**math.floor(math.log10(value)) if value > 0 else 1
+    return next(m*exponent for m in (1, 2, 5, 10) if m*exponent >= value)
+class CounterPlot(QGroupBox):
+    """Live count rate plot fed from the per second sample rings of the counters
+
+    New samples are moved from the rings into each series' pyramid once per frame.
+    """
+    SPANS = (('10 s',10),('1 min',60),('10 min',600),('1 h',3600),('6 h',21600),('1 day',86400),('10 days',864000),('All',None))
+    def __init__(self, title: str = "Count Rate", parent = None, frame_ms: int = 200):
+        super(CounterPlot, self).__init__(parent)
+        self.setTitle(title)
+        self.feeds = [] #[name, ring, samples already taken]
+        self.p_layout = QVBoxLayout()
+        self._makePlot()
+        self._makePlotButtons()
+        self.setLayout(self.p_layout)
+        self.frame_timer = QTimer(self)
+        self.frame_timer.timeout.connect(self.drain)
+        self.frame_timer.start(frame_ms)
+    def _makePlot(self):
+        self.canvas = PlotCanvas(self)
+        self.p_layout.addWidget(self.canvas)
+    def _makePlotButtons(self):
+        self.buttonBox = QHBoxLayout()
+        self.buttonBox.addWidget(QLabel('Span:',self))
+        self.span_box = QComboBox(self)
+        for text, seconds in self.SPANS:
+            self.span_box.addItem(text,seconds)
+        self.span_box.setCurrentIndex(2)
+        self.span_box.activated.connect(lambda i: self.canvas.set_span(self.span_box.itemData(i)))
+        self.buttonBox.addWidget(self.span_box)
+        self.follow_box = QCheckBox('Follow',self) #wheel zooms, dragging pans, double click follows again
+        self.follow_box.setChecked(True)
+        self.follow_box.toggled.connect(self.canvas.set_follow)
+        self.canvas.follow_changed.connect(self.follow_box.setChecked)
+        self.buttonBox.addWidget(self.follow_box)
+        self.buttonBox.addStretch(1)
+        self.p_layout.addLayout(self.buttonBox)
+    def add_series(self, name: str, ring: SampleRing):
+        """Plots the samples appended to <ring> from now on as series <name>
+
+        A series fed from the same ring before keeps its samples but gets no new ones.
+        """
+        self.drain()
+        self.feeds = [feed for feed in self.feeds if feed[1] is not ring]
+        self.canvas.add_series(name)
+        self.feeds.append([name, ring, ring.total])
+    def drain(self):
+        """Moves new ring samples into the plot
+        """
+        added = False
+        for feed in self.feeds:
+            name, ring, taken = feed
+            if ring.total < taken: #ring was cleared
+                taken = 0
+            total = ring.total #the stream may append while this runs
+            since = max(taken, total - ring.capacity)
+            series = self.canvas.series[name]
+            for times, counts in ring.segments(since):
+                n = min(len(times), total - since)
+                series.extend(times[:n], counts[:n])
+                since += n
+                added = added or n > 0
+            feed[2] = total
+        if added:
+            self.canvas.advance()
 class CounterTerminal(QMainWindow):
     """Main window for GMC Terminal
     """
     def __init__(self):
         super().__init__()
         self.setWindowTitle('GMC Terminal')
-        self.serialport = None #serial port for device
+        self.device = None #GMCDevice on the chosen serial port
+        self.device_id = '' #serial number of the device, names its sample store
+        self.sample_store = TimeSeriesStore('samples') #per second samples of every device
+        self.metrics_server = None #Prometheus endpoint, on when GMC_METRICS_PORT is set
+        if os.environ.get('GMC_METRICS_PORT'):
+            self.metrics_server = metrics_registry.serve(int(os.environ['GMC_METRICS_PORT']))
         self.version = ''
+        self.discovery = Discovery() #finds counters on all ports at once, remembers them in devices.json
+        self.scheduler = None #CommandScheduler, the only thread talking to the open port
+        self.open_thread = None #SubThread opening a port
+        self.device_threads = set() #SubThreads waiting on scheduled commands
+        self.sweep = None #PlateauSweep while one is running
+        self.interrupted_run = None #checkpoint of a long count cut off by a port error, resumed on reconnect
+        self.reconnect_timer = QTimer(self) #looks for the counter of the interrupted count
+        self.reconnect_timer.setInterval(RECONNECT_INTERVAL*1000)
+        self.reconnect_timer.timeout.connect(self._reconnect)
         #self.threadpool = QThreadPool()
-        self.setFixedSize(600,400)
+        self.setMinimumSize(600,400)
+        self.resize(800,720) #room for the count rate plot
         self._createMenubar()
         self._createToolbar()
         self._make_GMC_GUI() #builds the GUI
+        self.auto_detect(self.discovery.reconnect) #reopens a counter seen before, if plugged in
     def _createMenubar(self):
         self.menu = self.menuBar()
         file_menu = self.menu.addMenu('&File')
         file_menu.addAction('&Exit', self.close)
         file_menu.addAction('Export Count Log',self.export_count_log)
+        file_menu.addAction('Export Samples',self.export_samples)
+        self.record_action = file_menu.addAction('Record Samples to Disk',self._set_sample_store)
+        self.record_action.setCheckable(True)
+        self.record_action.setChecked(True)
+        self.capture_action = file_menu.addAction('Capture Serial Traffic') #raw bytes to captures/, applies to the next port opened
+        self.capture_action.setCheckable(True)
         
         device_menu = self.menu.addMenu('Devices')
         device_menu.addAction('Open Ports',self._make_Portlist)
+        device_menu.addAction('Auto Detect',partial(self.auto_detect,None))
         device_menu.addAction('Export Configuration Data',self.export_config_data)
+        device_menu.addAction('Download History',self.download_history)
+        device_menu.addAction('Read Battery Voltage',self.read_battery_voltage)
+        device_menu.addAction('Read Telemetry',self.read_telemetry)
+        device_menu.addAction('Plateau Sweep',self._make_Sweep_Dialog)
+        device_menu.addAction('Stop Plateau Sweep',self.stop_sweep)
         device_menu.addAction('Factory Reset', self.factory_reset)
         device_menu.addAction('Close Ports', self.close_port)
     def _createToolbar(self):
@@ -422,18 +784,41 @@ class CounterTerminal(QMainWindow):
                                  "Percent (0-100%): ", 50, 0, 100, 1)
         if okay:
             self.write_tube_voltage(user_percent)
+    def _make_Sweep_Dialog(self):
+        """Dialog for the voltage range, step and dwell time of a plateau sweep
+        """
+        if not self.device or self.volt_toolbar.isHidden():
+            return
+        dialog = QDialog(self)
+        dialog.setWindowTitle("Plateau Sweep")
+        form = QFormLayout(dialog)
+        boxes = []
+        for label, value, suffix, maximum in (("Start:",30,' %',100),("Stop:",80,' %',100),
+                                              ("Step:",2,' %',50),("Dwell:",60,' s',3600)):
+            box = QDoubleSpinBox(dialog) if suffix == ' %' else QSpinBox(dialog)
+            box.setRange(1 if label == "Step:" else 0,maximum)
+            box.setValue(value)
+            box.setSuffix(suffix)
+            form.addRow(label,box)
+            boxes.append(box)
+        buttons = QDialogButtonBox(QDialogButtonBox.Ok | QDialogButtonBox.Cancel,parent=dialog)
+        buttons.accepted.connect(dialog.accept)
+        buttons.rejected.connect(dialog.reject)
+        form.addRow(buttons)
+        if dialog.exec_():
+            start, stop, step, dwell = (box.value() for box in boxes)
+            self.run_sweep(sweep_voltages(start,stop,step),dwell)
     def _make_GMC_GUI(self):
         self.centralwidget = QWidget(self)
         self.GMC_layout = QVBoxLayout(self.centralwidget)
         self._make_Timed_Counter()
-        # line_sep = QFrame(self.centralwidget)
-        # line_sep.setFrameStyle(QFrame.Raised)
-        # line_sep.setFrameShape(QFrame.HLine)
-        # line_sep.setLineWidth(1)
-        # line_sep.setMidLineWidth(0)
-        # self.GMC_layout.addWidget(line_sep)
-        ### horizontal separator in case of more widgets below the line
-        self.GMC_layout.addStretch(1)
+        line_sep = QFrame(self.centralwidget)
+        line_sep.setFrameStyle(QFrame.Raised)
+        line_sep.setFrameShape(QFrame.HLine)
+        line_sep.setLineWidth(1)
+        line_sep.setMidLineWidth(0)
+        self.GMC_layout.addWidget(line_sep)
+        self._make_Counter_Plot()
         self.setCentralWidget(self.centralwidget)
         return self.centralwidget
     def _make_Timed_Counter(self):
@@ -444,27 +829,78 @@ class CounterTerminal(QMainWindow):
         
         timer_layout = QHBoxLayout()
         timer_layout.addStretch(1)
-        self.counterBox = TimedCounter(self.serialport,parent = self)
+        self.counterBox = TimedCounter(self.device,parent = self)
+        self.counterBox.t_signals.alarm.connect(self.show_alarm)
         timer_layout.addWidget(self.counterBox)
         timer_layout.addStretch(1) 
         self.counterBox.move(250,20)
         self.GMC_layout.addLayout(timer_layout)
+    def _make_Counter_Plot(self):
+        """adds the live CounterPlot below the timed counter
+        """
+        self.plot = CounterPlot(parent = self)
+        self.GMC_layout.addWidget(self.plot,1) #takes the space left over
 ### Public functions
     def open_ports(self):
     
         portchoice = self.portlist_dialog.scrolledList.currentItem()
-        if self.serialport:
+        self.portlist_dialog.accept() #closes the dialog
+        self.open_port(portchoice.text())
+    def auto_detect(self, search = None):
+        """Probes every port at once in the background and opens the first counter found
+
+        <search> is Discovery.discover (the default) or Discovery.reconnect to only look for known counters
+        """
+        search = search or self.discovery.discover
+        exclude = (self.device.name,) if self.device else ()
+        self.discovery_thread = SubThread(search,exclude)
+        self.discovery_thread.signals.result.connect(self._open_detected)
+        self.discovery_thread.signals.error.connect(partial(self._thread_error,"Auto Detect Error"))
+        self.discovery_thread.start()
+    def _open_detected(self, records: list):
+        if records and not self.device:
+            self.open_port(records[0].port)
+    def open_port(self, port_name: str):
+        """Opens <port_name> and identifies the counter on a SubThread, see _port_opened
+        """
+        if self.open_thread is not None and self.open_thread.isRunning(): #one port opens at a time
+            return
+        if self.device:
             self.close_port()
+        capture = capture_path('captures',port_name) if self.capture_action.isChecked() else None
+        print(f"Port of choice : {port_name}")
+        self.device_label.setText(f"Opening {port_name}")
+        self.open_thread = SubThread(self._connect,port_name,capture)
+        self.open_thread.signals.result.connect(self._port_opened)
+        self.open_thread.signals.error.connect(partial(self._thread_error,"Port Error"))
+        self.open_thread.signals.error.connect(lambda error: self.device_label.setText('No Device Selected'))
+        self.open_thread.start()
+    def _connect(self, port_name: str, capture: str) -> tuple:
+        """Opens a port and reads the version and serial number through its new scheduler, on the open SubThread
+        """
+        device = GMCDevice.open(port_name,capture=capture) # opens the chosen port and makes sure heartbeat mode is off
+        metrics_registry.attach(device) #latency, byte and heartbeat counters
+        scheduler = CommandScheduler(device).start()
+        try:
+            version = scheduler.run(device.get_version)
+            device_id = device.name
+            if version[0:3] == "GMC":
+                try:
+                    device_id = scheduler.run(device.get_serial)
+                except GMCError: #firmware without GETSERIAL
+                    pass
+        except:
+            scheduler.close(2)
+            device.close()
+            raise
+        return device,scheduler,version,device_id
+    def _port_opened(self, opened: tuple):
+        """Sets the GUI up for the port _connect opened
+        """
+        self.device,self.scheduler,self.version,self.device_id = opened
+        self.counterBox.scheduler = self.scheduler
+        print(self.version)
         try:
-            
-            self.serialport = serial.Serial(portchoice.text(),115200, timeout = 1) # opens the chosen port
-            print(f"Port of choice : {portchoice.text()}")
-            self.portlist_dialog.accept() #closes the dialog
-            self.serialport.write(('<HEARTBEAT0>>').encode()) # Makes sure heartbeat mode is off; heartbeat may interfere with attempts to read off the device
-            time.sleep(0.5)
-            self.serialport.write(('<GETVER>>').encode())
-            self.version = self.serialport.read(15).decode() #get the device version
-            print(self.version)
             if self.version[0:3] == "GMC":
                 self.device_label.setText(self.version)
                 self.device_label.setStyleSheet("background-color: limegreen; color: black; font-weight: bold")
@@ -477,84 +913,180 @@ class CounterTerminal(QMainWindow):
                 print("GMC device with Tube voltage configuration chosen.")
                 self.volt_toolbar.show()
                 self.read_tube_voltage()
-                self.counterBox.port = self.serialport
+                self.counterBox.device = self.device
+                self.counterBox.count_run_btn.setEnabled(True)
+                self.counterBox.rate_alarm.reset() #another tube, another background
+                self._set_sample_store()
+                self.plot.add_series(self.device_id,self.counterBox.samples)
+                self._offer_resume()
 
         except:
             # error dialog
-            self.portlist_dialog.reject()
             err_msg = QErrorMessage(self)
             err_msg.setWindowTitle("Port Error")
             err_msg.showMessage(traceback.format_exc())
     def close_port(self):
-        if self.serialport:
-            self.serialport.close()
+        if self.device:
+            self.stop_sweep()
+            if self.counterBox.long_run:
+                self.counterBox.count_interrupt()
+            if self.scheduler:
+                self.scheduler.close(2)
+                self.scheduler = None
+            config_cache.invalidate(self.device)
+            self.device.close()
             self.volt_toolbar.hide()
-            self.serialport = None
+            self.device = None
+            self.counterBox.device = None
+            self.counterBox.scheduler = None
+            self.counterBox.count_run_btn.setEnabled(False)
+            self.counterBox.store = None
+            self.sample_store.flush()
             self.device_label.setStyleSheet("background-color: red; color: black; font-weight: bold")
             self.device_label.setText('No Device Selected')
+    def _set_sample_store(self):
+        """Points the counter at the sample store of the open device, if recording
+        """
+        if self.device and self.record_action.isChecked():
+            self.counterBox.store = self.sample_store.device(self.device_id)
+        else:
+            self.counterBox.store = None
     def read_tube_voltage(self)->float:
         """Reads the tube voltage of tube 1
         """
         
-        if self.serialport:
-            try:
-                self.serialport.write(('<GETCFG>>').encode())
-                cfg = self.serialport.read(512) #read in the CFG
-                print(cfg)
-                volt_percent = cfg[330]*(2/3) #get the voltage "percent" and convert it from out of 150 to out of 100
-                tube_volt_text = f"{volt_percent:.2f}"+"%"
-                self.tube_voltage_reading.setText(tube_volt_text)
-            except:
-                err_msg = QErrorMessage(self)
-                err_msg.setWindowTitle("Voltage Read Error")
-                err_msg.showMessage(traceback.format_exc())
+        if self.device:
+            self._submit(config_cache.get,self.device,result=self._show_tube_voltage, #cached CFG, read from the device once
+                         error_title="Voltage Read Error")
+    def run_sweep(self, voltages: list, dwell: int):
+        """Runs a plateau sweep on the scheduler, logging every step
+        """
+        self.sweep = PlateauSweep(self.device,voltages,dwell,service=self.scheduler.service)
+        signals = ThreadSignals()
+        signals.progress.connect(self._log_sweep_step)
+        self.counterBox.count_run_btn.setEnabled(False)
+        self.volt_write_btn.setEnabled(False)
+        self.statusBar().showMessage(f"Plateau sweep: {len(voltages)} steps of {dwell} s")
+        self._submit(self.sweep.run,signals.progress.emit,result=self._show_plateau,finished=self._sweep_finished,
+                     error_title="Plateau Sweep Error",priority=PRIORITY_LOW)
+        self.sweep_signals = signals #keeps the signals alive while the sweep runs
+    def stop_sweep(self):
+        if self.sweep:
+            self.sweep.stop()
+    def _log_sweep_step(self, step):
+        self.counterBox.timer_model.append({'total_count': step.counts, 'duration': step.seconds, 'voltage': step.voltage})
+        self.statusBar().showMessage(f"Plateau sweep: {step.voltage:.1f}% {step.cpm:.1f} CPM")
+    def _sweep_finished(self):
+        self.sweep = None
+        self.counterBox.count_run_btn.setEnabled(self.counterBox.device is not None)
+        self.volt_write_btn.setEnabled(True)
+        self.read_tube_voltage() #the original voltage is restored
+    def _show_plateau(self, steps: list):
+        plateau = find_plateau(steps)
+        if plateau is None:
+            text = "No plateau found, try a wider range or a longer dwell time"
+        else:
+            text = (f"Plateau: {plateau.start:.1f}% - {plateau.end:.1f}%\n"
+                    f"Slope: {plateau.slope:.2f}% per voltage point\n"
+                    f"Recommended set-point: {plateau.setpoint:.1f}%")
+        self.statusBar().showMessage("Plateau sweep finished")
+        QMessageBox.information(self,"Plateau Sweep",text)
+    def read_battery_voltage(self):
+        """Shows the battery voltage in the status bar, also while a count is running
+        """
+        if self.device:
+            self._submit(self.device.get_battery_voltage,error_title="Battery Read Error",
+                         result=lambda volt: self.statusBar().showMessage(f"Battery: {volt:.1f} V"))
+    def show_alarm(self, event):
+        """Turns the device label red while the count rate is in alarm
+        """
+        when = time.strftime('%H:%M:%S',time.localtime(event.timestamp))
+        if event.kind == 'clear':
+            self.device_label.setStyleSheet("background-color: limegreen; color: black; font-weight: bold")
+            self.device_label.setText(self.version)
+            self.statusBar().showMessage(f"{when} Alarm cleared, {event.rate*60:.0f} CPM during the alarm")
+            return
+        QApplication.beep()
+        self.device_label.setStyleSheet("background-color: red; color: white; font-weight: bold")
+        self.device_label.setText(f"RATE {'RISE' if event.kind == 'rise' else 'DROP'}: {event.rate*60:.0f} CPM")
+        self.statusBar().showMessage(f"{when} Count rate {event.kind}: {event.rate*60:.0f} CPM "
+                                     f"against a background of {event.background*60:.0f} CPM")
+    def read_telemetry(self):
+        """Shows CPM, battery, temperature, gyro and clock offset in the status bar, read in one round trip
+        """
+        if self.device:
+            self._submit(read_telemetry,self.device,self.device_id,error_title="Telemetry Read Error",
+                         result=lambda t: self.statusBar().showMessage(
+                             f"CPM: {t.cpm}   Battery: {t.battery:.1f} V   Temperature: {t.temperature:.1f} C   "
+                             f"Gyro: {t.gyro[0]},{t.gyro[1]},{t.gyro[2]}   Clock: {t.clock_offset:+.0f} s"))
+    def _submit(self, fn, *args, result = None, finished = None, error_title: str = "Port Error", priority: int = PRIORITY_HIGH):
+        """Runs fn(*args) on the device's scheduler from a SubThread, so the GUI never waits on the port
+        """
+        thread = SubThread(self.scheduler.run,fn,*args,priority=priority)
+        if result:
+            thread.signals.result.connect(result)
+        if finished:
+            thread.signals.finished.connect(finished)
+        thread.signals.error.connect(partial(self._thread_error,error_title))
+        thread.signals.finished.connect(lambda: self.device_threads.discard(thread))
+        self.device_threads.add(thread) #keeps the thread alive until it is done
+        thread.start()
+        return thread
     def write_tube_voltage(self,voltage_percent: float):
         """Writes a given voltage percentage to a GQ GMC
-        """
-        if self.serialport: #if the port is open
-            try:
-                #self.volt_read_btn.setEnabled(False)
-                self.volt_write_btn.setEnabled(False)
-                
-                num_to_bytes = partial(int.to_bytes,byteorder = 'big')
-                
-                byte_percent = num_to_bytes(round(voltage_percent*(0.01)*150),1)
-                #converts the percentage into an integer /150, then to a bytes object
-                
-                self.serialport.write(('<GETCFG>>').encode())
-                cfg = bytearray(self.serialport.read(512)) #get the current configuration
 
-                self.serialport.write(('<ECFG>>').encode())
-                confirmation = self.serialport.read(1)
-                if confirmation != b'\xAA':
-                    print("Erasure failed:  " + confirmation.hex().upper()) #erase the current configuration
-         
-                cfg[330:331] = byte_percent #modify the config with the new percentage
-                for address in range(512): #re-write configuration data with new data
-                    write_package = ('<WCFG').encode() + num_to_bytes(address,2) + num_to_bytes(cfg[address],1) + ('>>').encode()
-                    self.serialport.write(write_package)
-                    write_confirmation = self.serialport.read(1)
-                    if write_confirmation != b'\xAA':
-                        print(write_package)
-                        print("Write Failed: " + write_confirmation.hex().upper()+ f" index: {address:d}")
-                
-                self.serialport.write(('<CFGUPDATE>>').encode())
-                confirmation = self.serialport.read(1)
-                if confirmation != b'\xAA':
-                    print("Update failed: " + confirmation.hex().upper()) #update the device
-                self.volt_write_btn.setEnabled(True)
-                self.read_tube_voltage()
-            except serial.serialutil.SerialException:
-                err_msg = QErrorMessage(self)
-                err_msg.setWindowTitle("Voltage Read Error")
-                err_msg.showMessage(traceback.format_exc())
-                self.volt_write_btn.setEnabled(True)
-                self.close_port()
-            except:
-                err_msg = QErrorMessage(self)
-                err_msg.setWindowTitle("Voltage Read Error")
-                err_msg.showMessage(traceback.format_exc())
-                self.volt_write_btn.setEnabled(True)
+        The config transaction is scheduled ahead of other commands and pauses a running count
+        """
+        if self.device: #if the port is open
+            #self.volt_read_btn.setEnabled(False)
+            self.volt_write_btn.setEnabled(False)
+            self._submit(set_tube_voltage,self.device,voltage_percent,result=self._show_tube_voltage,
+                         finished=lambda: self.volt_write_btn.setEnabled(True),error_title="Voltage Write Error")
+    def _show_tube_voltage(self,cfg):
+        """Displays the tube 1 voltage of a config image
+        """
+        tube_volt_text = f"{cfg.tube1_voltage_percent:.2f}"+"%"
+        self.tube_voltage_reading.setText(tube_volt_text)
+    def _thread_error(self,title: str,error: tuple):
+        """Shows the error emitted by a SubThread, closing the port if it was disconnected
+        """
+        exctype, value, trace = error
+        err_msg = QErrorMessage(self)
+        err_msg.setWindowTitle(title)
+        err_msg.showMessage(trace)
+        if issubclass(exctype,serial.serialutil.SerialException):
+            run = self.counterBox.long_run
+            if run is not None and run.path and not run.complete and not run.stopped:
+                self.interrupted_run = run.path
+                self.reconnect_timer.start()
+            self.close_port()
+    def _reconnect(self):
+        """Looks for the counter of an interrupted long count until it is back
+        """
+        if self.device:
+            self.reconnect_timer.stop()
+        elif not self.discovery_thread.isRunning():
+            self.auto_detect(self.discovery.reconnect)
+    def _offer_resume(self):
+        """Resumes the interrupted long count of the opened counter, or offers to resume an unfinished one
+        """
+        path = find_unfinished(self.counterBox.RUNS_DIR,self.device_id)
+        if path is None:
+            return
+        if path != self.interrupted_run:
+            state = read_checkpoint(path)
+            started = time.strftime('%Y-%m-%d %H:%M',time.localtime(state['started']))
+            answer = QMessageBox.question(self,"Resume Count",
+                f"A {state['duration']/3600:.1f} h count started {started} was cut off after "
+                f"{state['seconds']/3600:.1f} h. Resume it?",
+                QMessageBox.Yes | QMessageBox.No | QMessageBox.Discard)
+            if answer == QMessageBox.Discard:
+                abandon(path) #not offered again
+            if answer != QMessageBox.Yes:
+                return
+        self.interrupted_run = None
+        self.reconnect_timer.stop()
+        self.counterBox.run_count(None,path)
     def enable_btns(self):
         #self.volt_read_btn.setEnabled(True)
         self.volt_write_btn.setEnabled(True)        
@@ -566,56 +1098,86 @@ class CounterTerminal(QMainWindow):
     def export_config_data(self):
         """Exports the configuration data to a text file
         """
-        if self.serialport:
-            try:
-                self.serialport.write(('<GETCFG>>').encode())
-                cfg = self.serialport.read(512)
-                filename = QFileDialog.getSaveFileName(self, 'Save config', 
-                    'config_files',"Text Files (*.txt *.csv)")
-                with open(filename[0],'w') as config_file:
-                    config_file.write("Configuration data from " + self.version + "\n")
-                    for address in range(len(cfg)):
-                        if cfg[address] >= 32 and cfg[address] <= 126:
-                            char = chr(cfg[address]) + ' '
-                        else: 
-                            char = f'{cfg[address]:0>2X}' + ' '
-                        config_file.write(char)
-                        if address%32 == 0 and address != 0:
-                            config_file.write('\n')
-            except:
-                err_msg = QErrorMessage(self)
-                err_msg.setWindowTitle("Port Error")
-                err_msg.showMessage(traceback.format_exc())
+        if self.device:
+            filename = QFileDialog.getSaveFileName(self, 'Save config', 
+                'config_files',"Text Files (*.txt *.csv)")
+            if filename[0]:
+                self._submit(config_cache.get,self.device,result=partial(self._write_config_file,filename[0]))
+    def _write_config_file(self, filename: str, cfg):
+        """Writes a config image as text, characters where printable and hex elsewhere
+        """
+        cells = []
+        for address, byte in enumerate(bytes(cfg)):
+            cells.append((chr(byte) if 32 <= byte <= 126 else f'{byte:0>2X}') + ' ')
+            if address%32 == 0 and address != 0:
+                cells.append('\n')
+        try:
+            with open(filename,'w') as config_file:
+                config_file.write("Configuration data from " + self.version + "\n" + ''.join(cells)) #one write for the whole image
+        except:
+            err_msg = QErrorMessage(self)
+            err_msg.setWindowTitle("Port Error")
+            err_msg.showMessage(traceback.format_exc())
+    def download_history(self):
+        """Downloads the history flash to a binary file
+
+        An interrupted download resumes when the same file is chosen again
+        """
+        if self.device:
+            filename = QFileDialog.getSaveFileName(self, 'Save history', 
+                'history',"Binary Files (*.bin)")
+            if filename[0]:
+                self.disable_btns()
+                self._submit(HistoryDownloader(self.device).download,filename[0],finished=self.enable_btns,
+                             error_title="History Download Error",priority=PRIORITY_LOW)
     def export_count_log(self):
         """Exports the count log data
         """
         #filename = "logs\\" + datetime.now().strftime("%Y-%m-%d-%H%M%S") + "-data.csv"
-        filename = QFileDialog.getSaveFileName(self, 'Save config', 
-                'logs',"Text Files (*.txt *.csv)")
-        with open(filename[0],'w',newline='') as f:
-            fieldnames = ['#','Total Counts','Duration (seconds)']
-            wr = csv.writer(f)
-            wr.writerows([fieldnames])
-            n = 1
-            for log in self.counterBox.timer_log:
-                wr.writerow([n,log['total_count'],log['duration']])   
-                n = n + 1
+        filters = ["Text Files (*.txt *.csv)","Binary Count Log (*.gmclog)"] + [FILE_FILTERS[f] for f in available_formats()]
+        filename, file_filter = QFileDialog.getSaveFileName(self, 'Save count log', 
+                'logs',';;'.join(filters))
+        if not filename:
+            return
+        if filename.endswith('.gmclog'):
+            self.counterBox.timer_log.export_binary(filename)
+        elif filename.lower().endswith(tuple(FORMATS)):
+            export_count_log(self.counterBox.timer_log,filename)
+        else:
+            self.counterBox.timer_log.export_csv(filename)
+    def export_samples(self):
+        """Exports every device's recorded samples to a Parquet, Arrow or NumPy file
+        """
+        filters = [FILE_FILTERS[f] for f in available_formats()]
+        if not filters:
+            QMessageBox.warning(self,'Export Samples','Exporting samples needs NumPy: pip install numpy')
+            return
+        filename, file_filter = QFileDialog.getSaveFileName(self, 'Export samples', 'samples', ';;'.join(filters))
+        if not filename:
+            return
+        self.sample_store.flush() #a reader only sees what reached the segment files
+        thread = SubThread(export_store,self.sample_store.root,filename)
+        thread.signals.error.connect(partial(self._thread_error,"Export Error"))
+        thread.signals.result.connect(lambda rows: self.statusBar().showMessage(f'Exported {rows} samples to {filename}'))
+        thread.signals.finished.connect(lambda: self.device_threads.discard(thread))
+        self.device_threads.add(thread)
+        thread.start()
     def factory_reset(self):
         """Resets device to factory default.
         Useful for debugging.
         """
-        if self.serialport:
-            try:  
-                self.serialport.write(('<FACTORYRESET>>').encode())
-                confirmation = self.serialport.read(1)
-            except:
-                err_msg = QErrorMessage(self)
-                err_msg.setWindowTitle("Port Error")
-                err_msg.showMessage(traceback.format_exc())
+        if self.device:
+            self._submit(self._factory_reset,self.device,result=self._show_tube_voltage)
+    def _factory_reset(self, device: GMCDevice):
+        device.factory_reset()
+        config_cache.invalidate(device) #config changed on the device
+        return config_cache.get(device) if device.model in ('GMC-500','GMC-600') else None
     def closeEvent(self,event):
-        if self.serialport:
-            self.serialport.write(('<HEARTBEAT0>>').encode())
-            self.serialport.close()
+        if self.device:
+            self.close_port()
+        self.sample_store.close()
+        if self.metrics_server is not None:
+            self.metrics_server.shutdown()
 def main():
     app = QApplication(sys.argv) 
     port = serial.Serial('COM6',115200)
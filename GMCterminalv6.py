@@ -1,13 +1,15 @@
-import sys, traceback
-from PyQt5.QtWidgets import *
-from PyQt5.QtCore import *
-from PyQt5.QtGui import *
-
-
-from GMC_utils import CounterSignals, SubThread, TimedCounter, QSelectionDialog, CounterTerminal
+import sys
 
 
 def main():
+    """Starts the GUI, or the headless terminal in GMC_cli when given a command
+    """
+    if len(sys.argv) > 1:
+        from GMC_cli import main as cli_main
+        sys.exit(cli_main(sys.argv[1:]))
+    from PyQt5.QtWidgets import QApplication
+    from PyQt5.QtGui import QIcon
+    from GMC_utils import CounterTerminal
     app = QApplication(sys.argv)
     app.setWindowIcon(QIcon('img/UMD_Radiation.png'))
     win = CounterTerminal()